@@ -47,7 +47,9 @@ open_model_list = [
     "google/gemma-3-27b-it-fast",
 ]
 
+# Limits are looked up by model name, or by the longest key prefixing it, e.g. "gpt-4o" for every dated gpt-4o model.
 per_minute_token_limit = {
+    "claude-3-5-sonnet-20241022": 400000,
     "claude-3-5-sonnet-20240620": 400000,
     "claude-3-opus-20240229": 80000,
     "claude-3-sonnet-20240229": 160000,
@@ -62,3 +64,46 @@ per_minute_token_limit = {
     "Qwen/Qwen2.5-72B-Instruct-fast":400000,
     "google/gemma-3-27b-it-fast":400000,
 }
+
+# Requests per minute allowed for a model, at the usage tier of the token limits above:
+# Anthropic tier 3 (tier 4 for Claude 3.5 Sonnet), OpenAI tier 3, and Nebius AI Studio's default limits.
+# Models not listed here are only limited by tokens.
+per_minute_request_limit = {
+    "claude-3-5-sonnet-20241022": 4000,
+    "claude-3-5-sonnet-20240620": 4000,
+    "claude-3-opus-20240229": 2000,
+    "claude-3-sonnet-20240229": 2000,
+    "claude-3-haiku-20240307": 2000,
+    "gpt-4o": 5000,
+    "deepseek-ai/DeepSeek-V3-0324": 600,
+    "meta-llama/Llama-3.3-70B-Instruct": 600,
+    "Qwen/Qwen2.5-72B-Instruct": 600,
+    "google/gemma-3-27b-it": 600,
+    "deepseek-ai/DeepSeek-V3-0324-fast": 600,
+    "meta-llama/Llama-3.3-70B-Instruct-fast": 600,
+    "Qwen/Qwen2.5-72B-Instruct-fast": 600,
+    "google/gemma-3-27b-it-fast": 600,
+}
+
+# Context window of a model in tokens, used to plan token-aware chunks. Models not listed here default to 8192.
+context_window = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4o": 128000,
+    "gpt-4o-2024-11-20": 128000,
+    "claude-3-5-sonnet-20241022": 200000,
+    "claude-3-5-sonnet-20240620": 200000,
+    "claude-3-opus-20240229": 200000,
+    "claude-3-sonnet-20240229": 200000,
+    "claude-3-haiku-20240307": 200000,
+    "gemini-1.5-pro-001": 2097152,
+    "gemini-1.5-pro-002": 2097152,
+    "deepseek-ai/DeepSeek-V3-0324": 128000,
+    "meta-llama/Llama-3.3-70B-Instruct": 128000,
+    "Qwen/Qwen2.5-72B-Instruct": 32768,
+    "google/gemma-3-27b-it": 128000,
+    "deepseek-ai/DeepSeek-V3-0324-fast": 128000,
+    "meta-llama/Llama-3.3-70B-Instruct-fast": 128000,
+    "Qwen/Qwen2.5-72B-Instruct-fast": 32768,
+    "google/gemma-3-27b-it-fast": 128000,
+}
@@ -0,0 +1,286 @@
+import abc
+import json
+import os
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, BaseMessage
+
+from .providers import providers, get_model_provider, OpenAIProvider, ClaudeProvider
+
+
+def message_role(message: BaseMessage):
+    if isinstance(message, SystemMessage):
+        return "system"
+    elif isinstance(message, HumanMessage):
+        return "user"
+    elif isinstance(message, AIMessage):
+        return "assistant"
+    raise ValueError(f"Message type {type(message).__name__} is not supported in batch requests.")
+
+
+class BatchBackend(abc.ABC):
+
+    terminal_statuses = ()
+
+    def __init__(self, poll_interval=60, timeout=24 * 3600):
+        """
+        Offline batch backend. Serializes a whole list of prompts into a provider batch job,
+        submits it, polls for completion and maps the results back to LangChain's Responses.
+
+        Args:
+            poll_interval (float): Seconds to wait between polls. Defaults to 60.
+            timeout (float): Seconds to wait for the batch to complete before giving up. Defaults to 24 hours.
+        """
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    @abc.abstractmethod
+    def build_request(self, custom_id, prompt, model, max_tokens, temperature, bound_kwargs=None) -> dict:
+        """
+        Serialize a prompt into a request of the batch job.
+        bound_kwargs are the kwargs bound to the client, e.g. stop, logprobs or logit_bias, see LLMClient.bind.
+        A ValueError is raised if the provider's batch API does not support one of them.
+        """
+        pass
+
+    @abc.abstractmethod
+    def submit(self, requests: list[dict]) -> str:
+        pass
+
+    @abc.abstractmethod
+    def status(self, batch_id) -> str:
+        pass
+
+    @abc.abstractmethod
+    def results(self, batch_id) -> dict[str, AIMessage]:
+        pass
+
+    def wait(self, batch_id):
+        """
+        Poll the batch until it reaches a terminal status.
+
+        Returns:
+            The terminal status.
+
+        """
+        start_time = time.time()
+        while True:
+            status = self.status(batch_id)
+            if status in self.terminal_statuses:
+                return status
+            if time.time() - start_time > self.timeout:
+                raise TimeoutError(f"Batch {batch_id} did not complete in {self.timeout} seconds. Last status: {status}")
+            time.sleep(self.poll_interval)
+
+    def run(self, prompt_batch, model, max_tokens, temperature=0, bound_kwargs=None):
+        """
+        Run a batch of prompts as a single provider batch job.
+
+        Args:
+            prompt_batch: A batch of list of Messages.
+            model (str): The model to use.
+            max_tokens (int): The maximum number of tokens.
+            temperature (float): The temperature to use.
+            bound_kwargs (dict): The kwargs bound to the client, sent with every request, e.g. stop or logprobs.
+
+        Returns:
+            A list of LangChain's Responses, in the same order as prompt_batch.
+            Requests which failed in the batch get an empty response with the error in response_metadata["batch_error"].
+
+        """
+        requests = [
+            self.build_request(f"request-{i}", prompt, model, max_tokens, temperature, bound_kwargs=bound_kwargs)
+            for i, prompt in enumerate(prompt_batch)
+        ]
+        batch_id = self.submit(requests)
+        print(f"Submitted batch {batch_id} with {len(requests)} requests.")
+        status = self.wait(batch_id)
+        print(f"Batch {batch_id} finished with status {status}.")
+        results = self.results(batch_id)
+        return [
+            results.get(f"request-{i}", error_response(f"No result for request-{i} in batch {batch_id} ({status})"))
+            for i in range(len(prompt_batch))
+        ]
+
+
+def error_response(error):
+    return AIMessage(content="", response_metadata={"batch_error": error})
+
+
+class OpenAIBatchBackend(BatchBackend):
+
+    terminal_statuses = ("completed", "failed", "expired", "cancelled")
+
+    def __init__(self, base_url=None, api_key=None, completion_window="24h", poll_interval=60, timeout=24 * 3600):
+        """
+        Batch backend using OpenAI's Batch API. Also works with OpenAI compatible providers, e.g. Nebius.
+
+        Args:
+            base_url (str): The base url of the API. If None, use OpenAI's.
+            api_key (str): The API key. If None, read from the environment.
+            completion_window (str): The completion window of the batch. Defaults to "24h".
+            poll_interval (float): Seconds to wait between polls. Defaults to 60.
+            timeout (float): Seconds to wait for the batch to complete before giving up. Defaults to 24 hours.
+        """
+        super().__init__(poll_interval=poll_interval, timeout=timeout)
+        import openai
+        self.client = openai.OpenAI(base_url=base_url, api_key=api_key)
+        self.completion_window = completion_window
+
+    def build_request(self, custom_id, prompt, model, max_tokens, temperature, bound_kwargs=None):
+        # The bound kwargs are parameters of the chat completions API, e.g. stop, logprobs, top_logprobs, logit_bias
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+                "messages": [{"role": message_role(m), "content": m.content} for m in prompt],
+                **(bound_kwargs or {}),
+            }
+        }
+
+    def submit(self, requests):
+        jsonl = "\n".join(json.dumps(r) for r in requests).encode("utf-8")
+        batch_file = self.client.files.create(file=("batch.jsonl", jsonl), purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id, endpoint="/v1/chat/completions",
+            completion_window=self.completion_window
+        )
+        return batch.id
+
+    def status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        results = {}
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    results[result["custom_id"]] = error_response(result.get("error") or response.get("body"))
+                else:
+                    results[result["custom_id"]] = self.to_message(response["body"])
+        return results
+
+    @staticmethod
+    def to_message(body):
+        choice = body["choices"][0]
+        usage = body.get("usage") or {}
+        return AIMessage(
+            content=choice["message"]["content"] or "",
+            response_metadata={
+                "token_usage": usage, "model_name": body.get("model"),
+                "finish_reason": choice.get("finish_reason"), "logprobs": choice.get("logprobs"),
+            },
+            usage_metadata={
+                "input_tokens": usage.get("prompt_tokens", 0),
+                "output_tokens": usage.get("completion_tokens", 0),
+                "total_tokens": usage.get("total_tokens", 0),
+            }
+        )
+
+
+class AnthropicBatchBackend(BatchBackend):
+
+    terminal_statuses = ("ended",)
+
+    def __init__(self, base_url=None, api_key=None, poll_interval=60, timeout=24 * 3600):
+        """
+        Batch backend using Anthropic's Message Batches API.
+
+        Args:
+            base_url (str): The base url of the API. If None, use Anthropic's.
+            api_key (str): The API key. If None, read from the environment.
+            poll_interval (float): Seconds to wait between polls. Defaults to 60.
+            timeout (float): Seconds to wait for the batch to complete before giving up. Defaults to 24 hours.
+        """
+        super().__init__(poll_interval=poll_interval, timeout=timeout)
+        import anthropic
+        self.client = anthropic.Anthropic(base_url=base_url, api_key=api_key)
+
+    # The bound kwargs supported by the Messages API, and their names in it
+    supported_kwargs = {"stop": "stop_sequences"}
+
+    def build_request(self, custom_id, prompt, model, max_tokens, temperature, bound_kwargs=None):
+        unsupported = [k for k in bound_kwargs or {} if k not in self.supported_kwargs]
+        if unsupported:
+            raise ValueError(f"{unsupported} are not supported in Anthropic batch requests.")
+        system = "\n\n".join(m.content for m in prompt if isinstance(m, SystemMessage))
+        params = {
+            "model": model,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "messages": [
+                {"role": message_role(m), "content": m.content}
+                for m in prompt if not isinstance(m, SystemMessage)
+            ],
+        }
+        if system:
+            params["system"] = system
+        for k, v in (bound_kwargs or {}).items():
+            params[self.supported_kwargs[k]] = v
+        return {"custom_id": custom_id, "params": params}
+
+    def submit(self, requests):
+        return self.client.messages.batches.create(requests=requests).id
+
+    def status(self, batch_id):
+        return self.client.messages.batches.retrieve(batch_id).processing_status
+
+    def results(self, batch_id):
+        results = {}
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                results[entry.custom_id] = self.to_message(entry.result.message)
+            else:
+                results[entry.custom_id] = error_response(entry.result.model_dump(mode="json"))
+        return results
+
+    @staticmethod
+    def to_message(message):
+        return AIMessage(
+            content="".join(block.text for block in message.content if block.type == "text"),
+            response_metadata={
+                "model": message.model, "stop_reason": message.stop_reason,
+                "usage": message.usage.model_dump(mode="json"),
+            },
+            usage_metadata={
+                "input_tokens": message.usage.input_tokens,
+                "output_tokens": message.usage.output_tokens,
+                "total_tokens": message.usage.input_tokens + message.usage.output_tokens,
+            }
+        )
+
+
+def get_batch_backend(model, **kwargs) -> BatchBackend:
+    """
+    Get the default batch backend of a model.
+
+    Args:
+        model (str): The name of the model.
+        **kwargs: Passed to the backend.
+
+    Returns:
+        BatchBackend
+
+    """
+    provider = providers[get_model_provider(model)]
+    if isinstance(provider, OpenAIProvider):
+        # OpenAI compatible providers, e.g. Nebius
+        if provider.base_url is not None:
+            kwargs.setdefault("base_url", provider.base_url)
+        if provider.api_key_env is not None:
+            kwargs.setdefault("api_key", os.environ.get(provider.api_key_env))
+        return OpenAIBatchBackend(**kwargs)
+    elif isinstance(provider, ClaudeProvider):
+        return AnthropicBatchBackend(**kwargs)
+    raise ValueError(f"Batch API is not supported for model {model}.")
@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+import time
+
+from langchain_core.messages import message_to_dict, messages_from_dict
+
+
+class Journal:
+
+    def __init__(self, path, resume=True, fsync_every=64, fsync_interval=1.0):
+        """
+        An append-only JSONL journal of LLM responses, written as soon as each response is received,
+        so an interrupted run can be resumed without invoking the model again for the responses already received.
+        Responses are keyed like ResponseCache (model settings and prompt), one line per response.
+
+        Every line is written to the operating system at once, so a crash of the process loses nothing.
+        Lines are fsynced to disk in batches, every fsync_every lines or fsync_interval seconds,
+        so a crash of the machine loses at most the last batch.
+
+        Only the offset of each key's line is kept in memory: responses are read back from the file when replayed,
+        so the memory of a long run does not grow with its responses.
+
+        Args:
+            path (str): The path to the journal file.
+            resume (bool): Replay the responses of an existing journal file. If False, the file is truncated.
+            fsync_every (int): The number of lines written between two fsyncs. Defaults to 64.
+            fsync_interval (float): The maximum number of seconds between two fsyncs. Defaults to 1.0.
+        """
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.replayed = 0
+        # key -> (offset, length) of its last line
+        self._index = {}
+        self._size = 0
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if resume and os.path.exists(path):
+            self._replay()
+        self._file = open(path, "ab" if resume else "wb")
+        self._reader = None
+
+    def _replay(self):
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                if line.strip():
+                    # The last response of a key wins, e.g. a parse retry
+                    self._index[json.loads(line)["key"]] = (offset, len(line))
+                offset += len(line)
+        # A partially written last line is dropped, and truncated so the next line starts cleanly
+        if offset < os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+        self._size = offset
+        self.replayed = len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key):
+        """
+        Get the journaled response of a key, read from the journal file.
+
+        Returns:
+            LangChain's Response, or None if the key is not in the journal.
+
+        """
+        with self._lock:
+            if key not in self._index:
+                return None
+            offset, length = self._index[key]
+            if self._reader is None:
+                self._reader = open(self.path, "rb")
+            self._reader.seek(offset)
+            line = self._reader.read(length)
+        return messages_from_dict([json.loads(line)["response"]])[0]
+
+    def append(self, key, response):
+        """
+        Append a response to the journal.
+        """
+        line = (json.dumps({"key": key, "response": message_to_dict(response)}) + "\n").encode("utf-8")
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._index[key] = (self._size, len(line))
+            self._size += len(line)
+            self._pending += 1
+            if self._pending >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def sync(self):
+        """
+        Flush the journal to disk.
+        """
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        if self._file.closed:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def get_journal(journal):
+    """
+    Get a Journal. A path is opened once per process, resuming from its existing responses,
+    and shared by every LLMClient using it.
+
+    Args:
+        journal (Journal|str|None): A Journal, or the path to its JSONL file.
+
+    Returns:
+        Journal or None
+
+    """
+    if journal is None or isinstance(journal, Journal):
+        return journal
+    path = os.path.abspath(journal)
+    with _journals_lock:
+        if path not in _journals or _journals[path]._file.closed:
+            _journals[path] = Journal(path)
+        return _journals[path]
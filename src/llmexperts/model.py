@@ -1,22 +1,167 @@
+import asyncio
+import hashlib
+import json
 import os
+import sqlite3
+import threading
 import time
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
 
-import anthropic
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, BaseMessage, message_to_dict, messages_from_dict
 
-from langchain_anthropic import ChatAnthropic
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_openai import ChatOpenAI
-from langchain.schema import AIMessage, HumanMessage, SystemMessage, BaseMessage
+from .batch import get_batch_backend
+from .journal import get_journal
+from .providers import providers, get_model_provider, get_chat_model
+from .ratelimit import (
+    get_rate_limiter, get_concurrency_controller, estimate_prompt_tokens, response_tokens, retry_after_seconds
+)
 
-from . import openai_model_list, claude_model_list, gemini_model_list, per_minute_token_limit, open_model_list
+
+class ResponseCache:
+
+    def __init__(self, path, max_entries=None, ttl=None):
+        """
+        A persistent content-addressed cache of LLM responses backed by SQLite.
+        Responses are keyed by a hash of the model settings and the prompt, so identical requests are only sent once.
+
+        Args:
+            path (str): The path to the SQLite database file.
+            max_entries (int): The maximum number of responses to keep. The least recently used are evicted first. None for no limit.
+            ttl (float): The number of seconds a response is kept. None to keep responses forever.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, response TEXT, created_at REAL, accessed_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    @staticmethod
+    def make_key(model, temperature, max_tokens, bound_kwargs, prompt):
+        """
+        Hash of the model settings and the prompt.
+
+        Args:
+            model (str): The name of the model.
+            temperature (float): The temperature.
+            max_tokens (int): The maximum number of tokens.
+            bound_kwargs (dict): Extra kwargs bound to the model.
+            prompt: A str, a Message or a list of Messages.
+
+        Returns:
+            str
+
+        """
+        if isinstance(prompt, BaseMessage):
+            prompt = [prompt]
+        if not isinstance(prompt, str):
+            prompt = [message_to_dict(m) for m in prompt]
+        content = json.dumps(
+            [model, temperature, max_tokens, bound_kwargs, prompt], sort_keys=True, default=str
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Get a cached response.
+
+        Returns:
+            LangChain's Response, or None if the key is not cached or has expired.
+
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and row[1] < now - self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return messages_from_dict([json.loads(row[0])])[0]
+
+    def set(self, key, response):
+        """
+        Cache a response, evicting expired and least recently used responses if needed.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(message_to_dict(response)), now, now)
+            )
+            if self.ttl is not None:
+                self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+            if self.max_entries is not None:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self._conn.close()
+
+
+_response_caches = {}
+_response_caches_lock = threading.Lock()
+
+
+def get_response_cache(cache):
+    """
+    Get a ResponseCache. A path is opened once per process and shared by every LLMClient using it.
+
+    Args:
+        cache (ResponseCache|str|None): A ResponseCache, or the path to its SQLite database file.
+
+    Returns:
+        ResponseCache or None
+
+    """
+    if cache is None or isinstance(cache, ResponseCache):
+        return cache
+    path = os.path.abspath(cache)
+    with _response_caches_lock:
+        if path not in _response_caches:
+            _response_caches[path] = ResponseCache(path)
+        return _response_caches[path]
+
+
+def response_cache_read_tokens(response):
+    """
+    The number of input tokens read from the provider's prompt cache, 0 if none or not reported.
+    """
+    usage_metadata = getattr(response, "usage_metadata", None) or {}
+    return (usage_metadata.get("input_token_details") or {}).get("cache_read") or 0
 
 
 class LLMClient:
 
     def __init__(
             self, model, max_tokens,
-            temperature=0, max_retries=2, probabilities=False
+            temperature=0, max_retries=2, probabilities=False, cache=None, prompt_cache=False, journal=None,
+            overload_retries=3, choices=None, top_logprobs=None, adaptive_concurrency=False
     ):
         """
         A Wrapper class for various LangChain LLM clients.
@@ -26,50 +171,251 @@ class LLMClient:
             max_tokens (int): The maximum number of tokens.
             temperature (float): The temperature to use.
             max_retries (int): The number of times to retry invoking the model. Defaults to 7, which should be enough
-            probabilities: Whether to include token probabilities in the response. Defaults to False. Only works with OpenAI models.
+            probabilities: Whether to include token probabilities in the response. Defaults to False.
+                Only works with OpenAI compatible models, including the open models served by Nebius.
+            cache (ResponseCache|str): A response cache, or the path to its SQLite database file. Cached responses are returned without invoking the model.
+            prompt_cache (bool): Mark every message but the last as a cacheable prefix for the provider's prompt cache.
+                Only Anthropic needs explicit markers (cache_control), OpenAI caches long prefixes automatically.
+            journal (Journal|str): A journal, or the path to its JSONL file. Responses are appended as they are received,
+                and responses already in the journal are replayed without invoking the model, to resume a run.
+            overload_retries (int): The number of times a request is retried when the provider is overloaded
+                (rate limit or timeout, after the SDK's own retries), once the pause of the provider is over,
+                see ratelimit.ConcurrencyController. Defaults to 3.
+            adaptive_concurrency (bool): Limit the requests in flight to the provider with its adaptive limit,
+                for concurrency="auto". Otherwise the caller's concurrency applies as is, and only the pauses of
+                the provider do. The controller then also owns the retries: the SDK does not retry (max_retries=0),
+                so every rate limit reaches the controller, and overload errors are retried up to
+                max(overload_retries, max_retries) times after pausing the provider.
+            choices (list[str]): Constrain the response to one of these short answers, e.g. scores: max_tokens is
+                lowered to the provider's minimum, with stop sequences and, for OpenAI models, a logit bias
+                allowing only the tokens of the choices. See Provider.choice_decoding.
+            top_logprobs (int): Include the logprobs of the top_logprobs most likely tokens at each position
+                of the response, implies probabilities. Only works with OpenAI compatible models.
         """
         self.model = model
-        if model in openai_model_list:
-            self.llm = ChatOpenAI(temperature=temperature, max_tokens=max_tokens, model_name=model, max_retries=max_retries)
-        elif model in claude_model_list:
-            self.llm = ChatAnthropic(temperature=temperature, max_tokens=max_tokens, model_name=model, max_retries=max_retries)
-        elif model in gemini_model_list:
-            self.llm = ChatGoogleGenerativeAI(temperature=temperature, max_tokens=max_tokens, model=model, max_retries=max_retries)
-        elif model in open_model_list:
-            self.llm = ChatOpenAI(
-                openai_api_base="https://api.studio.nebius.com/v1/",
-                openai_api_key=os.environ.get("NEBIUS_API_KEY"),
-                temperature=temperature, max_tokens=max_tokens, model_name=model, max_retries=max_retries
-            )
-        else:
-            raise Exception(
-                f"You've selected a model that is not available {model}.\nPlease select from the following models: {openai_model_list + claude_model_list + gemini_model_list}"
-            )
+        self.bound_kwargs = {}
+        self.temperature = temperature
+        provider = get_model_provider(model)
+        self.choices = choices
+        choice_kwargs = {}
+        if choices is not None:
+            max_tokens, choice_kwargs = providers[provider].choice_decoding(model, choices)
+        if adaptive_concurrency:
+            # Retries of the SDK would absorb the rate limits and their Retry-After before the controller sees them
+            overload_retries = max(overload_retries, max_retries)
+            max_retries = 0
+        # The chat model is shared with every client of the same settings, see providers.get_chat_model
+        self._chat_model_args = dict(temperature=temperature, max_tokens=max_tokens, max_retries=max_retries)
+        self._llm = None
+        if choice_kwargs:
+            self.bind(**choice_kwargs)
+        self.overload_errors = providers[provider].overload_errors()
+        self.overload_retries = overload_retries
+        # Shared by every client of this provider in the process
+        self.concurrency_controller = get_concurrency_controller(provider)
+        self.adaptive_concurrency = adaptive_concurrency
 
-        # logprobs are only available for OpenAI models
-        if probabilities and (model in openai_model_list):
-            self.llm = self.llm.bind(logprobs=True)
-        elif probabilities:
+        # logprobs are only available for OpenAI compatible models
+        if (probabilities or top_logprobs) and providers[provider].logprobs:
+            self.bind(logprobs=True)
+            if top_logprobs:
+                self.bind(top_logprobs=top_logprobs)
+        elif probabilities or top_logprobs:
             print(
-                f"Probabilities are not available for model {model}, please select a model from the following list: {openai_model_list}")
+                f"Probabilities are not available for model {model}, please select a model from the following providers: "
+                f"{[name for name, p in providers.items() if p.logprobs]}")
+
+        self.max_tokens = max_tokens
+        # Shared by every client of this model in the process
+        self.rate_limiter = get_rate_limiter(model)
+        self.token_limit = self.rate_limiter.token_limit
+        self.cache = get_response_cache(cache)
+        self.prompt_cache = prompt_cache
+        self.journal = get_journal(journal)
+
+    @property
+    def llm(self):
+        """
+        The LangChain chat model with the bound kwargs. It is made on first use, so dry runs do not need API keys.
+        """
+        if self._llm is None:
+            llm = get_chat_model(self.model, **self._chat_model_args)
+            self._llm = llm.bind(**self.bound_kwargs) if self.bound_kwargs else llm
+        return self._llm
 
-        self.tokens_used = 0
-        self.token_limit = per_minute_token_limit.get(model, 800000)
-        self.start_time = time.time()
+    @llm.setter
+    def llm(self, llm):
+        self._llm = llm
 
     def bind(self, **kwargs):
-        self.llm = self.llm.bind(**kwargs)
+        if self._llm is not None:
+            self._llm = self._llm.bind(**kwargs)
+        self.bound_kwargs.update(kwargs)
+
+    def cache_key(self, prompt):
+        return ResponseCache.make_key(self.model, self.temperature, self.max_tokens, self.bound_kwargs, prompt)
+
+    def cache_get(self, prompt):
+        """
+        Read-through: the cached response of the prompt, or None.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.get(self.cache_key(prompt))
+
+    def cache_set(self, prompt, response):
+        """
+        Write-through: cache the response of the prompt. Responses of failed batch requests are not cached.
+        """
+        if self.cache is None or "batch_error" in response.response_metadata:
+            return
+        self.cache.set(self.cache_key(prompt), response)
+
+    def journal_get(self, prompt):
+        """
+        The journaled response of the prompt, or None.
+        """
+        if self.journal is None:
+            return None
+        return self.journal.get(self.cache_key(prompt))
+
+    def journal_append(self, prompt, response):
+        """
+        Append the response of the prompt to the journal.
+        """
+        if self.journal is None or "batch_error" in response.response_metadata:
+            return
+        self.journal.append(self.cache_key(prompt), response)
+
+    def mark_prompt_cache(self, prompt):
+        """
+        Add the provider's prompt cache markers to a prompt, if prompt_cache is enabled.
+        The prefix ends at the message before the last one, so prompts differing only in their last message share it.
+
+        Args:
+            prompt: A list of Messages.
+
+        Returns:
+            The prompt to send. The original prompt is not modified, so cache keys do not depend on the markers.
+
+        """
+        if not self.prompt_cache or get_model_provider(self.model) != "claude" or not isinstance(prompt, list) or len(prompt) < 2:
+            return prompt
+        prefix_end = prompt[-2]
+        content = prefix_end.content
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        content = [*content[:-1], {**content[-1], "cache_control": {"type": "ephemeral"}}]
+        return [*prompt[:-2], prefix_end.model_copy(update={"content": content}), prompt[-1]]
+
+    def _estimate_tokens(self, prompt):
+        # Output tokens count against the limit too, so reserve max_tokens for them.
+        return estimate_prompt_tokens(prompt) + int(self.max_tokens or 0)
 
     def wait_for_per_minute_limit(self, prompt):
-        char_length = reduce(lambda x, y: len(x.content) + len(y.content), prompt)
-        if self.tokens_used + char_length / 4 > self.token_limit:
-            elapsed_time = time.time() - self.start_time
-            time_to_wait = 60 - elapsed_time
-            if time_to_wait > 0:
-                print(f'Waiting for {time_to_wait:.0f} seconds to avoid token limit. Tokens used: {self.tokens_used}')
-                time.sleep(time_to_wait)
-            self.tokens_used = 0
-            self.start_time = time.time()
+        """
+        Block until the prompt fits in the per-minute budget of the model, and reserve it.
+
+        Args:
+            prompt: A list of Messages.
+
+        Returns:
+            The Reservation, to be settled with the real usage once the response arrives.
+
+        """
+        reservation, wait = self.rate_limiter.try_reserve(self._estimate_tokens(prompt))
+        if reservation is None:
+            print(f'Waiting for {wait:.0f} seconds to avoid token limit. Tokens used: {self.rate_limiter.tokens_used}')
+            reservation = self.rate_limiter.acquire(self._estimate_tokens(prompt))
+        return reservation
+
+    async def await_for_per_minute_limit(self, prompt):
+        """
+        Async counterpart of wait_for_per_minute_limit, which does not block the event loop while waiting.
+        """
+        reservation, wait = self.rate_limiter.try_reserve(self._estimate_tokens(prompt))
+        if reservation is None:
+            print(f'Waiting for {wait:.0f} seconds to avoid token limit. Tokens used: {self.rate_limiter.tokens_used}')
+            reservation = await self.rate_limiter.aacquire(self._estimate_tokens(prompt))
+        return reservation
+
+    def settle_per_minute_limit(self, reservation, response):
+        """
+        Settle a reservation against the usage reported in the response.
+        The estimate is kept if the provider does not report usage.
+        """
+        tokens = response_tokens(response)
+        if tokens is not None:
+            self.rate_limiter.settle(reservation, tokens)
+
+    def max_in_flight(self, concurrency):
+        """
+        The number of requests to keep in flight for a concurrency argument: the maximum of the adaptive limit
+        of the provider for "auto", else the argument itself. The adaptive limit only applies to clients with
+        adaptive_concurrency, which "auto" requires.
+        """
+        if concurrency == "auto":
+            if not self.adaptive_concurrency:
+                raise ValueError('concurrency="auto" requires a client created with adaptive_concurrency=True.')
+            return self.concurrency_controller.max_limit
+        return concurrency
+
+    def _overloaded(self, error, attempt):
+        """
+        Report an overload error to the concurrency controller. Returns whether the request should be retried.
+        """
+        retry_after = retry_after_seconds(error)
+        # Without a hint, pause the provider with an exponential backoff
+        self.concurrency_controller.release_overloaded(
+            retry_after if retry_after is not None else min(60, 2 ** attempt)
+        )
+        if attempt >= self.overload_retries:
+            return False
+        print(f"{self.model} is overloaded ({type(error).__name__}). Retrying when the provider is available.")
+        return True
+
+    def _invoke_llm(self, prompt):
+        """
+        Invoke the chat model once the provider is available, within its adaptive limit if adaptive_concurrency,
+        retrying overload errors.
+        """
+        attempt = 0
+        while True:
+            self.concurrency_controller.acquire(self.adaptive_concurrency)
+            start = time.monotonic()
+            try:
+                response = self.llm.invoke(self.mark_prompt_cache(prompt))
+            except self.overload_errors as e:
+                if not self._overloaded(e, attempt):
+                    raise
+                attempt += 1
+                continue
+            except BaseException:
+                self.concurrency_controller.release_error()
+                raise
+            self.concurrency_controller.release(time.monotonic() - start)
+            return response
+
+    async def _ainvoke_llm(self, prompt):
+        """
+        Async counterpart of _invoke_llm, which does not block the event loop while waiting.
+        """
+        attempt = 0
+        while True:
+            await self.concurrency_controller.aacquire(self.adaptive_concurrency)
+            start = time.monotonic()
+            try:
+                response = await self.llm.ainvoke(self.mark_prompt_cache(prompt))
+            except self.overload_errors as e:
+                if not self._overloaded(e, attempt):
+                    raise
+                attempt += 1
+                continue
+            except BaseException:
+                self.concurrency_controller.release_error()
+                raise
+            self.concurrency_controller.release(time.monotonic() - start)
+            return response
 
     def mock_response(self, prompt, max_chars=2000, prefix="MOCK CONTENT", response_content=None):
 
@@ -96,7 +442,7 @@ class LLMClient:
         )
         return mock
 
-    def invoke(self, prompt, dry_run=False, dry_run_res=None):
+    def invoke(self, prompt, dry_run=False, dry_run_res=None, refresh_cache=False):
         """
         Invoke the LangChain LLM client.
 
@@ -105,6 +451,7 @@ class LLMClient:
             dry_run (bool|str): Do not invoke the LLMs. Return a mock response instead. For testing purposes.
                 If a str is given, prefix this str to the response.
             dry_run_res (str): Content to use for the dry run mock response.
+            refresh_cache (bool): Invoke the model even if the response is cached or journaled, and cache the new response.
 
         Returns:
             LangChain's Response.
@@ -113,25 +460,28 @@ class LLMClient:
         if isinstance(dry_run, str) or dry_run == True:
             prefix = dry_run if isinstance(dry_run, str) else ""
             return self.mock_response(prompt, prefix=prefix, response_content=dry_run_res)
-        self.wait_for_per_minute_limit(prompt)
-        try:
-            response = self.llm.invoke(prompt)
-        except anthropic.RateLimitError:
-            print("Anthropic rate limit exceeded. Waiting for 1 minute ...")
-            time.sleep(60)
-            print("Retry Anthropic invoke.")
-            response = self.llm.invoke(prompt)
+        cached = None if refresh_cache else (self.journal_get(prompt) or self.cache_get(prompt))
+        if cached is not None:
+            return cached
+        reservation = self.wait_for_per_minute_limit(prompt)
         try:
-            self.tokens_used += response.response_metadata['token_usage']['prompt_tokens']
-        except:
-            pass
+            response = self._invoke_llm(prompt)
+        except BaseException:
+            # A failed request still counts as a request, but not its estimated tokens
+            self.rate_limiter.settle(reservation, 0)
+            raise
+        self.settle_per_minute_limit(reservation, response)
+        self.cache_set(prompt, response)
+        self.journal_append(prompt, response)
         return response
 
-    def batch(self, prompt_batch, dry_run=False, dry_run_res=None):
+    def batch(self, prompt_batch, concurrency=None, dry_run=False, dry_run_res=None):
         """
-        Invoke LLMs using LangChain's batch method.
+        Invoke LLMs concurrently in a thread pool. Each request goes through the shared per-minute limit.
         Args:
             prompt_batch: A batch of list of Messages.
+            concurrency (int|str): The maximum number of requests in flight. If None, use the default thread pool size.
+                "auto": as many as the adaptive limit of the provider allows, see ratelimit.ConcurrencyController.
             dry_run (bool|str): Do not invoke the LLMs. Return a mock response instead. For testing purposes.
                 If a str is given, prefix this str to the response.
             dry_run_res (str): Content to use for the dry run mock response.
@@ -144,4 +494,105 @@ class LLMClient:
         if isinstance(dry_run, str) or dry_run==True:
             prefix = dry_run if isinstance(dry_run, str) else ""
             return [self.mock_response(p, prefix=prefix, response_content=dry_run_res) for p in prompt_batch]
-        return self.llm.batch(prompt_batch)
+        with ThreadPoolExecutor(max_workers=self.max_in_flight(concurrency)) as executor:
+            return list(executor.map(self.invoke, prompt_batch))
+
+    async def ainvoke(self, prompt, dry_run=False, dry_run_res=None, refresh_cache=False):
+        """
+        Invoke the LangChain LLM client asynchronously.
+
+        Args:
+            prompt: A list of Messages. Could be HumanMessage, SystemMessage or AI Message.
+            dry_run (bool|str): Do not invoke the LLMs. Return a mock response instead. For testing purposes.
+                If a str is given, prefix this str to the response.
+            dry_run_res (str): Content to use for the dry run mock response.
+            refresh_cache (bool): Invoke the model even if the response is cached or journaled, and cache the new response.
+
+        Returns:
+            LangChain's Response.
+
+        """
+        if isinstance(dry_run, str) or dry_run == True:
+            prefix = dry_run if isinstance(dry_run, str) else ""
+            return self.mock_response(prompt, prefix=prefix, response_content=dry_run_res)
+        cached = None if refresh_cache else (self.journal_get(prompt) or self.cache_get(prompt))
+        if cached is not None:
+            return cached
+        reservation = await self.await_for_per_minute_limit(prompt)
+        try:
+            response = await self._ainvoke_llm(prompt)
+        except BaseException:
+            # A failed request still counts as a request, but not its estimated tokens
+            self.rate_limiter.settle(reservation, 0)
+            raise
+        self.settle_per_minute_limit(reservation, response)
+        self.cache_set(prompt, response)
+        self.journal_append(prompt, response)
+        return response
+
+    async def abatch(self, prompt_batch, concurrency=None, dry_run=False, dry_run_res=None, refresh_cache=False,
+                     return_exceptions=False):
+        """
+        Invoke LLMs asynchronously, keeping at most `concurrency` requests in flight.
+        A new request is started as soon as any running one finishes, instead of waiting for a whole group.
+
+        Args:
+            prompt_batch: A batch of list of Messages.
+            concurrency (int|str): The maximum number of requests in flight. If None, all requests are sent at once.
+                "auto": as many as the adaptive limit of the provider allows, see ratelimit.ConcurrencyController.
+            dry_run (bool|str): Do not invoke the LLMs. Return a mock response instead. For testing purposes.
+                If a str is given, prefix this str to the response.
+            dry_run_res (str): Content to use for the dry run mock response.
+            refresh_cache (bool): Invoke the model even if the responses are cached or journaled, and cache the new responses.
+            return_exceptions (bool): Return the exception of a failed request in place of its response,
+                instead of raising it.
+
+        Returns:
+            A list of LangChain's Responses, in the same order as prompt_batch.
+
+        """
+        concurrency = self.max_in_flight(concurrency)
+        semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+
+        async def _ainvoke(prompt):
+            if semaphore is None:
+                return await self.ainvoke(prompt, dry_run=dry_run, dry_run_res=dry_run_res, refresh_cache=refresh_cache)
+            async with semaphore:
+                return await self.ainvoke(prompt, dry_run=dry_run, dry_run_res=dry_run_res, refresh_cache=refresh_cache)
+
+        # gather keeps the results in the order of the prompts, whatever order they finish in.
+        return list(await asyncio.gather(*[_ainvoke(p) for p in prompt_batch], return_exceptions=return_exceptions))
+
+    def offline_batch(self, prompt_batch, backend=None, dry_run=False, dry_run_res=None):
+        """
+        Invoke LLMs through the provider's offline batch API, which is not subject to the per-minute limits.
+        Blocks until the batch job has finished.
+
+        Args:
+            prompt_batch: A batch of list of Messages.
+            backend (BatchBackend): The batch backend to use. If None, use the default backend of the model.
+            dry_run (bool|str): Do not invoke the LLMs. Return a mock response instead. For testing purposes.
+                If a str is given, prefix this str to the response.
+            dry_run_res (str): Content to use for the dry run mock response.
+
+        Returns:
+            A list of LangChain's Responses, in the same order as prompt_batch.
+
+        """
+        if isinstance(dry_run, str) or dry_run == True:
+            prefix = dry_run if isinstance(dry_run, str) else ""
+            return [self.mock_response(p, prefix=prefix, response_content=dry_run_res) for p in prompt_batch]
+        responses = [self.journal_get(p) or self.cache_get(p) for p in prompt_batch]
+        missing = [i for i, r in enumerate(responses) if r is None]
+        if len(missing) > 0:
+            if backend is None:
+                backend = get_batch_backend(self.model)
+            batch_responses = backend.run(
+                [prompt_batch[i] for i in missing], self.model, self.max_tokens, temperature=self.temperature,
+                bound_kwargs=self.bound_kwargs
+            )
+            for i, response in zip(missing, batch_responses):
+                self.cache_set(prompt_batch[i], response)
+                self.journal_append(prompt_batch[i], response)
+                responses[i] = response
+        return responses
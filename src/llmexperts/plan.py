@@ -0,0 +1,181 @@
+import glob
+import os
+
+import pandas as pd
+
+from . import per_minute_token_limit, per_minute_request_limit
+from .prompts import ScalePromptTemplate, SummarizePromptTemplate
+from .ratelimit import model_limit
+from .summarize import split_text, group_summaries
+from .utils import get_token_counter
+
+
+def count_prompt_tokens(prompt, count_tokens):
+    """
+    Count the tokens of a prompt with the token counter of a model.
+
+    Args:
+        prompt: A list of Messages.
+        count_tokens: A function taking a str and returning its number of tokens, see utils.get_token_counter.
+
+    Returns:
+        int
+
+    """
+    return sum(count_tokens(m.content) for m in prompt)
+
+
+def projected_minutes(model, input_tokens, output_tokens, requests, concurrency=None, seconds_per_request=None):
+    """
+    Project the wall time of a run of a model under its per minute limits.
+    The rate limiter reserves max_tokens for every response, so output_tokens should be the maximum.
+
+    Args:
+        model (str): The name of the model.
+        input_tokens (int): The total number of input tokens.
+        output_tokens (int): The total number of output tokens.
+        requests (int): The number of requests.
+        concurrency (int): The number of concurrent requests. Only used with seconds_per_request.
+        seconds_per_request (float): The latency of a single request. If None, latency is not projected.
+
+    Returns:
+        float: The projected minutes, bound by the slowest of tokens, requests and latency.
+
+    """
+    minutes = (input_tokens + output_tokens) / model_limit(per_minute_token_limit, model, 800000)
+    request_limit = model_limit(per_minute_request_limit, model)
+    if request_limit:
+        minutes = max(minutes, requests / request_limit)
+    if seconds_per_request is not None:
+        minutes = max(minutes, requests * seconds_per_request / (concurrency or 1) / 60)
+    return minutes
+
+
+def make_plan(rows, concurrency=None, seconds_per_request=None):
+    """
+    Build the plan DataFrame of a list of per model usage dicts (model, requests, input_tokens, output_tokens).
+    """
+    df = pd.DataFrame(rows, columns=["model", "requests", "input_tokens", "output_tokens"])
+    df["total_tokens"] = df["input_tokens"] + df["output_tokens"]
+    df["token_limit"] = [model_limit(per_minute_token_limit, m, 800000) for m in df["model"]]
+    df["projected_minutes"] = [
+        projected_minutes(
+            r.model, r.input_tokens, r.output_tokens, r.requests,
+            concurrency=concurrency, seconds_per_request=seconds_per_request
+        ) for r in df.itertuples()
+    ]
+    return df
+
+
+def plan_scale(
+        paths, model_list, issue_list, prompt_template: ScalePromptTemplate | os.PathLike,
+        use_examples=False, override_personas=None, override_encouragements=None, max_tokens=150,
+        concurrency=3, seconds_per_request=None
+):
+    """
+    Plan the tokens, requests and wall time of scaling files, without invoking any LLM.
+    Prompts are built with ScalePromptTemplate.build_prompt exactly as scale_file and scale_corpus build them.
+    Parse retries are not counted.
+
+    Args:
+        paths (str|list[str]): A path, a glob pattern or a list of paths of the files to be scaled.
+        model_list (list): A list of model names to use for scale.
+        issue_list (list): A list of issue areas to scale.
+        prompt_template (ScalePromptTemplate|os.PathLike): A ScalePromptTemplate instance or a filepath to the prompt file.
+        use_examples (bool): Whether to add examples to the prompts. Defaults to False.
+        override_personas (int|list[int]): An index or a list of indices of personas to use.
+        override_encouragements (int|list[int]): An index or a list of indices of encouragements to use.
+        max_tokens (int): The max_tokens of a scale response. Defaults to 150, as in scale_file.
+        concurrency (int): The number of concurrent requests. Defaults to 3.
+        seconds_per_request (float): The latency of a single request, to project the time bound by concurrency.
+
+    Returns:
+        DataFrame: One row per model with the requests, input_tokens, output_tokens (maximum), total_tokens,
+            token_limit (per minute) and projected_minutes.
+
+    """
+    if isinstance(paths, (str, os.PathLike)):
+        paths = sorted(glob.glob(str(paths)))
+    if not isinstance(prompt_template, ScalePromptTemplate):
+        prompt_template = ScalePromptTemplate.from_file(prompt_template)
+
+    counters = {model: get_token_counter(model) for model in model_list}
+    usage = {model: {"model": model, "requests": 0, "input_tokens": 0, "output_tokens": 0} for model in model_list}
+    for filepath in paths:
+        with open(filepath, "r", encoding="utf-8") as file:
+            text = file.read()
+        for issue in issue_list:
+            prompts = prompt_template.build_prompt(
+                text, issue, use_examples=use_examples,
+                override_persona_to_use=override_personas, override_encouragement_to_use=override_encouragements
+            )
+            for model in model_list:
+                usage[model]["requests"] += len(prompts)
+                usage[model]["input_tokens"] += sum(count_prompt_tokens(p.prompt, counters[model]) for p in prompts)
+                usage[model]["output_tokens"] += len(prompts) * max_tokens
+
+    return make_plan(list(usage.values()), concurrency=concurrency, seconds_per_request=seconds_per_request)
+
+
+def plan_summarize(
+        paths, prompt_template: SummarizePromptTemplate | os.PathLike, issues_to_summarize, model_list,
+        chunk_size=100000, overlap=2500, min_size=500, max_size=1000, max_tokens_factor=1.0,
+        chunk_unit="chars", reduce="concat", reduce_token_budget=20000, concurrency=3, seconds_per_request=None
+):
+    """
+    Plan the tokens, requests and wall time of summarizing files, without invoking any LLM.
+    Texts are chunked and prompts built exactly as summarize_file does. Summaries are assumed to use all
+    their max_tokens, so the reduce steps are an upper bound.
+
+    Args:
+        paths (str|list[str]): A path, a glob pattern or a list of paths of the files to be summarized.
+        prompt_template (SummarizePromptTemplate|PathLike): A SummarizePrompt instance or a filepath to the prompt file.
+        issues_to_summarize (list): The issues to be summarized.
+        model_list (list): A list of model names to use for summarization.
+        chunk_size, overlap, min_size, max_size, max_tokens_factor, chunk_unit, reduce, reduce_token_budget:
+            See summarize_file.
+        concurrency (int): The number of concurrent requests. Defaults to 3.
+        seconds_per_request (float): The latency of a single request, to project the time bound by concurrency.
+
+    Returns:
+        DataFrame: One row per model with the requests, input_tokens, output_tokens (maximum), total_tokens,
+            token_limit (per minute) and projected_minutes.
+
+    """
+    if isinstance(paths, (str, os.PathLike)):
+        paths = sorted(glob.glob(str(paths)))
+    if not isinstance(prompt_template, SummarizePromptTemplate):
+        prompt_template = SummarizePromptTemplate.from_file(prompt_template)
+    if isinstance(issues_to_summarize, str):
+        issues_to_summarize = [issues_to_summarize]
+
+    max_tokens = int(max_size * max_tokens_factor)
+    instructions = prompt_template.build_prompt("", issues_to_summarize, min_size=min_size, max_size=max_size)
+    rows = []
+    for model in model_list:
+        count_tokens = get_token_counter(model)
+        instruction_tokens = count_prompt_tokens(instructions, count_tokens)
+        row = {"model": model, "requests": 0, "input_tokens": 0, "output_tokens": 0}
+        for filepath in paths:
+            with open(filepath, "r", encoding="utf-8") as file:
+                text = file.read()
+            chunks = split_text(
+                text, prompt_template, model, issues_to_summarize, chunk_size=chunk_size, overlap=overlap,
+                chunk_unit=chunk_unit, max_tokens=max_tokens, min_size=min_size, max_size=max_size
+            )
+            row["requests"] += len(chunks)
+            row["input_tokens"] += sum(count_tokens(c) for c in chunks) + len(chunks) * instruction_tokens
+            row["output_tokens"] += len(chunks) * max_tokens
+
+            # Each reduce prompt combines summaries of at most max_tokens
+            level = [max_tokens] * len(chunks)
+            while len(level) > 1:
+                groups = group_summaries(level, reduce_token_budget) if reduce == "tree" else [list(range(len(level)))]
+                merge_groups = [g for g in groups if len(g) > 1]
+                row["requests"] += len(merge_groups)
+                row["input_tokens"] += sum(sum(level[i] for i in g) + instruction_tokens for g in merge_groups)
+                row["output_tokens"] += len(merge_groups) * max_tokens
+                level = [max_tokens if len(g) > 1 else level[g[0]] for g in groups]
+        rows.append(row)
+
+    return make_plan(rows, concurrency=concurrency, seconds_per_request=seconds_per_request)
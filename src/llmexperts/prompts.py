@@ -1,15 +1,18 @@
 import abc
+import hashlib
+import json
 import os
-from collections import namedtuple
-from langchain.prompts import PromptTemplate
-from langchain.schema import HumanMessage, SystemMessage, AIMessage, BaseMessage
+from langchain_core.prompts import PromptTemplate
+from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, BaseMessage, message_to_dict, messages_from_dict
 from .utils import yml_to_dict, json_to_dict
 
 class LLMExpertPromptTemplate:
 
     def __init__(self, system_template_string, human_template_string):
         """
-        Prompt template
+        Prompt template. Messages are formatted with str.format, which is equivalent to PromptTemplate.format
+        for these f-string templates but skips its validation on every call.
+        Templates cache the messages they build, so create a new template instead of modifying one.
 
         Args:
             system_template_string: Template string to build system message
@@ -57,6 +60,8 @@ class SummarizePromptTemplate(LLMExpertPromptTemplate):
         """
         super().__init__(system_template_string, human_template_string)
         self.issue_areas = issue_areas
+        self._issue_list_strings = {}
+        self._system_messages = {}
 
     def build_prompt(self, text, issues_to_summarize, min_size=500, max_size=1000):
         """
@@ -73,30 +78,134 @@ class SummarizePromptTemplate(LLMExpertPromptTemplate):
 
         """
 
-        issue_area_dict = {issue: self.issue_areas[issue] for issue in issues_to_summarize}
-        issue_area_descriptions = [f"{issue}: {description}" for issue, description in issue_area_dict.items()]
-        issue_list_string = "\n".join([f"{i + 1}. {area}" for i, area in enumerate(issue_area_descriptions)])
-
         return [
-            SystemMessage(
-                content=self.system_template.format(
-                    issue_areas=issue_list_string,
-                    min_size=min_size,
-                    max_size=max_size
-                )),
-            HumanMessage(
-                content=self.human_template.format(text=text)
-            )
+            self.system_message(issues_to_summarize, min_size=min_size, max_size=max_size),
+            HumanMessage(content=self.human_template_string.format(text=text))
         ]
 
-ScalePrompt = namedtuple("ScalePrompt", ["prompt", "persona", "encouragement", "persona_idx", "encouragement_idx"])
+    def issue_list_string(self, issues_to_summarize):
+        """
+        The numbered list of the definitions of the issues, cached per list of issues.
+        """
+        key = tuple(issues_to_summarize)
+        if key not in self._issue_list_strings:
+            issue_area_descriptions = [f"{issue}: {self.issue_areas[issue]}" for issue in issues_to_summarize]
+            self._issue_list_strings[key] = "\n".join(
+                [f"{i + 1}. {area}" for i, area in enumerate(issue_area_descriptions)]
+            )
+        return self._issue_list_strings[key]
+
+    def system_message(self, issues_to_summarize, min_size=500, max_size=1000):
+        """
+        The system message of the issues and sizes, cached as it is the same for every chunk.
+        """
+        key = (tuple(issues_to_summarize), min_size, max_size)
+        if key not in self._system_messages:
+            self._system_messages[key] = SystemMessage(content=self.system_template_string.format(
+                issue_areas=self.issue_list_string(issues_to_summarize), min_size=min_size, max_size=max_size
+            ))
+        return self._system_messages[key]
+
+class SharedMessages:
+    """
+    Messages shared by all the ScalePrompts of a text and issue, e.g. the examples and the text to scale.
+    """
+    __slots__ = ("messages", "_id")
+
+    def __init__(self, messages: list[BaseMessage]):
+        self.messages = tuple(messages)
+        self._id = None
+
+    @property
+    def id(self):
+        """
+        A hash of the content of the messages, identifying them in the logs.
+        """
+        if self._id is None:
+            self._id = hashlib.sha256(self.dumps().encode("utf-8")).hexdigest()[:16]
+        return self._id
+
+    def dumps(self):
+        return json.dumps([message_to_dict(m) for m in self.messages])
+
+
+class ScalePrompt:
+    """
+    A scoring prompt for a persona and an encouragement. Only its own message is stored,
+    the messages shared with the other prompts of the text are referenced, and the full prompt is built when sent.
+    """
+    __slots__ = ("message", "shared", "message_first", "persona", "encouragement", "persona_idx", "encouragement_idx")
+
+    def __init__(
+            self, message: BaseMessage, shared: SharedMessages, persona, encouragement, persona_idx, encouragement_idx,
+            message_first=True
+    ):
+        """
+        Args:
+            message (BaseMessage): The message of this prompt, with the persona and the encouragement.
+            shared (SharedMessages): The messages shared with the other prompts.
+            persona (str): The persona text.
+            encouragement (str): The encouragement text.
+            persona_idx (int): The index of the persona in the template.
+            encouragement_idx (int): The index of the encouragement in the template.
+            message_first (bool): Whether the own message comes before the shared messages, or after them.
+        """
+        self.message = message
+        self.shared = shared
+        self.message_first = message_first
+        self.persona = persona
+        self.encouragement = encouragement
+        self.persona_idx = persona_idx
+        self.encouragement_idx = encouragement_idx
+
+    @property
+    def prompt(self) -> list[BaseMessage]:
+        """
+        The list of Messages to send.
+        """
+        if self.message_first:
+            return [self.message, *self.shared.messages]
+        return [*self.shared.messages, self.message]
+
+    def __eq__(self, other):
+        return isinstance(other, ScalePrompt) and self.to_dict() == other.to_dict() and self.prompt == other.prompt
+
+    def __repr__(self):
+        return f"ScalePrompt(persona_idx={self.persona_idx}, encouragement_idx={self.encouragement_idx}, prompt={self.prompt})"
+
+    def to_dict(self):
+        return {
+            "message": message_to_dict(self.message), "shared_id": self.shared.id, "message_first": self.message_first,
+            "persona": self.persona, "encouragement": self.encouragement,
+            "persona_idx": self.persona_idx, "encouragement_idx": self.encouragement_idx,
+        }
+
+    def dumps(self):
+        """
+        Serialize the prompt without its shared messages, which are serialized once with SharedMessages.dumps.
+        """
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def loads(cls, prompt_json: str, shared_json: str):
+        """
+        Load a prompt serialized with dumps, and its shared messages serialized with SharedMessages.dumps.
+        """
+        prompt_dict = json.loads(prompt_json)
+        shared = SharedMessages(messages_from_dict(json.loads(shared_json)))
+        return cls(
+            messages_from_dict([prompt_dict["message"]])[0], shared, prompt_dict["persona"], prompt_dict["encouragement"],
+            prompt_dict["persona_idx"], prompt_dict["encouragement_idx"], message_first=prompt_dict["message_first"]
+        )
+
 
 class ScalePromptTemplate(LLMExpertPromptTemplate):
 
     def __init__(
             self, system_template_string: str, human_template_string: str,
             policy_scales: dict, personas: list[str], encouragements: list[str],
-            examples: dict[str, list[dict[str, str|int]]]=None, ai_template_string: str = "{score}"
+            examples: dict[str, list[dict[str, str|int]]]=None, ai_template_string: str = "{score}",
+            persona_template_string: str = "{persona} {encouragement}"
     ):
         """
         Prompt template for scoring.
@@ -109,6 +218,8 @@ class ScalePromptTemplate(LLMExpertPromptTemplate):
             encouragements (list[str]): A list of encouragements.
             examples (dict): Examples of policy scales. Used for few-shot scoring. Should be a dictionary where keys are policy names and values are a dict containing a "score" and a "summary" key.
             ai_template_string (str): Template string to build AI message. Used for few-shot scoring.
+            persona_template_string (str): Template string to build the final message with the persona and
+                encouragement in the "prefix" layout.
         """
         super().__init__(system_template_string, human_template_string)
         self.policy_scales = policy_scales
@@ -117,10 +228,59 @@ class ScalePromptTemplate(LLMExpertPromptTemplate):
         self.examples = examples or {}
         self.ai_template_string = ai_template_string
         self.ai_template = PromptTemplate(template=ai_template_string)
+        self.persona_template_string = persona_template_string
+        self._example_messages = {}
+        self._system_messages = {}
+        self._persona_messages = {}
+
+    def example_messages(self, issue_to_scale):
+        """
+        The few-shot (HumanMessage, AIMessage) pairs of an issue, rendered once.
+        """
+        if issue_to_scale not in self._example_messages:
+            example_messages = []
+            for issue_examples in self.examples.get(issue_to_scale, []):
+                summary = issue_examples["summary"]
+                score = issue_examples["score"]
+                example_messages.append(HumanMessage(content=self.human_template_string.format(text=summary)))
+                example_messages.append(AIMessage(content=self.ai_template_string.format(score=f"{score}")))
+            self._example_messages[issue_to_scale] = tuple(example_messages)
+        return self._example_messages[issue_to_scale]
+
+    def system_message(self, issue_to_scale, persona_idx=None, encouragement_idx=None):
+        """
+        The system message of a persona, an encouragement and an issue, rendered once.
+        Without persona and encouragement, the system message of the "prefix" layout.
+        """
+        key = (issue_to_scale, persona_idx, encouragement_idx)
+        if key not in self._system_messages:
+            if persona_idx is None:
+                content = self.system_template_string.format(
+                    persona="", encouragement="", policy_scale=self.policy_scales[issue_to_scale]
+                ).strip()
+            else:
+                content = self.system_template_string.format(
+                    persona=self.personas[persona_idx], encouragement=self.encouragements[encouragement_idx],
+                    policy_scale=self.policy_scales[issue_to_scale]
+                )
+            self._system_messages[key] = SystemMessage(content=content)
+        return self._system_messages[key]
+
+    def persona_message(self, persona_idx, encouragement_idx):
+        """
+        The final persona message of the "prefix" layout, rendered once.
+        """
+        key = (persona_idx, encouragement_idx)
+        if key not in self._persona_messages:
+            self._persona_messages[key] = HumanMessage(content=self.persona_template_string.format(
+                persona=self.personas[persona_idx], encouragement=self.encouragements[encouragement_idx]
+            ))
+        return self._persona_messages[key]
 
     def build_prompt(
             self, text: str, issue_to_scale: str, use_examples:bool=False,
-            override_persona_to_use: int | list[int]=None, override_encouragement_to_use: int | list[int]=None
+            override_persona_to_use: int | list[int]=None, override_encouragement_to_use: int | list[int]=None,
+            layout: str = "standard"
     ) -> list[ScalePrompt]:
 
         """
@@ -132,11 +292,16 @@ class ScalePromptTemplate(LLMExpertPromptTemplate):
             use_examples (boolean): Whether to add examples as few-shot scoring.
             override_persona_to_use (int|list[int]): The persona to use. The index of personas in the template. If None, use all.
             override_encouragement_to_use: (int|list[int]): The encouragement to use. The index of encouragements in the template. If None, use all.
+            layout (str): "standard": the persona and encouragement are in the system message.
+                "prefix": the system message is built without persona and encouragement, which are moved to a final
+                HumanMessage built from persona_template_string. All prompts of a text then share every message
+                but the last, which provider prompt caches can reuse.
 
         Returns:
-            A two-dimensional list of shape (n_persona * n_encouragement, 2 + 2*n_examples).
-            Dim 0 is the combinations of persona and encouragement.
-            Dim 1 is prompts for each combination containing a System message and a HumanMessage. Plus many (HumanMessage, AI message) pairs in between.
+            A list of n_persona * n_encouragement ScalePrompts, one for each combination of persona and encouragement.
+            The prompt of each contains a System message and a HumanMessage. Plus many (HumanMessage, AI message) pairs in between.
+            The "prefix" layout adds the final persona HumanMessage.
+            The examples and the text are shared by all ScalePrompts instead of being copied.
 
         """
 
@@ -149,28 +314,25 @@ class ScalePromptTemplate(LLMExpertPromptTemplate):
         if type(override_encouragement_to_use) is int:
             override_encouragement_to_use = [override_encouragement_to_use]
 
-        example_messages = []
-        if use_examples:
-            for issue_examples in self.examples.get(issue_to_scale, []):
-                summary = issue_examples["summary"]
-                score = issue_examples["score"]
-                example_messages.append(HumanMessage(content=self.human_template.format(text=summary)))
-                example_messages.append(AIMessage(content=self.ai_template.format(score=f"{score}")))
+        example_messages = self.example_messages(issue_to_scale) if use_examples else ()
+        human_message = HumanMessage(content=self.human_template_string.format(text=text))
+        if layout == "prefix":
+            shared = SharedMessages([self.system_message(issue_to_scale), *example_messages, human_message])
+        elif layout == "standard":
+            shared = SharedMessages([*example_messages, human_message])
+        else:
+            raise ValueError(f"Unknown prompt layout {layout}. Use 'standard' or 'prefix'.")
 
         prompts = []
         for persona_idx in override_persona_to_use:
-            persona_text = self.personas[persona_idx]
             for encouragement_idx in override_encouragement_to_use:
-                encouragement_text = self.encouragements[encouragement_idx]
+                if layout == "prefix":
+                    message = self.persona_message(persona_idx, encouragement_idx)
+                else:
+                    message = self.system_message(issue_to_scale, persona_idx, encouragement_idx)
                 prompts.append(ScalePrompt(
-                    prompt=[
-                        SystemMessage(content=self.system_template.format(
-                            persona=persona_text, encouragement=encouragement_text,
-                            policy_scale=self.policy_scales[issue_to_scale]
-                        )),
-                        *example_messages,
-                        HumanMessage(content=self.human_template.format(text=text))
-                    ], persona=persona_text, encouragement=encouragement_text,
-                    persona_idx=persona_idx, encouragement_idx=encouragement_idx
+                    message, shared, persona=self.personas[persona_idx],
+                    encouragement=self.encouragements[encouragement_idx],
+                    persona_idx=persona_idx, encouragement_idx=encouragement_idx, message_first=layout != "prefix"
                 ))
         return prompts
@@ -0,0 +1,243 @@
+import abc
+import asyncio
+import os
+import threading
+import weakref
+
+from . import (
+    openai_model_list, claude_model_list, gemini_model_list, open_model_list, per_minute_token_limit, context_window
+)
+
+
+class Provider(abc.ABC):
+
+    # The maximum number of tokens of a short choice, e.g. a score, see choice_decoding
+    choice_max_tokens = 5
+    # Whether the API returns the logprobs of the response tokens
+    logprobs = False
+
+    def __init__(self, name, models):
+        """
+        A provider of chat models. The LangChain package of a provider is only imported when a chat model is made.
+
+        Args:
+            name (str): The name of the provider, e.g. "openai".
+            models (list): The names of the models served by the provider. Models added to the list are available
+                at once, see register_model.
+        """
+        self.name = name
+        self.models = models
+
+    @abc.abstractmethod
+    def make_chat_model(self, model, temperature, max_tokens, max_retries):
+        """
+        Make a LangChain chat model. Per-call settings should be bound to it instead, see LLMClient.bind.
+        """
+        pass
+
+    def overload_errors(self):
+        """
+        The exceptions raised by the provider's SDK when the provider is overloaded: rate limits, timeouts
+        and server errors.
+        """
+        return ()
+
+    def choice_decoding(self, model, choices):
+        """
+        The settings which make a model answer one of a few short choices, e.g. a score, in as few tokens as possible.
+
+        Args:
+            model (str): The name of the model.
+            choices (list[str]): The valid answers.
+
+        Returns:
+            tuple: The maximum number of tokens, and the kwargs to bind to the chat model.
+
+        """
+        return self.choice_max_tokens, {"stop": ["\n"]}
+
+
+class OpenAIProvider(Provider):
+
+    logprobs = True
+
+    def __init__(self, name="openai", models=None, base_url=None, api_key_env=None, logit_bias=True):
+        """
+        OpenAI, or any OpenAI compatible API.
+
+        Args:
+            name (str): The name of the provider.
+            models (list): The names of the models served by the provider.
+            base_url (str): The base url of the API. If None, use OpenAI's.
+            api_key_env (str): The environment variable holding the API key. If None, use OpenAI's default.
+            logit_bias (bool): Whether the models are tokenized by tiktoken, so choices can be enforced with a logit bias.
+        """
+        super().__init__(name, openai_model_list if models is None else models)
+        self.base_url = base_url
+        self.api_key_env = api_key_env
+        self.logit_bias = logit_bias
+
+    def make_chat_model(self, model, temperature, max_tokens, max_retries):
+        from langchain_openai import ChatOpenAI
+        kwargs = {}
+        if self.base_url is not None:
+            kwargs["openai_api_base"] = self.base_url
+        if self.api_key_env is not None:
+            kwargs["openai_api_key"] = os.environ.get(self.api_key_env)
+        return ChatOpenAI(
+            temperature=temperature, max_tokens=max_tokens, model_name=model, max_retries=max_retries, **kwargs
+        )
+
+    def overload_errors(self):
+        import openai
+        # Server errors include overloaded responses, which the SDK retries unless the concurrency controller does
+        return openai.RateLimitError, openai.APITimeoutError, openai.InternalServerError
+
+    def choice_decoding(self, model, choices):
+        max_tokens, kwargs = super().choice_decoding(model, choices)
+        if not self.logit_bias:
+            return max_tokens, kwargs
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            return max_tokens, kwargs
+        tokens = [encoding.encode(choice) for choice in choices]
+        # Only the tokens of the choices can be sampled. They are all raised by the same bias,
+        # so their probabilities relative to each other, and their logprobs once renormalized, are unchanged.
+        kwargs["logit_bias"] = {token: 100 for choice_tokens in tokens for token in choice_tokens}
+        return max(len(choice_tokens) for choice_tokens in tokens), kwargs
+
+
+class ClaudeProvider(Provider):
+
+    def __init__(self, name="claude", models=None):
+        super().__init__(name, claude_model_list if models is None else models)
+
+    def make_chat_model(self, model, temperature, max_tokens, max_retries):
+        from langchain_anthropic import ChatAnthropic
+        return ChatAnthropic(temperature=temperature, max_tokens=max_tokens, model_name=model, max_retries=max_retries)
+
+    def overload_errors(self):
+        import anthropic
+        # Includes 529 overloaded responses
+        return anthropic.RateLimitError, anthropic.APITimeoutError, anthropic.InternalServerError
+
+    def choice_decoding(self, model, choices):
+        # The Anthropic API rejects stop sequences made only of whitespace, so only max_tokens bounds the answer
+        return self.choice_max_tokens, {}
+
+
+class GeminiProvider(Provider):
+
+    def __init__(self, name="gemini", models=None):
+        super().__init__(name, gemini_model_list if models is None else models)
+
+    def make_chat_model(self, model, temperature, max_tokens, max_retries):
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        return ChatGoogleGenerativeAI(temperature=temperature, max_tokens=max_tokens, model=model, max_retries=max_retries)
+
+    def overload_errors(self):
+        from google.api_core import exceptions
+        return exceptions.ResourceExhausted, exceptions.DeadlineExceeded, exceptions.ServiceUnavailable
+
+
+providers = {
+    "openai": OpenAIProvider(),
+    "claude": ClaudeProvider(),
+    "gemini": GeminiProvider(),
+    "nebius": OpenAIProvider(
+        "nebius", open_model_list, base_url="https://api.studio.nebius.com/v1/", api_key_env="NEBIUS_API_KEY",
+        logit_bias=False
+    ),
+}
+
+
+def register_provider(provider: Provider):
+    """
+    Register a provider, replacing any provider of the same name.
+    """
+    providers[provider.name] = provider
+
+
+def register_model(model, provider, token_limit=None, context_window_tokens=None):
+    """
+    Make a model available without editing the package, e.g. register_model("gpt-4.1", "openai").
+
+    Args:
+        model (str): The name of the model.
+        provider (str): The name of a registered provider.
+        token_limit (int): The tokens per minute allowed for the model. If None, the default limit.
+        context_window_tokens (int): The context window of the model in tokens. If None, the default window.
+    """
+    if provider not in providers:
+        raise ValueError(f"Unknown provider {provider}. Registered providers: {list(providers)}")
+    if model not in providers[provider].models:
+        providers[provider].models.append(model)
+    if token_limit is not None:
+        per_minute_token_limit[model] = token_limit
+    if context_window_tokens is not None:
+        context_window[model] = context_window_tokens
+
+
+def get_model_provider(model):
+    """
+    The name of the provider serving a model, e.g. "openai", "claude", "gemini" or "nebius".
+
+    Args:
+        model (str): The name of the model.
+
+    Returns:
+        str
+
+    """
+    for name, provider in providers.items():
+        if model in provider.models:
+            return name
+    raise Exception(
+        f"You've selected a model that is not available {model}.\nPlease select from the following models: {[m for p in providers.values() for m in p.models]}"
+    )
+
+
+# Chat models made outside of an event loop, and per event loop, as async HTTP clients are bound to their loop
+_chat_models = {}
+_loop_chat_models = weakref.WeakKeyDictionary()
+_chat_models_lock = threading.Lock()
+
+
+def get_chat_model(model, temperature=0, max_tokens=None, max_retries=2):
+    """
+    Get the LangChain chat model of a model, made once per (model, temperature, max_tokens, max_retries)
+    and reused with its HTTP connection pool. Chat models made in a running event loop are only reused in that loop.
+
+    Args:
+        model (str): The name of the model.
+        temperature (float): The temperature.
+        max_tokens (int): The maximum number of tokens.
+        max_retries (int): The number of times the provider's SDK retries a request.
+
+    Returns:
+        A LangChain chat model.
+
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    key = (model, temperature, max_tokens, max_retries)
+    with _chat_models_lock:
+        pool = _chat_models if loop is None else _loop_chat_models.setdefault(loop, {})
+        if key not in pool:
+            pool[key] = providers[get_model_provider(model)].make_chat_model(
+                model, temperature, max_tokens, max_retries
+            )
+        return pool[key]
+
+
+def clear_chat_models():
+    """
+    Drop the pooled chat models, e.g. after changing API keys.
+    """
+    with _chat_models_lock:
+        _chat_models.clear()
+        _loop_chat_models.clear()
@@ -0,0 +1,439 @@
+import asyncio
+import email.utils
+import math
+import threading
+import time
+from collections import deque
+
+from . import per_minute_token_limit, per_minute_request_limit
+from .utils import estimate_tokens
+
+
+class Reservation:
+    """
+    Budget reserved in a RateLimiter for a single request.
+    """
+    __slots__ = ("timestamp", "tokens", "active")
+
+    def __init__(self, timestamp, tokens):
+        self.timestamp = timestamp
+        self.tokens = tokens
+        # False once the reservation has left the sliding window
+        self.active = True
+
+
+class RateLimiter:
+
+    def __init__(self, token_limit=None, request_limit=None, window=60.0, clock=time.monotonic):
+        """
+        A thread- and asyncio-safe sliding window limiter counting both tokens and requests.
+        Budget is reserved before a request is dispatched and settled against the real usage afterwards.
+
+        Args:
+            token_limit (int): The maximum number of tokens in a window. None for no limit.
+            request_limit (int): The maximum number of requests in a window. None for no limit.
+            window (float): The length of the sliding window in seconds. Defaults to 60.
+            clock (callable): The clock to use. Defaults to time.monotonic.
+        """
+        self.token_limit = token_limit
+        self.request_limit = request_limit
+        self.window = window
+        self.clock = clock
+        self._reservations = deque()
+        self._tokens = 0
+        self._lock = threading.Lock()
+
+    @property
+    def tokens_used(self):
+        with self._lock:
+            self._prune(self.clock())
+            return self._tokens
+
+    @property
+    def requests_used(self):
+        with self._lock:
+            self._prune(self.clock())
+            return len(self._reservations)
+
+    def _prune(self, now):
+        while self._reservations and self._reservations[0].timestamp <= now - self.window:
+            reservation = self._reservations.popleft()
+            reservation.active = False
+            self._tokens -= reservation.tokens
+
+    def _wait_time(self, tokens, now):
+        """
+        Seconds until a request of the given size fits in the window. 0 if it fits now.
+        """
+        wait = 0
+        if self.request_limit is not None and len(self._reservations) >= self.request_limit:
+            expiring = self._reservations[len(self._reservations) - self.request_limit]
+            wait = max(wait, expiring.timestamp + self.window - now)
+        # A request larger than the whole budget is let through once the window is empty
+        if self.token_limit is not None and self._tokens + tokens > self.token_limit and self._reservations:
+            freed = 0
+            for reservation in self._reservations:
+                freed += reservation.tokens
+                if self._tokens - freed + tokens <= self.token_limit:
+                    break
+            wait = max(wait, reservation.timestamp + self.window - now)
+        return wait
+
+    def try_reserve(self, tokens):
+        """
+        Reserve budget for a request if it fits in the window.
+
+        Args:
+            tokens (int): The estimated number of tokens of the request.
+
+        Returns:
+            A tuple (reservation, wait). reservation is None if the request does not fit,
+            in which case wait is the number of seconds to wait before trying again.
+
+        """
+        with self._lock:
+            now = self.clock()
+            self._prune(now)
+            wait = self._wait_time(tokens, now)
+            if wait > 0:
+                return None, wait
+            reservation = Reservation(now, tokens)
+            self._reservations.append(reservation)
+            self._tokens += tokens
+            return reservation, 0
+
+    def acquire(self, tokens):
+        """
+        Reserve budget for a request, blocking the current thread until it fits in the window.
+
+        Args:
+            tokens (int): The estimated number of tokens of the request.
+
+        Returns:
+            Reservation
+
+        """
+        while True:
+            reservation, wait = self.try_reserve(tokens)
+            if reservation is not None:
+                return reservation
+            time.sleep(wait)
+
+    async def aacquire(self, tokens):
+        """
+        Async counterpart of acquire, which does not block the event loop while waiting.
+        """
+        while True:
+            reservation, wait = self.try_reserve(tokens)
+            if reservation is not None:
+                return reservation
+            await asyncio.sleep(wait)
+
+    def settle(self, reservation, tokens):
+        """
+        Replace the estimated tokens of a reservation with the real usage.
+
+        Args:
+            reservation (Reservation): The reservation returned by acquire.
+            tokens (int): The number of tokens actually used.
+
+        """
+        with self._lock:
+            if reservation.active:
+                self._tokens += tokens - reservation.tokens
+            reservation.tokens = tokens
+
+
+def model_limit(limits, model, default=None):
+    """
+    The limit of a model in a table of limits, e.g. per_minute_token_limit.
+    An exact entry wins, else the longest key prefixing the model name, so "gpt-4o" covers "gpt-4o-2024-11-20".
+
+    Args:
+        limits (dict): The limits, keyed by model name or prefix.
+        model (str): The name of the model.
+        default: The limit of a model without entry.
+
+    Returns:
+        The limit.
+
+    """
+    if model in limits:
+        return limits[model]
+    prefixes = [key for key in limits if model.startswith(key)]
+    if prefixes:
+        return limits[max(prefixes, key=len)]
+    return default
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model):
+    """
+    Get the process-wide rate limiter of a model, so the budget is shared by every LLMClient of this model.
+    Limits are read from per_minute_token_limit and per_minute_request_limit, see model_limit.
+
+    Args:
+        model (str): The name of the model.
+
+    Returns:
+        RateLimiter
+
+    """
+    with _rate_limiters_lock:
+        if model not in _rate_limiters:
+            _rate_limiters[model] = RateLimiter(
+                token_limit=model_limit(per_minute_token_limit, model, 800000),
+                request_limit=model_limit(per_minute_request_limit, model)
+            )
+        return _rate_limiters[model]
+
+
+class ConcurrencyController:
+
+    def __init__(
+            self, initial=4, min_limit=1, max_limit=64, increase=1.0, decrease=0.5, target_latency=None,
+            failure_threshold=5, cooldown=60.0, clock=time.monotonic
+    ):
+        """
+        A thread- and asyncio-safe adaptive limit on the requests in flight to a provider (AIMD).
+        The limit grows additively while requests succeed, by `increase` for every `limit` successes,
+        and is cut multiplicatively when the provider is overloaded: a rate limit error, a timeout,
+        or a latency above target_latency. Cuts are applied at most once per second, so a burst of errors
+        from the same overload only counts once.
+
+        Overload errors pause the provider for the retry-after delay they carry, if any.
+        After failure_threshold consecutive overload errors the circuit opens: the provider is paused for cooldown
+        seconds, then requests resume from min_limit.
+
+        Args:
+            initial (float): The initial limit. Defaults to 4.
+            min_limit (int): The minimum limit. Defaults to 1.
+            max_limit (int): The maximum limit. Defaults to 64.
+            increase (float): The additive increase per `limit` successes. Defaults to 1.
+            decrease (float): The multiplicative decrease on overload. Defaults to 0.5.
+            target_latency (float): Seconds above which a successful request counts as overload. None to ignore latency.
+            failure_threshold (int): The consecutive overload errors opening the circuit. Defaults to 5.
+            cooldown (float): The seconds the circuit stays open. Defaults to 60.
+            clock (callable): The clock to use. Defaults to time.monotonic.
+        """
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.consecutive_failures = 0
+        self._last_decrease = None
+        self._lock = threading.Lock()
+        # Waiters for a free slot, woken when a slot is released
+        self._slot_released = threading.Condition(self._lock)
+        self._async_waiters = []
+
+    @property
+    def is_open(self):
+        """
+        Whether the provider is paused, by a retry-after delay or an open circuit.
+        """
+        return self.clock() < self.paused_until
+
+    def try_acquire(self, adaptive=True):
+        """
+        Take a slot if the provider is not paused and, if adaptive, fewer than `limit` requests are in flight.
+
+        Args:
+            adaptive (bool): Apply the adaptive limit. If False, only the pauses of the provider apply,
+                e.g. for a fixed concurrency limited by the caller.
+
+        Returns:
+            The number of seconds to wait before trying again, 0 if a slot was taken,
+            or math.inf if no slot is free until a request is released.
+
+        """
+        with self._lock:
+            return self._try_acquire(adaptive)
+
+    def _try_acquire(self, adaptive):
+        now = self.clock()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if adaptive and self.in_flight >= int(self.limit):
+            return math.inf
+        self.in_flight += 1
+        return 0
+
+    def acquire(self, adaptive=True):
+        """
+        Take a slot, blocking the current thread until one is free. See try_acquire.
+        """
+        with self._slot_released:
+            while (wait := self._try_acquire(adaptive)) > 0:
+                self._slot_released.wait(None if wait == math.inf else wait)
+
+    async def aacquire(self, adaptive=True):
+        """
+        Async counterpart of acquire, which does not block the event loop while waiting.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                wait = self._try_acquire(adaptive)
+                if wait == 0:
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, None if wait == math.inf else wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _notify(self):
+        # Called with the lock held, whenever a slot is released or the limit changes
+        self._slot_released.notify_all()
+        for loop, waiter in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # The loop of the waiter is closed
+                pass
+        self._async_waiters = []
+
+    def release(self, latency=None):
+        """
+        Release the slot of a successful request.
+
+        Args:
+            latency (float): The seconds the request took.
+
+        """
+        with self._lock:
+            self.in_flight -= 1
+            self.consecutive_failures = 0
+            if self.target_latency is not None and latency is not None and latency > self.target_latency:
+                self._decrease(self.clock())
+            else:
+                self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+            self._notify()
+
+    def release_error(self):
+        """
+        Release the slot of a request which failed for another reason than overload. The limit is not changed.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            self._notify()
+
+    def release_overloaded(self, retry_after=None):
+        """
+        Release the slot of a request rejected because the provider is overloaded.
+
+        Args:
+            retry_after (float): The seconds the provider asked to wait, if any.
+
+        """
+        with self._lock:
+            self.in_flight -= 1
+            now = self.clock()
+            self._decrease(now)
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                print(f"Circuit open: pausing requests for {self.cooldown:.0f} seconds.")
+                self.paused_until = max(self.paused_until, now + self.cooldown)
+                self.limit = float(self.min_limit)
+                self.consecutive_failures = 0
+            self._notify()
+
+    def _decrease(self, now):
+        if self._last_decrease is not None and now - self._last_decrease < 1.0:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_concurrency_controllers = {}
+_concurrency_controllers_lock = threading.Lock()
+
+
+def get_concurrency_controller(provider):
+    """
+    Get the process-wide concurrency controller of a provider, shared by every LLMClient of its models,
+    so an overloaded provider is slowed down or paused without affecting the others.
+
+    Args:
+        provider (str): The name of the provider, see providers.get_model_provider.
+
+    Returns:
+        ConcurrencyController
+
+    """
+    with _concurrency_controllers_lock:
+        if provider not in _concurrency_controllers:
+            _concurrency_controllers[provider] = ConcurrencyController()
+        return _concurrency_controllers[provider]
+
+
+def retry_after_seconds(error):
+    """
+    The delay asked by the retry-after-ms or retry-after header of the response of an error, None if not given.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after is None:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            # An HTTP date
+            return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_prompt_tokens(prompt):
+    """
+    A fast estimation of the number of tokens of a prompt, at roughly 4 characters per token.
+
+    Args:
+        prompt: A str, a Message or a list of Messages.
+
+    Returns:
+        int
+
+    """
+    if isinstance(prompt, str):
+        return estimate_tokens(prompt)
+    if not isinstance(prompt, (list, tuple)):
+        prompt = [prompt]
+    return estimate_tokens("".join(str(m.content) for m in prompt))
+
+
+def response_tokens(response):
+    """
+    The number of tokens used by a LangChain response, or None if the provider did not report it.
+    """
+    usage_metadata = getattr(response, "usage_metadata", None)
+    if usage_metadata and usage_metadata.get("total_tokens"):
+        return usage_metadata["total_tokens"]
+    try:
+        return response.response_metadata['token_usage']['total_tokens']
+    except (AttributeError, KeyError, TypeError):
+        return None
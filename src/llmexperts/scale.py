@@ -1,127 +1,475 @@
+import asyncio
+import glob
+import math
 import os
-import numpy as np
+import re
+import uuid
 import pandas as pd
 
 from datetime import datetime
 from langchain_core.load import dumps
 
-from . import openai_model_list
-from .model import LLMClient
-from .prompts import ScalePromptTemplate, ScalePrompt
+from .journal import get_journal
+from .model import LLMClient, get_model_provider, response_cache_read_tokens
+from .providers import providers
+from .prompts import ScalePromptTemplate, ScalePrompt, SharedMessages
+from .ratelimit import get_concurrency_controller
+from .sinks import ResultSink, CSVSink, ScaleResultIndex, get_result_index
+from .utils import run_sync
+
+
+valid_scores = ['NA', '1', '2', '3', '4', '5', '6', '7']
+# The columns of the distribution of the score, see score_distribution
+score_distribution_columns = [f'prob_{score}' for score in valid_scores]
 
 
 def validate_score(score):
-    return score in ['NA', '1', '2', '3', '4', '5', '6', '7']
+    return score in valid_scores
+
+
+def extract_score(text):
+    """
+    Extract the score of a short response, tolerating the decoration models add around it,
+    e.g. "5.", "**5**", "Score: 5" or "N/A".
+
+    Args:
+        text (str): The content of the response.
+
+    Returns:
+        str: The score, or None if the response is not a single score.
+
+    """
+    match = re.fullmatch(r"\W*(?:score\W*)?(N/?A|[1-7])\W*", text.strip(), flags=re.IGNORECASE)
+    if match is None:
+        return None
+    return match.group(1).upper().replace("/", "")
+
 
 def scale_text_with_batch(
         prompt_list: list[ScalePrompt], model, parse_retries=3, max_retries=7, concurrency=3,
-        probabilities=False, dry_run=False,
-        res_persona="index", res_encouragement="index"
+        probabilities=False, top_logprobs=None, dry_run=False,
+        res_persona="index", res_encouragement="index", batch_backend=None, cache=None, journal=None,
+        prompt_cache=False, parse_retry_backoff=1.0, score_only=False
 ):
     """
     Scales the given text, given a list of prompts using the specified model.
+    This is a synchronous wrapper of ascale_text_with_batch.
 
     Args:
         prompt_list (list): A list of lists, each containing message objects representing the conversation.
         model (str): The name or ID of the model to use for scale.
         parse_retries (int): The number of times to retry parsing the response. Defaults to 3.
+            The responses which cannot be parsed are retried together as a concurrent batch.
         max_retries (int): The number of times to retry invoking the model. Defaults to 7, which should be enough
             to handle most TPM rate limits with langchains built in exponential backoff.
-        concurrency (int): The number of concurrent requests to make to the model. Defaults to 3.
-        probabilities (bool): Whether to include token probabilities in the response. Defaults to False. Only works with OpenAI models.
+        concurrency (int|str): The number of concurrent requests to make to the model. Defaults to 3.
+            "auto": as many as the adaptive limit of the provider allows, see ratelimit.ConcurrencyController.
+            The controller then also retries rate limits instead of the SDK, see LLMClient's adaptive_concurrency.
+        probabilities (bool): Whether to include token probabilities in the response. Defaults to False. Only works with OpenAI compatible models.
+        top_logprobs (int): Request the logprobs of the top_logprobs most likely tokens, e.g. 10, and add the
+            distribution of the score (prob_NA, prob_1, ..., prob_7), its expected_score and its entropy to each row.
+            Only works with OpenAI compatible models, including the open models served by Nebius. Defaults to None.
         dry_run (bool, optional): Don't invoke the LLM api call. Return a mock response for debug and testing. Defaults to False.
         res_persona (str, optional): "text": include persona text in result. "index": include persona index in result.
         res_encouragement (str, optional): "text": include encouragement text in result. "index": include encouragement index in result.
+        batch_backend (BatchBackend|bool, optional): Send all prompts as a single job through the provider's offline
+            batch API instead of live requests. If True, use the default backend of the model.
+        cache (ResponseCache|str, optional): A response cache, or the path to its SQLite database file.
+            Cached responses are reused instead of invoking the model again.
+        journal (Journal|str, optional): A journal, or the path to its JSONL file. Each response is appended
+            as soon as it is received, and an interrupted run resumed with the same journal replays them.
+        parse_retry_backoff (float, optional): The number of seconds to wait before the first batch of parse retries,
+            doubled for every following batch. Defaults to 1.0.
+        score_only (bool, optional): Constrain the model to answer only a score, with a few output tokens,
+            see LLMClient's choices. Defaults to False.
 
     Returns:
         dict: A dictionary containing the scaled text generated by the model.
 
     """
+    return run_sync(ascale_text_with_batch(
+        prompt_list, model, parse_retries=parse_retries, max_retries=max_retries, concurrency=concurrency,
+        probabilities=probabilities, top_logprobs=top_logprobs, dry_run=dry_run,
+        res_persona=res_persona, res_encouragement=res_encouragement, batch_backend=batch_backend, cache=cache,
+        journal=journal, prompt_cache=prompt_cache, parse_retry_backoff=parse_retry_backoff, score_only=score_only
+    ))
 
-    llm = LLMClient(model, max_tokens=150, temperature=0, max_retries=max_retries)
 
-    # This is the core call to the model, using batch for concurrency
-    # We needed to add concurrency because we hit rate limits with the API
-    responses = []
-    prompt_batches = [[p.prompt for p in prompt_list[i:i + concurrency]]
-                      for i in range(0, len(prompt_list), concurrency)]
+async def ascale_text_with_batch(
+        prompt_list: list[ScalePrompt], model, parse_retries=3, max_retries=7, concurrency=3,
+        probabilities=False, top_logprobs=None, dry_run=False,
+        res_persona="index", res_encouragement="index", batch_backend=None, cache=None, journal=None,
+        prompt_cache=False, parse_retry_backoff=1.0, score_only=False
+):
+    """
+    Scales the given text asynchronously, given a list of prompts using the specified model.
+    At most `concurrency` requests are in flight at any time, and a new request is started as soon as any one finishes.
+
+    Args:
+        prompt_list (list): A list of lists, each containing message objects representing the conversation.
+        model (str): The name or ID of the model to use for scale.
+        parse_retries (int): The number of times to retry parsing the response. Defaults to 3.
+            The responses which cannot be parsed are retried together as a concurrent batch.
+        max_retries (int): The number of times to retry invoking the model. Defaults to 7, which should be enough
+            to handle most TPM rate limits with langchains built in exponential backoff.
+        concurrency (int|str): The number of concurrent requests to make to the model. Defaults to 3.
+            "auto": as many as the adaptive limit of the provider allows, see ratelimit.ConcurrencyController.
+            The controller then also retries rate limits instead of the SDK, see LLMClient's adaptive_concurrency.
+        probabilities (bool): Whether to include token probabilities in the response. Defaults to False. Only works with OpenAI compatible models.
+        top_logprobs (int): Request the logprobs of the top_logprobs most likely tokens, e.g. 10, and add the
+            distribution of the score (prob_NA, prob_1, ..., prob_7), its expected_score and its entropy to each row.
+            Only works with OpenAI compatible models, including the open models served by Nebius. Defaults to None.
+        dry_run (bool, optional): Don't invoke the LLM api call. Return a mock response for debug and testing. Defaults to False.
+        res_persona (str, optional): "text": include persona text in result. "index": include persona index in result.
+        res_encouragement (str, optional): "text": include encouragement text in result. "index": include encouragement index in result.
+        batch_backend (BatchBackend|bool, optional): Send all prompts as a single job through the provider's offline
+            batch API instead of live requests. If True, use the default backend of the model.
+        cache (ResponseCache|str, optional): A response cache, or the path to its SQLite database file.
+            Cached responses are reused instead of invoking the model again.
+        journal (Journal|str, optional): A journal, or the path to its JSONL file. Each response is appended
+            as soon as it is received, and an interrupted run resumed with the same journal replays them.
+        prompt_cache (bool, optional): Mark all messages but the last as a prefix for the provider's prompt cache,
+            and add a cache_read_tokens column to the results. Prompts should be built with layout="prefix".
+        parse_retry_backoff (float, optional): The number of seconds to wait before the first batch of parse retries,
+            doubled for every following batch. Defaults to 1.0.
+        score_only (bool, optional): Constrain the model to answer only a score, with a few output tokens,
+            see LLMClient's choices. Defaults to False.
+
+    Returns:
+        dict: A dictionary containing the scaled text generated by the model, in the order of prompt_list.
+
+    """
+
+    llm = LLMClient(
+        model, max_tokens=150, temperature=0, max_retries=max_retries, cache=cache, journal=journal,
+        prompt_cache=prompt_cache, choices=valid_scores if score_only else None,
+        probabilities=probabilities, top_logprobs=top_logprobs,
+        # Offline batches are not subject to rate limits
+        adaptive_concurrency=concurrency == "auto" and not batch_backend
+    )
 
-    for prompt_batch in prompt_batches:
-        responses += llm.batch(prompt_batch, dry_run=dry_run, dry_run_res="NA")
+    if batch_backend:
+        # The batch job is polled in a thread to keep the event loop free
+        responses = await asyncio.to_thread(
+            llm.offline_batch, [p.prompt for p in prompt_list],
+            backend=None if batch_backend is True else batch_backend, dry_run=dry_run, dry_run_res="NA"
+        )
+    else:
+        # This is the core call to the model, keeping a fixed number of requests in flight.
+        # We needed to limit concurrency because we hit rate limits with the API
+        responses = await llm.abatch(
+            [p.prompt for p in prompt_list], concurrency=concurrency, dry_run=dry_run, dry_run_res="NA"
+        )
 
     # This is hardcoded to expect a single score or NA in the response
     # If the desired response changes this will need to be updated
     # Originally this handled a json response but that was removed to make
     # this more robust.
-    response_dicts = []
-    responses_logs = []
-    for i, response in enumerate(responses):
-        response_parse = [response]
+    return await aparse_scale_responses_with_retries(
+        llm, responses, prompt_list, parse_retries=parse_retries, concurrency=concurrency,
+        probabilities=probabilities, top_logprobs=top_logprobs,
+        res_persona=res_persona, res_encouragement=res_encouragement,
+        retry_backoff=parse_retry_backoff
+    )
+
+
+async def aparse_scale_responses_with_retries(
+        llm: LLMClient, responses, prompt_list: list[ScalePrompt], parse_retries=3, concurrency=None,
+        probabilities=False, top_logprobs=None, res_persona="index", res_encouragement="index", retry_backoff=1.0,
+        lane: asyncio.Semaphore = None
+):
+    """
+    Parse scaling responses, invoking the model again for the responses which cannot be parsed.
+    The failed prompts of each round are retried together as one concurrent batch,
+    after a backoff doubling every round, so the time spent on retries does not grow with the number of failures.
+
+    Args:
+        llm (LLMClient): The client used for scale.
+        responses (list): LangChain's Responses, one per prompt.
+        prompt_list (list[ScalePrompt]): The prompts which produced the responses.
+        parse_retries (int): The number of rounds of retries. Defaults to 3.
+        concurrency (int|str): The maximum number of retries in flight. If None, all retries of a round are sent at once.
+        probabilities (bool): Whether to include token probabilities in the result. Only works with OpenAI compatible models.
+        top_logprobs (int): Add the distribution of the score, its expected score and its entropy to the result,
+            see score_distribution. The response must have been invoked with top_logprobs.
+        res_persona (str, optional): "text": include persona text in result. "index": include persona index in result.
+        res_encouragement (str, optional): "text": include encouragement text in result. "index": include encouragement index in result.
+        retry_backoff (float): The number of seconds to wait before the first round of retries. Defaults to 1.0.
+        lane (asyncio.Semaphore): A semaphore held while the retries are in flight, but not during the backoff,
+            e.g. the provider lane of scale_corpus.
+
+    Returns:
+        list[dict]: The results in the order of prompt_list, with a score of 'ERR' where all retries failed.
+
+    """
+    model = llm.model
+    response_dicts = [None] * len(prompt_list)
+    # Only the attempts of a prompt are logged in its row
+    attempts = [[response] for response in responses]
+    errors = {}
+
+    def parse(i, response):
         try:
-            score = response.content.strip()
-            if not validate_score(score):
-                raise ValueError(f'Invalid score: {score}')
-            response_dict = {
-                'score': score,
-                'error_message': None,
-                'prompt': dumps(prompt_list[i])
-            }
-            if res_persona == "text":
-                response_dict["persona"] = prompt_list[i].persona
-            else:
-                response_dict["persona"] = prompt_list[i].persona_idx
+            response_dicts[i] = parse_scale_response(
+                response, prompt_list[i], model, probabilities=probabilities, top_logprobs=top_logprobs,
+                res_persona=res_persona, res_encouragement=res_encouragement, tolerant=llm.choices is not None
+            )
+        except Exception as e:
+            # The first error is reported if all retries fail
+            errors.setdefault(i, e)
 
-            if res_encouragement == "text":
-                response_dict["encouragement"] = prompt_list[i].encouragement
-            else:
-                response_dict["encouragement"] = prompt_list[i].encouragement_idx
-
-            if probabilities and (model in openai_model_list):
-                try:
-                    score = response_dict['score']
-                    response_meta_df = pd.DataFrame(response.response_metadata["logprobs"]["content"])
-                    score_metadata = response_meta_df[response_meta_df['token'] == str(score)].iloc[0]
-                    # note this is a little fragile, it will retrieve the probability of the first token in the response
-                    # that matches the score, which given the template "should" be the score itself, but it's not guaranteed
-                    prob = np.exp(score_metadata['logprob'])
-                    response_dict['prob'] = prob
-                except Exception as e:
-                    print(f'Error extracting probabilities from model {model}: {e}')
-                    response_dict['prob'] = 'ERR'
-        except Exception as original_error:
-            attempt = 1
-            while attempt <= parse_retries:
-                print(
-                    f'\nError parsing response from model {model}, retrying attempt {attempt}')
-                try:
-                    response = llm.invoke(prompt_list[i])
-                    response_parse.append(response)
-                    score = response.content.strip()
-                    if not validate_score(score):
-                        raise ValueError(f'Invalid score: {score}')
-                    response_dict = {
-                        'score': score, 'error_message': None,
-                        'prompt': dumps(prompt_list[i]),
-                        'persona': prompt_list[i].persona,
-                        'encouragement': prompt_list[i].encouragement,
-                    }
-                    break
-                except:
-                    attempt += 1
-            else:
-                print(f'Retries failed with model {model}: {original_error}')
-                response_dict = {
-                    'score': 'ERR', 'error_message': original_error,
-                    'prompt': dumps(prompt_list[i]),
-                    'persona': prompt_list[i].persona,
-                    'encouragement': prompt_list[i].encouragement,
-                }
-        responses_logs.append(response_parse)
-        response_dict["responses"] = [dumps(r) for r in responses_logs]
-        response_dicts.append(response_dict)
+    for i, response in enumerate(responses):
+        parse(i, response)
+
+    failed = list(errors)
+    for attempt in range(1, parse_retries + 1):
+        if not failed:
+            break
+        print(f'\nError parsing {len(failed)} responses from model {model}, retrying attempt {attempt}')
+        await asyncio.sleep(retry_backoff * 2 ** (attempt - 1))
+        retry_batch = llm.abatch(
+            [prompt_list[i].prompt for i in failed], concurrency=concurrency, refresh_cache=True,
+            return_exceptions=True
+        )
+        if lane is None:
+            retry_responses = await retry_batch
+        else:
+            async with lane:
+                retry_responses = await retry_batch
+        for i, response in zip(failed, retry_responses):
+            # A failed request counts as a failed attempt, like a response which cannot be parsed
+            if not isinstance(response, Exception):
+                attempts[i].append(response)
+                parse(i, response)
+        failed = [i for i in failed if response_dicts[i] is None]
+
+    for i in failed:
+        print(f'Retries failed with model {model}: {errors[i]}')
+        response_dicts[i] = scale_error_result(
+            prompt_list[i], errors[i], res_persona=res_persona, res_encouragement=res_encouragement,
+            top_logprobs=top_logprobs
+        )
+    for i, response_dict in enumerate(response_dicts):
+        response_dict["responses"] = [dumps(r) for r in attempts[i]]
+        if llm.prompt_cache:
+            response_dict["cache_read_tokens"] = sum(response_cache_read_tokens(r) for r in attempts[i])
     return response_dicts
 
 
+async def aparse_scale_response_with_retries(
+        llm: LLMClient, response, scale_prompt: ScalePrompt, parse_retries=3, probabilities=False, top_logprobs=None,
+        res_persona="index", res_encouragement="index", retry_backoff=1.0, lane: asyncio.Semaphore = None
+):
+    """
+    Parse a single scaling response, invoking the model again if it cannot be parsed.
+    See aparse_scale_responses_with_retries for the arguments.
+
+    Returns:
+        dict: The result, with a score of 'ERR' if all retries failed.
+
+    """
+    return (await aparse_scale_responses_with_retries(
+        llm, [response], [scale_prompt], parse_retries=parse_retries,
+        probabilities=probabilities, top_logprobs=top_logprobs,
+        res_persona=res_persona, res_encouragement=res_encouragement, retry_backoff=retry_backoff, lane=lane
+    ))[0]
+
+
+def scale_error_result(
+        scale_prompt: ScalePrompt, error, res_persona="index", res_encouragement="index", top_logprobs=None
+):
+    """
+    The result of a prompt which could not be scaled, with a score of 'ERR'.
+    """
+    response_dict = {
+        'score': 'ERR', 'error_message': error,
+        'prompt': scale_prompt.dumps(), 'shared_prompt': scale_prompt.shared,
+        'persona': scale_prompt.persona if res_persona == "text" else scale_prompt.persona_idx,
+        'encouragement': scale_prompt.encouragement if res_encouragement == "text" else scale_prompt.encouragement_idx,
+    }
+    if top_logprobs:
+        response_dict.update(score_distribution(None))
+    return response_dict
+
+
+def parse_scale_response(
+        response, scale_prompt: ScalePrompt, model, probabilities=False, top_logprobs=None,
+        res_persona="index", res_encouragement="index", tolerant=False
+):
+    """
+    Parse a single scaling response into a result dictionary.
+
+    Args:
+        response: LangChain's Response.
+        scale_prompt (ScalePrompt): The prompt which produced the response.
+        model (str): The name or ID of the model used for scale.
+        probabilities (bool): Whether to include token probabilities in the result. Only works with OpenAI compatible models.
+        top_logprobs (int): Add the distribution of the score, its expected score and its entropy to the result,
+            see score_distribution. The response must have been invoked with top_logprobs.
+        res_persona (str, optional): "text": include persona text in result. "index": include persona index in result.
+        res_encouragement (str, optional): "text": include encouragement text in result. "index": include encouragement index in result.
+        tolerant (bool, optional): Extract the score from its decoration with extract_score, e.g. for the score-only
+            decoding mode. Otherwise the response must be exactly a valid score. Defaults to False.
+
+    Returns:
+        dict: The parsed result. A ValueError is raised if the response is not a valid score.
+
+    """
+    if tolerant:
+        score = extract_score(response.content)
+    else:
+        score = response.content.strip()
+        if not validate_score(score):
+            score = None
+    if score is None:
+        raise ValueError(f'Invalid score: {response.content.strip()}')
+    response_dict = {
+        'score': score,
+        'error_message': None,
+        'prompt': scale_prompt.dumps(),
+        'shared_prompt': scale_prompt.shared,
+    }
+    if res_persona == "text":
+        response_dict["persona"] = scale_prompt.persona
+    else:
+        response_dict["persona"] = scale_prompt.persona_idx
+
+    if res_encouragement == "text":
+        response_dict["encouragement"] = scale_prompt.encouragement
+    else:
+        response_dict["encouragement"] = scale_prompt.encouragement_idx
+
+    score_token = find_score_token(response)
+    if probabilities and providers[get_model_provider(model)].logprobs:
+        if score_token is not None and score_token['token'].strip() == score:
+            response_dict['prob'] = math.exp(score_token['logprob'])
+        else:
+            print(f'Error extracting probabilities from model {model}: no logprobs of the score token')
+            response_dict['prob'] = 'ERR'
+    if top_logprobs:
+        # Without logprobs, e.g. a cached response or a model which does not return them, the columns are empty
+        response_dict.update(score_distribution(score_token))
+    return response_dict
+
+
+def find_score_token(response):
+    """
+    The logprobs of the first token of a response which is a score.
+    This is usually the first token, but models may add decoration before the score, e.g. "**".
+
+    Args:
+        response: LangChain's Response, invoked with logprobs.
+
+    Returns:
+        dict: The "token", its "logprob" and its "top_logprobs" as returned by the API, or None.
+
+    """
+    logprobs = response.response_metadata.get("logprobs") or {}
+    for token in logprobs.get("content") or []:
+        if token["token"].strip() in valid_scores:
+            return token
+    return None
+
+
+def score_distribution(score_token):
+    """
+    The distribution of the score over NA and 1-7 from the top logprobs of the score token,
+    its expected score and its entropy.
+    The probabilities are renormalized over the scores, so they sum to 1 even if other tokens had some probability.
+    The expected score is computed over 1-7 only, excluding NA.
+
+    Args:
+        score_token (dict): The logprobs of the score token, see find_score_token.
+
+    Returns:
+        dict: prob_NA, prob_1, ..., prob_7, expected_score and entropy (in bits). All None if score_token is None.
+
+    """
+    probs = dict.fromkeys(valid_scores, 0.0)
+    if score_token is not None:
+        # Without top_logprobs, only the sampled token is known
+        for token in score_token.get("top_logprobs") or [score_token]:
+            score = token["token"].strip()
+            if score in probs:
+                probs[score] += math.exp(token["logprob"])
+    total = sum(probs.values())
+    if total == 0:
+        return {**dict.fromkeys(score_distribution_columns), "expected_score": None, "entropy": None}
+    probs = {s: p / total for s, p in probs.items()}
+    numeric_total = 1 - probs["NA"]
+    expected_score = None
+    if numeric_total > 0:
+        expected_score = sum(int(s) * p for s, p in probs.items() if s != "NA") / numeric_total
+    entropy = -sum(p * math.log2(p) for p in probs.values() if p > 0)
+    return {**{f"prob_{s}": p for s, p in probs.items()}, "expected_score": expected_score, "entropy": entropy}
+
+
+def scale_confidence(results, confidence="agreement"):
+    """
+    The confidence of each result of the persona/encouragement variants of a text and an issue, between 0 and 1.
+
+    Args:
+        results (list[dict]): The results of the variants of a text and an issue.
+        confidence (str): "agreement": the share of the variants giving the same score.
+            "margin": the probability of the most likely score minus that of the second, see score_distribution.
+            Results without a score distribution, e.g. not scaled with top_logprobs, fall back to agreement.
+
+    Returns:
+        list[float]: The confidence of each result, 0 for the results which could not be scaled.
+
+    """
+    if confidence not in ("agreement", "margin"):
+        raise ValueError(f"Unknown confidence {confidence}. Use 'agreement' or 'margin'.")
+    scores = [r['score'] for r in results if r['score'] != 'ERR']
+    confidences = []
+    for r in results:
+        probs = [r.get(c) for c in score_distribution_columns]
+        if r['score'] == 'ERR':
+            confidences.append(0.0)
+        elif confidence == "margin" and None not in probs:
+            top, second = sorted(probs, reverse=True)[:2]
+            confidences.append(top - second)
+        else:
+            confidences.append(scores.count(r['score']) / len(scores))
+    return confidences
+
+
+async def ascale_text_with_cascade(
+        prompt_list: list[ScalePrompt], model_list, confidence="agreement", threshold=0.6, **scale_args
+):
+    """
+    Scales the given text with a cascade of models, from the cheapest to the most expensive.
+    Every prompt is scaled by the first model, and only the prompts scored with a confidence below the threshold
+    are sent to the next model, so the expensive models are only used where the cheaper ones are unsure.
+
+    Args:
+        prompt_list (list[ScalePrompt]): The prompts of a text and an issue.
+        model_list (list[str]): The models of the cascade, from the first tier to the last.
+        confidence (str): "agreement" or "margin", see scale_confidence. Defaults to "agreement".
+        threshold (float): The confidence below which a prompt is sent to the next tier. Defaults to 0.6.
+        **scale_args: The arguments of ascale_text_with_batch.
+
+    Returns:
+        list[tuple]: The model which answered each prompt and its result, in the order of prompt_list.
+            Results have a tier, the index of the model in model_list, and the confidence of their score.
+
+    """
+    answers = [None] * len(prompt_list)
+    pending = list(range(len(prompt_list)))
+    for tier, model in enumerate(model_list):
+        results = await ascale_text_with_batch([prompt_list[i] for i in pending], model, **scale_args)
+        for i, result in zip(pending, results):
+            answers[i] = (model, {**result, 'tier': tier})
+        # A score is compared with the current answers of every variant, including those of the previous tiers
+        confidences = scale_confidence([result for _, result in answers], confidence)
+        for i in pending:
+            answers[i][1]['confidence'] = confidences[i]
+        pending = [i for i in pending if confidences[i] < threshold]
+        if len(pending) == 0:
+            break
+    return answers
+
+
 def ensure_output_paths(
         output_dir=None,
         results_filepath=None,
@@ -146,11 +494,13 @@ def ensure_output_paths(
 
 def scale_file(
         filepath, model_list, issue_list, prompt_template: ScalePromptTemplate | os.PathLike, output_dir=None,
-        parse_retries=3, max_retries=7, concurrency=3, probabilities=False,
+        parse_retries=3, max_retries=7, concurrency=3, probabilities=False, top_logprobs=None,
         use_examples=False, override_personas=None, override_encouragements=None, dry_run=False,
         results_filepath=None, results_filename="scale_results.csv",
         save_log=True, meta_columns:dict=None, skip_existing_scale_results=True,
-        res_persona="index", res_encouragement="index"
+        res_persona="index", res_encouragement="index", batch_backend=None, cache=None, journal=None, log_format="csv",
+        result_index=None, prompt_cache=False, sink: ResultSink = None, score_only=False,
+        cascade=False, cascade_confidence="agreement", cascade_threshold=0.6
 ):
     """
     Scales a collection of text files using different models and prompts and output results in a single file.
@@ -164,8 +514,13 @@ def scale_file(
         parse_retries (int): The number of times to retry parsing the response. Defaults to 3.
         max_retries (int): The number of times to retry invoking the model. Defaults to 7, which should be enough
         to handle most TPM rate limits with langchains built in exponential backoff.
-        concurrency (int): The number of concurrent requests to make to the model. Defaults to 3.
-        probabilities (bool): Whether to include token probabilities in the response. Defaults to False. Only works with OpenAI models.
+        concurrency (int|str): The number of concurrent requests to make to the model. Defaults to 3.
+            "auto": as many as the adaptive limit of the provider allows, see ratelimit.ConcurrencyController.
+            The controller then also retries rate limits instead of the SDK, see LLMClient's adaptive_concurrency.
+        probabilities (bool): Whether to include token probabilities in the response. Defaults to False. Only works with OpenAI compatible models.
+        top_logprobs (int): Request the logprobs of the top_logprobs most likely tokens, e.g. 10, and add the
+            distribution of the score (prob_NA, prob_1, ..., prob_7), its expected_score and its entropy to each row.
+            Only works with OpenAI compatible models, including the open models served by Nebius. Defaults to None.
         use_examples (bool): Whether to add examples to the prompts. Defaults to False. Examples must be specified in the prompt_template.
         override_personas (int|list[int]): An index or a list of indices of personas to use. Persona texts will be fetched from the prompt template. If None, will use all personas in the template.
         override_encouragements (int|list[int]): An index or a list of indices of encouragements to use. encouragement texts will be fetched from the prompt template. If None, will use all encouragements in the template.
@@ -174,10 +529,69 @@ def scale_file(
             output_dir and results_file_name will be ignored.
         results_filename (str): The name of the output file. Defaults to 'scale_results.xlsx'.
         save_log (bool): Should the log information be saved to a file. Defaults to False.
+        log_format (str): "csv": save the prompt and raw responses as columns of the results file.
+            "jsonl": save them to an append-only JSONL file next to the results file, keyed by the row_id column.
+        result_index (ScaleResultIndex): The index of existing results used by skip_existing_scale_results.
+            If None, the index of the results file shared by all calls in the process is used.
         meta_columns (dict): A dictionary of {column_name:value} which will be added to the final result file.
         skip_existing_scale_results (bool): Whether to skip existing scale_results that are already in the specified result file.
         res_persona (str): "text": include persona text in result. "index": include persona index in result.
         res_encouragement (str): "text": include encouragement text in result. "index": include encouragement index in result.
+        batch_backend (BatchBackend|bool): Scale through the provider's offline batch API instead of live requests.
+            All prompts of a model are sent as a single batch job. If True, use the default backend of each model.
+        cache (ResponseCache|str): A response cache, or the path to its SQLite database file.
+            Cached responses are reused instead of invoking the model again.
+        journal (Journal|str): A journal, or the path to its JSONL file. Each response is appended
+            as soon as it is received, and an interrupted run resumed with the same journal replays them.
+        prompt_cache (bool): Build the prompts with the "prefix" layout, so all prompts of a text share every message
+            but the final persona message, and mark this prefix for the provider's prompt cache.
+            Adds a cache_read_tokens column to the results.
+        sink (ResultSink): Where results are written and existing results are read from, e.g. a ParquetSink or a
+            store.SQLiteSink shared by several workers.
+            If None, results are appended to the csv results file.
+        score_only (bool): Constrain the models to answer only a score, with a few output tokens,
+            see LLMClient's choices. Defaults to False.
+        cascade (bool): Scale with the models of model_list as a cascade, from the cheapest to the most expensive,
+            instead of scaling every prompt with every model. A prompt is only sent to the next model when the
+            confidence of its score is below cascade_threshold, and only the last answer of each prompt is saved,
+            with its tier (the index of its model in model_list) and confidence. See ascale_text_with_cascade.
+        cascade_confidence (str): "agreement": the share of the persona/encouragement variants giving the same score.
+            "margin": the margin of the most likely score, which needs top_logprobs. Defaults to "agreement".
+        cascade_threshold (float): The confidence below which a prompt is sent to the next model. Defaults to 0.6.
+
+    Returns:
+        DataFrame: A DataFrame containing the scaled text generated by each model.
+
+    """
+    return run_sync(ascale_file(
+        filepath, model_list, issue_list, prompt_template, output_dir=output_dir,
+        parse_retries=parse_retries, max_retries=max_retries, concurrency=concurrency,
+        probabilities=probabilities, top_logprobs=top_logprobs,
+        use_examples=use_examples, override_personas=override_personas,
+        override_encouragements=override_encouragements, dry_run=dry_run,
+        results_filepath=results_filepath, results_filename=results_filename,
+        save_log=save_log, meta_columns=meta_columns, skip_existing_scale_results=skip_existing_scale_results,
+        log_format=log_format, result_index=result_index,
+        res_persona=res_persona, res_encouragement=res_encouragement, batch_backend=batch_backend, cache=cache,
+        journal=journal, prompt_cache=prompt_cache, sink=sink, score_only=score_only,
+        cascade=cascade, cascade_confidence=cascade_confidence, cascade_threshold=cascade_threshold
+    ))
+
+
+async def ascale_file(
+        filepath, model_list, issue_list, prompt_template: ScalePromptTemplate | os.PathLike, output_dir=None,
+        parse_retries=3, max_retries=7, concurrency=3, probabilities=False, top_logprobs=None,
+        use_examples=False, override_personas=None, override_encouragements=None, dry_run=False,
+        results_filepath=None, results_filename="scale_results.csv",
+        save_log=True, meta_columns:dict=None, skip_existing_scale_results=True,
+        res_persona="index", res_encouragement="index", batch_backend=None, cache=None, journal=None, log_format="csv",
+        result_index=None, prompt_cache=False, sink: ResultSink = None, score_only=False,
+        cascade=False, cascade_confidence="agreement", cascade_threshold=0.6
+):
+    """
+    Async counterpart of scale_file, see scale_file for the arguments.
+    Prompts of each (issue, model) group are scaled with ascale_text_with_batch,
+    or the prompts of each issue with ascale_text_with_cascade.
 
     Returns:
         DataFrame: A DataFrame containing the scaled text generated by each model.
@@ -190,6 +604,8 @@ def scale_file(
         output_dir=output_dir,
         results_filepath=results_filepath, results_filename=results_filename
     )
+    # Opened once, so every client of the run appends to the same journal
+    journal = get_journal(journal)
 
     summary_filename = os.path.basename(filepath)
 
@@ -203,84 +619,448 @@ def scale_file(
     with open(filepath, "r", encoding="utf-8") as file:
         text = file.read()
 
-    all_existing_res = None
+    if sink is None:
+        if skip_existing_scale_results and result_index is None:
+            result_index = get_result_index(results_filepath)
+        sink = CSVSink(
+            results_filepath, log_filepath=make_log_filepath(results_filepath) if log_format == "jsonl" else None,
+            result_index=result_index
+        )
     if skip_existing_scale_results:
-        try:
-            all_existing_res = pd.read_csv(results_filepath)
-        except:
-            pass
+        # Only reads results written since the last call
+        sink.refresh()
 
+    # Build the prompts of each (issue, model) group, skipping existing results
+    groups = []
     for issue in issue_list:
         print('-- Scaling issue: ', issue)
         prompts = prompt_template.build_prompt(
             text, issue, use_examples=use_examples,
-            override_persona_to_use=override_personas, override_encouragement_to_use=override_encouragements
+            override_persona_to_use=override_personas, override_encouragement_to_use=override_encouragements,
+            layout="prefix" if prompt_cache else "standard"
         )
 
+        if cascade:
+            # A prompt is done once any tier of the cascade has answered it
+            prompts_to_use = []
+            for p in prompts:
+                p_persona = p.persona if res_persona == "text" else p.persona_idx
+                p_encouragement = p.encouragement if res_encouragement == "text" else p.encouragement_idx
+                if skip_existing_scale_results and any(
+                        (summary_filename, issue, model, p_persona, p_encouragement) in sink for model in model_list
+                ):
+                    print(f"Skip scale: {summary_filename}")
+                else:
+                    prompts_to_use.append(p)
+            if len(prompts_to_use) > 0:
+                groups.append((issue, None, prompts_to_use))
+            continue
+
         for model in model_list:
             print('---- Scaling with model: ', model)
             prompts_to_use = []
-            if skip_existing_scale_results and all_existing_res is not None:
-                try:
-                    for p in prompts:
-                        p_persona = p.persona if res_persona == "text" else p.persona_idx
-                        p_encouragement = p.encouragement if res_encouragement == "text" else p.encouragement_idx
-                        existing_res = all_existing_res[
-                            (all_existing_res['file'] == summary_filename)&
-                            (all_existing_res['issue'] == issue) &
-                            (all_existing_res['scale_model'] == model) &
-                            (all_existing_res['persona'] == p_persona)&
-                            (all_existing_res['encouragement'] == p_encouragement)
-                            ]
-                        if existing_res.shape[0] == 0:
-                            prompts_to_use.append(p)
-                        else:
-                            print(f"Skip scale: {summary_filename}")
-                except:
-                    prompts_to_use = prompts
+            if skip_existing_scale_results:
+                for p in prompts:
+                    p_persona = p.persona if res_persona == "text" else p.persona_idx
+                    p_encouragement = p.encouragement if res_encouragement == "text" else p.encouragement_idx
+                    if (summary_filename, issue, model, p_persona, p_encouragement) in sink:
+                        print(f"Skip scale: {summary_filename}")
+                    else:
+                        prompts_to_use.append(p)
             else:
                 prompts_to_use = prompts
 
             if len(prompts_to_use) > 0:
+                groups.append((issue, model, prompts_to_use))
+
+    scale_args = dict(
+        parse_retries=parse_retries, max_retries=max_retries,
+        concurrency=concurrency, probabilities=probabilities, top_logprobs=top_logprobs, dry_run=dry_run,
+        res_persona=res_persona, res_encouragement=res_encouragement, cache=cache, journal=journal,
+        prompt_cache=prompt_cache, score_only=score_only
+    )
+    write_args = dict(
+        summary_filename=summary_filename, meta_columns=meta_columns,
+        save_log=save_log, res_persona=res_persona, res_encouragement=res_encouragement, sink=sink
+    )
+
+    if cascade:
+        for issue, _, prompts_to_use in groups:
+            answers = await ascale_text_with_cascade(
+                prompts_to_use, model_list, confidence=cascade_confidence, threshold=cascade_threshold,
+                batch_backend=batch_backend, **scale_args
+            )
+            for model in model_list:
+                results = [result for answer_model, result in answers if answer_model == model]
+                if len(results) > 0:
+                    overall_results.append(write_scale_results(results, issue, model, **write_args))
+    elif batch_backend:
+        # Send all prompts of a model as a single batch job, then split the results back into groups
+        for model in model_list:
+            model_groups = [g for g in groups if g[1] == model]
+            if len(model_groups) == 0:
+                continue
+            results = await ascale_text_with_batch(
+                [p for _, _, prompts_to_use in model_groups for p in prompts_to_use], model,
+                batch_backend=batch_backend, **scale_args
+            )
+            for issue, _, prompts_to_use in model_groups:
+                group_results, results = results[:len(prompts_to_use)], results[len(prompts_to_use):]
+                overall_results.append(write_scale_results(group_results, issue, model, **write_args))
+    else:
+        for issue, model, prompts_to_use in groups:
+            results = await ascale_text_with_batch(prompts_to_use, model, **scale_args)
+            overall_results.append(write_scale_results(results, issue, model, **write_args))
+
+    sink.flush()
+    if journal is not None:
+        journal.sync()
+    if len(overall_results) > 0:
+        final_df = pd.concat(overall_results, axis=0)
+        final_df = final_df.reset_index(drop=True)
+        return final_df
+
+
+def make_log_filepath(results_filepath):
+    """
+    The path to the JSONL log file of a results file.
+    """
+    return f"{os.path.splitext(results_filepath)[0]}_log.jsonl"
+
+
+def write_scale_results(
+        results, issue, model, summary_filename, results_filepath=None, meta_columns=None,
+        save_log=True, res_persona="index", res_encouragement="index", log_filepath=None, result_index=None,
+        sink: ResultSink = None
+):
+    """
+    Write the scale results of an (issue, model) group to the results sink.
+
+    Args:
+        results (list[dict]): The results returned by scale_text_with_batch.
+        issue (str): The issue scaled.
+        model (str): The model used for scale.
+        summary_filename (str): The name of the file scaled.
+        results_filepath (str): The path to the csv file where the results will be saved. Ignored if sink is given.
+        meta_columns (dict): A dictionary of {column_name:value} which will be added to the final result file.
+        save_log (bool): Should the log information be saved to a file.
+        log_filepath (str): If provided, the prompt and raw responses are appended to this JSONL file instead of
+            the results file, see CSVSink. Ignored if sink is given.
+        result_index (ScaleResultIndex): If provided, the index is updated with the rows written.
+            Ignored if sink is given.
+        res_persona (str): "text": include persona text in result. "index": include persona index in result.
+        res_encouragement (str): "text": include encouragement text in result. "index": include encouragement index in result.
+        sink (ResultSink): Where to write the results. If None, a CSVSink of results_filepath.
+            If the sink stores logs separately, a row_id column keys the prompt and responses of each row.
+
+    Returns:
+        DataFrame: The results with all columns.
+
+    """
+    if not meta_columns:
+        meta_columns = {}
+    if sink is None:
+        sink = CSVSink(results_filepath, log_filepath=log_filepath, result_index=result_index)
+
+    results_df = pd.DataFrame(results)
+    results_df['issue'] = issue
+    results_df['scale_model'] = model
+    results_df['file'] = summary_filename
+    results_df['created_at'] = datetime.now()
+    for k, v in meta_columns.items():
+        if results_df.shape[0] > 1:
+            results_df[k] = [v]*results_df.shape[0]
+        else:
+            results_df[k] = v
+
+    use_columns = [
+        'file', 'issue', 'scale_model', 'score', 'created_at',
+        *meta_columns.keys()
+    ]
+
+    # The messages shared by the prompts of a text are serialized once, in the first row of the text in the group
+    if 'shared_prompt' in results_df.columns:
+        shared_prompts = []
+        written = set()
+        for shared in results_df['shared_prompt']:
+            if not isinstance(shared, SharedMessages) or shared.id in written:
+                shared_prompts.append(None)
+            else:
+                written.add(shared.id)
+                shared_prompts.append(shared.dumps())
+        results_df['shared_prompt'] = shared_prompts
+
+    if 'cache_read_tokens' in results_df.columns:
+        use_columns.append('cache_read_tokens')
+    if 'expected_score' in results_df.columns:
+        use_columns.extend([*score_distribution_columns, 'expected_score', 'entropy'])
+    if 'tier' in results_df.columns:
+        use_columns.extend(['tier', 'confidence'])
+    if res_persona is not None:
+        use_columns.append('persona')
+    if res_encouragement is not None:
+        use_columns.append('encouragement')
+
+    if save_log:
+        use_columns.append('error_message')
+        log_columns = ['prompt', 'responses']
+        if 'shared_prompt' in results_df.columns:
+            log_columns.append('shared_prompt')
+        if sink.separate_log:
+            results_df['row_id'] = [uuid.uuid4().hex for _ in range(results_df.shape[0])]
+            use_columns.append('row_id')
+            sink.write(results_df[use_columns], results_df[['row_id', *log_columns]])
+        else:
+            sink.write(results_df[use_columns + log_columns])
+    else:
+        sink.write(results_df[use_columns])
+
+    return results_df
+
 
-                results = scale_text_with_batch(
-                    prompts_to_use, model, parse_retries=parse_retries, max_retries=max_retries,
-                    concurrency=concurrency, probabilities=probabilities, dry_run=dry_run,
-                    res_persona=res_persona, res_encouragement=res_encouragement
+def scale_corpus(
+        paths, model_list, issue_list, prompt_template: ScalePromptTemplate | os.PathLike, output_dir=None,
+        parse_retries=3, max_retries=7, concurrency=3, provider_concurrency:dict=None,
+        probabilities=False, top_logprobs=None,
+        use_examples=False, override_personas=None, override_encouragements=None, dry_run=False,
+        results_filepath=None, results_filename="scale_results.csv",
+        save_log=True, meta_columns:dict=None, skip_existing_scale_results=True,
+        res_persona="index", res_encouragement="index", cache=None, journal=None, log_format="csv", result_index=None,
+        prompt_cache=False, sink: ResultSink = None, score_only=False
+):
+    """
+    Scales a collection of text files using different models and prompts and output results in a single file.
+    The (file, issue, model, persona, encouragement) grid is scaled through a separate concurrency lane for each
+    provider, so a slow provider does not hold back the others. Each lane reads the files and builds their prompts
+    lazily into a bounded queue drained by a fixed set of workers, so memory does not grow with the size of the corpus.
+    Results are written to the results file as they finish.
+
+    Args:
+        paths (str|list[str]): A glob pattern or a list of paths of the files to be scaled.
+        model_list (list): A list of model names to use for scale.
+        issue_list (list): A list of issue areas to scale.
+        prompt_template (ScalePromptTemplate|os.PathLike): A ScalePromptTemplate instance or a filepath to the prompt file.
+        output_dir (str): The path to the output directory where the results will be saved.
+        parse_retries (int): The number of times to retry parsing the response. Defaults to 3.
+        max_retries (int): The number of times to retry invoking the model. Defaults to 7.
+        concurrency (int|str): The number of concurrent requests to make to each provider. Defaults to 3.
+            "auto": as many as the adaptive limit of the provider allows, see ratelimit.ConcurrencyController.
+            The controller then also retries rate limits instead of the SDK, see LLMClient's adaptive_concurrency.
+        provider_concurrency (dict): The number of concurrent requests for specific providers, e.g. {"openai": 10}.
+            Providers are "openai", "claude", "gemini" and "nebius". Other providers use concurrency.
+        probabilities (bool): Whether to include token probabilities in the response. Defaults to False. Only works with OpenAI compatible models.
+        top_logprobs (int): Request the logprobs of the top_logprobs most likely tokens, e.g. 10, and add the
+            distribution of the score (prob_NA, prob_1, ..., prob_7), its expected_score and its entropy to each row.
+            Only works with OpenAI compatible models, including the open models served by Nebius. Defaults to None.
+        use_examples (bool): Whether to add examples to the prompts. Defaults to False. Examples must be specified in the prompt_template.
+        override_personas (int|list[int]): An index or a list of indices of personas to use. If None, will use all personas in the template.
+        override_encouragements (int|list[int]): An index or a list of indices of encouragements to use. If None, will use all encouragements in the template.
+        dry_run (bool): Don't invoke the LLM api call. Return a mock response for debug and testing. Defaults to False.
+        results_filepath (str): The path to the csv file where the results will be saved, if provided,
+            output_dir and results_file_name will be ignored.
+        results_filename (str): The name of the output file. Defaults to 'scale_results.csv'.
+        save_log (bool): Should the log information be saved to a file. Defaults to True.
+        meta_columns (dict): A dictionary of {column_name:value} which will be added to the final result file.
+        skip_existing_scale_results (bool): Whether to skip existing scale_results that are already in the specified result file.
+        res_persona (str): "text": include persona text in result. "index": include persona index in result.
+        res_encouragement (str): "text": include encouragement text in result. "index": include encouragement index in result.
+        cache (ResponseCache|str): A response cache, or the path to its SQLite database file.
+        journal (Journal|str): A journal, or the path to its JSONL file. Each response is appended
+            as soon as it is received, and an interrupted run resumed with the same journal replays them.
+        log_format (str): "csv": save the prompt and raw responses as columns of the results file.
+            "jsonl": save them to an append-only JSONL file next to the results file, keyed by the row_id column.
+        result_index (ScaleResultIndex): The index of existing results used by skip_existing_scale_results.
+        prompt_cache (bool): Build the prompts with the "prefix" layout and mark the shared prefix for the provider's
+            prompt cache. Adds a cache_read_tokens column to the results.
+        sink (ResultSink): Where results are written and existing results are read from, e.g. a ParquetSink or a
+            store.SQLiteSink shared by several workers.
+            If None, results are appended to the csv results file.
+        score_only (bool): Constrain the models to answer only a score, with a few output tokens,
+            see LLMClient's choices. Defaults to False.
+
+    Returns:
+        DataFrame: A DataFrame containing the scaled text generated by each model, in the order results finished.
+
+    """
+    return run_sync(ascale_corpus(
+        paths, model_list, issue_list, prompt_template, output_dir=output_dir,
+        parse_retries=parse_retries, max_retries=max_retries, concurrency=concurrency,
+        provider_concurrency=provider_concurrency, probabilities=probabilities, top_logprobs=top_logprobs,
+        use_examples=use_examples, override_personas=override_personas,
+        override_encouragements=override_encouragements, dry_run=dry_run,
+        results_filepath=results_filepath, results_filename=results_filename,
+        save_log=save_log, meta_columns=meta_columns, skip_existing_scale_results=skip_existing_scale_results,
+        res_persona=res_persona, res_encouragement=res_encouragement, cache=cache, journal=journal,
+        log_format=log_format, result_index=result_index, prompt_cache=prompt_cache, sink=sink,
+        score_only=score_only
+    ))
+
+
+async def ascale_corpus(
+        paths, model_list, issue_list, prompt_template: ScalePromptTemplate | os.PathLike, output_dir=None,
+        parse_retries=3, max_retries=7, concurrency=3, provider_concurrency:dict=None,
+        probabilities=False, top_logprobs=None,
+        use_examples=False, override_personas=None, override_encouragements=None, dry_run=False,
+        results_filepath=None, results_filename="scale_results.csv",
+        save_log=True, meta_columns:dict=None, skip_existing_scale_results=True,
+        res_persona="index", res_encouragement="index", cache=None, journal=None, log_format="csv", result_index=None,
+        prompt_cache=False, sink: ResultSink = None, score_only=False
+):
+    """
+    Async counterpart of scale_corpus, see scale_corpus for the arguments.
+
+    Returns:
+        DataFrame: A DataFrame containing the scaled text generated by each model, in the order results finished.
+
+    """
+    if isinstance(paths, (str, os.PathLike)):
+        paths = sorted(glob.glob(str(paths)))
+    provider_concurrency = provider_concurrency or {}
+
+    results_filepath = ensure_output_paths(
+        output_dir=output_dir,
+        results_filepath=results_filepath, results_filename=results_filename
+    )
+    # Opened once, so every client of the run appends to the same journal
+    journal = get_journal(journal)
+
+    if not isinstance(prompt_template, ScalePromptTemplate):
+        prompt_template = ScalePromptTemplate.from_file(prompt_template)
+
+    if sink is None:
+        if skip_existing_scale_results and result_index is None:
+            result_index = get_result_index(results_filepath)
+        sink = CSVSink(
+            results_filepath, log_filepath=make_log_filepath(results_filepath) if log_format == "jsonl" else None,
+            result_index=result_index
+        )
+    if skip_existing_scale_results:
+        # Only reads results written since the last call
+        sink.refresh()
+
+    print(f'Scaling {len(paths)} files.')
+
+    clients = {
+        model: LLMClient(
+            model, max_tokens=150, temperature=0, max_retries=max_retries, cache=cache, journal=journal,
+            prompt_cache=prompt_cache, choices=valid_scores if score_only else None,
+            probabilities=probabilities, top_logprobs=top_logprobs,
+            adaptive_concurrency=provider_concurrency.get(get_model_provider(model), concurrency) == "auto"
+        )
+        for model in model_list
+    }
+    lanes = {}
+    lane_workers = {}
+    for model in model_list:
+        provider = get_model_provider(model)
+        if provider not in lanes:
+            lane_concurrency = provider_concurrency.get(provider, concurrency)
+            if lane_concurrency == "auto":
+                lane_concurrency = get_concurrency_controller(provider).max_limit
+            lanes[provider] = asyncio.Semaphore(lane_concurrency)
+            # Twice the lane's concurrency, so workers waiting to retry an unparseable response do not idle the lane
+            lane_workers[provider] = 2 * lane_concurrency
+
+    write_args = dict(
+        meta_columns=meta_columns,
+        save_log=save_log, res_persona=res_persona, res_encouragement=res_encouragement, sink=sink
+    )
+    finished = asyncio.Queue()
+    overall_results = []
+
+    def lane_work_items(provider):
+        # Files are read and their prompts built one at a time, as the lane drains its queue
+        lane_models = [m for m in model_list if get_model_provider(m) == provider]
+        for filepath in paths:
+            summary_filename = os.path.basename(filepath)
+            with open(filepath, "r", encoding="utf-8") as file:
+                text = file.read()
+            for issue in issue_list:
+                prompts = prompt_template.build_prompt(
+                    text, issue, use_examples=use_examples,
+                    override_persona_to_use=override_personas, override_encouragement_to_use=override_encouragements,
+                    layout="prefix" if prompt_cache else "standard"
                 )
-                results_df = pd.DataFrame(results)
-                results_df['issue'] = issue
-                results_df['scale_model'] = model
-                results_df['file'] = summary_filename
-                results_df['created_at'] = datetime.now()
-                for k, v in meta_columns.items():
-                    if results_df.shape[0] > 1:
-                        results_df[k] = [v]*results_df.shape[0]
-                    else:
-                        results_df[k] = v
+                for model in lane_models:
+                    for p in prompts:
+                        p_persona = p.persona if res_persona == "text" else p.persona_idx
+                        p_encouragement = p.encouragement if res_encouragement == "text" else p.encouragement_idx
+                        if skip_existing_scale_results and \
+                                (summary_filename, issue, model, p_persona, p_encouragement) in sink:
+                            continue
+                        yield summary_filename, issue, model, p
+
+    async def scale_item(summary_filename, issue, model, scale_prompt):
+        llm = clients[model]
+        lane = lanes[get_model_provider(model)]
+        try:
+            async with lane:
+                response = await llm.ainvoke(scale_prompt.prompt, dry_run=dry_run, dry_run_res="NA")
+            # The lane is only held while a retry is in flight, not during the backoff between retries
+            result = await aparse_scale_response_with_retries(
+                llm, response, scale_prompt, parse_retries=parse_retries,
+                probabilities=probabilities, top_logprobs=top_logprobs,
+                res_persona=res_persona, res_encouragement=res_encouragement, lane=lane
+            )
+        except Exception as e:
+            print(f'Error invoking model {model}: {e}')
+            result = scale_error_result(
+                scale_prompt, e, res_persona=res_persona, res_encouragement=res_encouragement,
+                top_logprobs=top_logprobs
+            )
+            result['responses'] = []
+        await finished.put((summary_filename, issue, model, result))
 
-                use_columns = [
-                    'file', 'issue', 'scale_model', 'score', 'created_at',
-                    *meta_columns.keys()
-                ]
+    async def run_lane(provider):
+        # A bounded queue drained by a fixed set of workers, so memory does not grow with the size of the grid
+        n_workers = lane_workers[provider]
+        queue = asyncio.Queue(maxsize=n_workers)
 
-                if res_persona is not None:
-                    use_columns.append('persona')
-                if res_encouragement is not None:
-                    use_columns.append('encouragement')
-                if save_log:
-                    use_columns+=['error_message', 'prompt', "responses"]
+        async def produce():
+            for item in lane_work_items(provider):
+                await queue.put(item)
+            for _ in range(n_workers):
+                await queue.put(None)
 
-                scores_df = results_df[use_columns]
+        async def work():
+            while (item := await queue.get()) is not None:
+                await scale_item(*item)
 
-                # Writing to csv as we go to avoid losing data in case of an error
-                if os.path.exists(results_filepath):
-                    scores_df.to_csv(results_filepath, mode="a", index=False, header=False)
-                else:
-                    scores_df.to_csv(results_filepath, mode="w", index=False)
+        await asyncio.gather(produce(), *[work() for _ in range(n_workers)])
+
+    async def run_lanes():
+        try:
+            await asyncio.gather(*[run_lane(provider) for provider in lanes])
+        finally:
+            await finished.put(None)
+
+    async def write_finished():
+        # Write whatever has finished since the last write, grouped by (file, issue, model)
+        n_written = 0
+        done = False
+        while not done:
+            items = [await finished.get()]
+            while not finished.empty():
+                items.append(finished.get_nowait())
+            # None is put once every lane is done
+            done = items[-1] is None
+            items = [item for item in items if item is not None]
+            groups = {}
+            for summary_filename, issue, model, result in items:
+                groups.setdefault((summary_filename, issue, model), []).append(result)
+            for (summary_filename, issue, model), results in groups.items():
+                overall_results.append(write_scale_results(
+                    results, issue, model, summary_filename=summary_filename, **write_args
+                ))
+            n_written += len(items)
+            print(f'Scaled so far: {n_written} prompts', end='\r')
+        print('\n', end='\r')
 
-                overall_results.append(results_df)
+    await asyncio.gather(write_finished(), run_lanes())
 
+    sink.flush()
+    if journal is not None:
+        journal.sync()
     if len(overall_results) > 0:
         final_df = pd.concat(overall_results, axis=0)
         final_df = final_df.reset_index(drop=True)
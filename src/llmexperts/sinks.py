@@ -0,0 +1,466 @@
+import abc
+import csv
+import io
+import json
+import os
+import threading
+import urllib.parse
+import uuid
+
+import pandas as pd
+
+
+def complete_size(f, size):
+    """
+    The size of the complete lines of a file, i.e. the offset after its last newline, reading backwards from size.
+
+    Args:
+        f: The file, opened in binary mode.
+        size (int): The size of the file.
+
+    Returns:
+        int
+
+    """
+    end = size
+    while end > 0:
+        start = max(0, end - 65536)
+        f.seek(start)
+        newline = f.read(end - start).rfind(b"\n")
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return 0
+
+
+class ScaleResultIndex:
+
+    key_columns = ('file', 'issue', 'scale_model', 'persona', 'encouragement')
+
+    def __init__(self, results_filepath):
+        """
+        An index of the (file, issue, scale_model, persona, encouragement) keys already in a results file,
+        so deciding whether a prompt was already scaled is O(1).
+        The file is read once, then only rows appended since the last read are parsed.
+
+        Args:
+            results_filepath (str): The path to the csv results file.
+        """
+        self.results_filepath = results_filepath
+        self._keys = set()
+        self._offset = 0
+        self._key_positions = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(key):
+        # Values read back from csv are strings, e.g. persona index 0 is "0"
+        return tuple(str(v) for v in key)
+
+    def __contains__(self, key):
+        return self.make_key(key) in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def refresh(self):
+        """
+        Parse the rows appended to the results file since the last read.
+        The index is rebuilt if the file was truncated or replaced.
+        """
+        with self._lock:
+            if not os.path.exists(self.results_filepath):
+                self._keys, self._offset, self._key_positions = set(), 0, None
+                return
+            if os.path.getsize(self.results_filepath) < self._offset:
+                self._keys, self._offset, self._key_positions = set(), 0, None
+            with open(self.results_filepath, "rb") as f:
+                if self._offset > 0:
+                    # The offset must follow a complete line, else the file changed under it: read it again
+                    f.seek(self._offset - 1)
+                    if f.read(1) != b"\n":
+                        self._keys, self._offset, self._key_positions = set(), 0, None
+                f.seek(self._offset)
+                data = f.read()
+            # Ignore a partially written last row
+            data = data[:data.rfind(b"\n") + 1]
+            if len(data) == 0:
+                return
+            reader = csv.reader(io.StringIO(data.decode("utf-8"), newline=""))
+            if self._key_positions is None:
+                header = next(reader)
+                if not all(c in header for c in self.key_columns):
+                    self._offset += len(data)
+                    return
+                self._key_positions = [header.index(c) for c in self.key_columns]
+            for row in reader:
+                if len(row) > max(self._key_positions):
+                    self._keys.add(tuple(row[i] for i in self._key_positions))
+            self._offset += len(data)
+
+    def reset(self):
+        """
+        Forget the rows read so far, e.g. after the results file was rewritten. The next refresh reads the whole file.
+        """
+        with self._lock:
+            self._keys, self._offset, self._key_positions = set(), 0, None
+
+    def add_appended(self, keys, size_before, size_after):
+        """
+        Add the keys of rows just appended to the results file.
+        If nothing else was appended since the last read, the appended rows do not need to be parsed again.
+
+        Args:
+            keys: An iterable of (file, issue, scale_model, persona, encouragement) tuples.
+            size_before (int): The size of the results file before the rows were appended.
+            size_after (int): The size of the results file after the rows were appended.
+        """
+        with self._lock:
+            self._keys.update(self.make_key(k) for k in keys)
+            # A new file is parsed once on the next refresh to read its header
+            if self._offset == size_before and size_before > 0:
+                self._offset = size_after
+
+
+_result_indexes = {}
+_result_indexes_lock = threading.Lock()
+
+
+def get_result_index(results_filepath):
+    """
+    Get the ScaleResultIndex of a results file, shared by every call in the process.
+
+    Args:
+        results_filepath (str): The path to the csv results file.
+
+    Returns:
+        ScaleResultIndex
+
+    """
+    path = os.path.abspath(results_filepath)
+    with _result_indexes_lock:
+        if path not in _result_indexes:
+            _result_indexes[path] = ScaleResultIndex(path)
+        return _result_indexes[path]
+
+
+class ResultSink:
+    """
+    Where scale results are written, and read back to skip existing results.
+    Each row is keyed by (file, issue, scale_model, persona, encouragement).
+    """
+
+    key_columns = ScaleResultIndex.key_columns
+    # Whether the prompt and raw responses are stored apart from the scores, keyed by a row_id column
+    separate_log = True
+
+    def refresh(self):
+        """
+        Read the keys of the results written since the last refresh, e.g. by another process.
+        """
+        pass
+
+    @abc.abstractmethod
+    def __contains__(self, key):
+        pass
+
+    @abc.abstractmethod
+    def write(self, scores_df: pd.DataFrame, log_df: pd.DataFrame = None):
+        """
+        Write the results of a group.
+
+        Args:
+            scores_df (DataFrame): The scores, one row per result.
+            log_df (DataFrame): If separate_log, the row_id, prompt, responses and shared_prompt of the rows.
+                The responses are lists of JSON strings, the other columns are already serialized.
+        """
+        pass
+
+    def flush(self):
+        """
+        Write the buffered results, if any.
+        """
+        pass
+
+
+class CSVSink(ResultSink):
+
+    def __init__(self, results_filepath, log_filepath=None, result_index: ScaleResultIndex = None):
+        """
+        Append results to a csv file. This is the default sink of scale_file.
+
+        Args:
+            results_filepath (str): The path to the csv results file.
+            log_filepath (str): If provided, the prompt and raw responses are appended to this JSONL file instead of
+                the results file, one line per row keyed by row_id. The messages shared by the prompts of a text
+                (see ScalePrompt) are written once, in a line keyed by shared_id before the first row using them.
+            result_index (ScaleResultIndex): The index of the results file, updated with the rows written.
+                If None, existing results are not tracked.
+        """
+        self.results_filepath = results_filepath
+        self.log_filepath = log_filepath
+        self.result_index = result_index
+
+    @property
+    def separate_log(self):
+        return self.log_filepath is not None
+
+    def refresh(self):
+        if self.result_index is not None:
+            self.result_index.refresh()
+
+    def __contains__(self, key):
+        return self.result_index is not None and key in self.result_index
+
+    def write(self, scores_df, log_df=None):
+        if log_df is not None:
+            # The prompt and responses are already serialized as JSON, so they are written as is.
+            with open(self.log_filepath, "a", encoding="utf-8") as f:
+                for row in log_df.to_dict("records"):
+                    if isinstance(row.get("shared_prompt"), str):
+                        shared_id = json.loads(row["prompt"])["shared_id"]
+                        f.write(f'{{"shared_id": "{shared_id}", "messages": {row["shared_prompt"]}}}\n')
+                    f.write(
+                        f'{{"row_id": "{row["row_id"]}", "prompt": {row["prompt"]}, '
+                        f'"responses": [{", ".join(row["responses"])}]}}\n'
+                    )
+
+        # Writing to csv as we go to avoid losing data in case of an error
+        size_before = self._drop_partial_row()
+        header = self.read_header()
+        if header is None:
+            scores_df.to_csv(self.results_filepath, mode="w", index=False)
+        elif any(c not in header for c in scores_df.columns):
+            self._rewrite_with_columns(scores_df, header)
+            return
+        else:
+            # Rows are appended in the column order of the file, columns this run does not produce are left empty
+            scores_df.reindex(columns=header).to_csv(self.results_filepath, mode="a", index=False, header=False)
+
+        if self.result_index is not None and all(c in scores_df.columns for c in self.key_columns):
+            self.result_index.add_appended(
+                scores_df[list(self.key_columns)].itertuples(index=False, name=None),
+                size_before, os.path.getsize(self.results_filepath)
+            )
+
+
+    def _drop_partial_row(self):
+        """
+        Truncate a partially written last row, e.g. left by a crash, so appended rows start on a new line.
+
+        Returns:
+            int: The size of the results file, 0 if it does not exist.
+
+        """
+        if not os.path.exists(self.results_filepath):
+            return 0
+        with open(self.results_filepath, "r+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            end = complete_size(f, size)
+            if end < size:
+                f.truncate(end)
+        return end
+
+    def read_header(self):
+        """
+        The columns of the results file, or None if it does not exist or is empty.
+        """
+        if not os.path.exists(self.results_filepath):
+            return None
+        with open(self.results_filepath, "r", encoding="utf-8", newline="") as f:
+            return next(csv.reader(f), None)
+
+    def _rewrite_with_columns(self, scores_df, header):
+        # A run adding columns, e.g. tier or cache_read_tokens, rewrites the file once with the union of the columns.
+        # Existing values are read as text, so they are written back unchanged.
+        existing_df = pd.read_csv(self.results_filepath, dtype=str, keep_default_na=False)
+        columns = header + [c for c in scores_df.columns if c not in header]
+        # Written to a temporary file then moved over the results file, so a crash leaves either file whole
+        tmp_filepath = f"{self.results_filepath}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_filepath, "w", encoding="utf-8", newline="") as f:
+                pd.concat([existing_df, scores_df], axis=0).reindex(columns=columns).to_csv(f, index=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filepath, self.results_filepath)
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+        if self.result_index is not None:
+            self.result_index.reset()
+            self.result_index.refresh()
+
+
+class ParquetSink(ResultSink):
+
+    def __init__(self, root_dir, partition_cols=("issue", "scale_model"), buffer_rows=1000, row_group_size=None):
+        """
+        Write results to a partitioned Parquet dataset. Requires pyarrow.
+        Scores are stored in root_dir/scores, hive-partitioned by partition_cols, e.g. scores/issue=x/scale_model=y.
+        The prompt and raw responses are stored in a separate table in root_dir/logs, keyed by row_id,
+        so reading scores never loads them.
+
+        Args:
+            root_dir (str): The directory of the dataset.
+            partition_cols (tuple): The columns to partition the scores by. Defaults to ("issue", "scale_model").
+            buffer_rows (int): Results are buffered in memory and written once this many rows are buffered,
+                or on flush. Buffered results are lost if the process crashes. Defaults to 1000.
+            row_group_size (int): The maximum number of rows of a Parquet row group. If None, use pyarrow's default.
+        """
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("ParquetSink requires pyarrow. Install it with `pip install llmexperts[parquet]`.")
+        self.root_dir = root_dir
+        self.scores_dir = os.path.join(root_dir, "scores")
+        self.logs_dir = os.path.join(root_dir, "logs")
+        self.partition_cols = list(partition_cols)
+        self.buffer_rows = buffer_rows
+        self.row_group_size = row_group_size
+        self._scores_buffer = []
+        self._logs_buffer = []
+        self._buffered_rows = 0
+        self._keys = set()
+        self._read_files = set()
+        self._lock = threading.Lock()
+
+    def _dataset(self, directory, partitioning=None):
+        import pyarrow.dataset as ds
+        if not os.path.exists(directory):
+            return None
+        return ds.dataset(directory, format="parquet", partitioning=partitioning)
+
+    def refresh(self):
+        """
+        Read the keys of the Parquet files written since the last refresh. Only the key columns are read.
+        """
+        import pyarrow.dataset as ds
+        with self._lock:
+            dataset = self._dataset(self.scores_dir, partitioning="hive")
+            if dataset is None:
+                return
+            new_files = [f for f in dataset.files if f not in self._read_files]
+            if len(new_files) == 0:
+                return
+            table = ds.dataset(
+                new_files, format="parquet", partitioning=ds.partitioning(flavor="hive"),
+                partition_base_dir=self.scores_dir
+            ).to_table(columns=list(self.key_columns))
+            for key in zip(*[table.column(c).to_pylist() for c in self.key_columns]):
+                self._keys.add(ScaleResultIndex.make_key(key))
+            self._read_files.update(new_files)
+
+    def __contains__(self, key):
+        return ScaleResultIndex.make_key(key) in self._keys
+
+    def write(self, scores_df, log_df=None):
+        with self._lock:
+            if all(c in scores_df.columns for c in self.key_columns):
+                self._keys.update(
+                    ScaleResultIndex.make_key(k)
+                    for k in scores_df[list(self.key_columns)].itertuples(index=False, name=None)
+                )
+            self._scores_buffer.append(scores_df)
+            if log_df is not None:
+                self._logs_buffer.append(log_df)
+            self._buffered_rows += scores_df.shape[0]
+            if self._buffered_rows >= self.buffer_rows:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._buffered_rows == 0:
+            return
+        part_name = f"part-{uuid.uuid4().hex}.parquet"
+        scores_df = to_arrow_compatible(pd.concat(self._scores_buffer, axis=0, ignore_index=True))
+        for values, partition_df in scores_df.groupby(self.partition_cols, sort=False):
+            # Values are url-encoded in directory names, e.g. model names containing "/"
+            partition_dir = os.path.join(self.scores_dir, *[
+                f"{c}={urllib.parse.quote(str(v), safe='')}" for c, v in zip(self.partition_cols, values)
+            ])
+            os.makedirs(partition_dir, exist_ok=True)
+            self._read_files.add(os.path.join(partition_dir, part_name))
+            pq.write_table(
+                pa.Table.from_pandas(partition_df.drop(columns=self.partition_cols), preserve_index=False),
+                os.path.join(partition_dir, part_name), row_group_size=self.row_group_size
+            )
+        if len(self._logs_buffer) > 0:
+            logs_df = pd.concat(self._logs_buffer, axis=0, ignore_index=True)
+            logs_df["responses"] = [f"[{', '.join(r)}]" for r in logs_df["responses"]]
+            os.makedirs(self.logs_dir, exist_ok=True)
+            pq.write_table(
+                pa.Table.from_pandas(to_arrow_compatible(logs_df), preserve_index=False),
+                os.path.join(self.logs_dir, part_name), row_group_size=self.row_group_size
+            )
+        self._scores_buffer, self._logs_buffer, self._buffered_rows = [], [], 0
+
+    def read(self, columns=None, **filters):
+        """
+        Read the scores back. Only the requested columns and matching partitions are read.
+
+        Args:
+            columns (list[str]): The columns to read. If None, read all columns.
+            **filters: Keep the rows where a column is equal to a value, or in a list of values,
+                e.g. issue="taxation" or scale_model=["gpt-4o", "claude-3-5-sonnet-20241022"].
+
+        Returns:
+            DataFrame
+
+        """
+        self.flush()
+        dataset = self._dataset(self.scores_dir, partitioning="hive")
+        if dataset is None:
+            return pd.DataFrame(columns=columns)
+        return dataset.to_table(columns=columns, filter=make_filter(filters)).to_pandas()
+
+    def read_log(self, row_ids=None):
+        """
+        Read the prompts and raw responses of the results.
+
+        Args:
+            row_ids (list[str]): The row_id of the rows to read. If None, read all rows.
+
+        Returns:
+            DataFrame: The row_id, prompt, responses and shared_prompt columns. See ScalePrompt.loads to load prompts.
+
+        """
+        self.flush()
+        dataset = self._dataset(self.logs_dir)
+        if dataset is None:
+            return pd.DataFrame(columns=["row_id", "prompt", "responses"])
+        return dataset.to_table(filter=make_filter({} if row_ids is None else {"row_id": list(row_ids)})).to_pandas()
+
+
+def to_arrow_compatible(df):
+    """
+    Convert values Arrow cannot store, e.g. exceptions in error_message, to str. Missing values are kept.
+    """
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = [
+                v if v is None or isinstance(v, str) else (None if isinstance(v, float) and v != v else str(v))
+                for v in df[column]
+            ]
+    return df
+
+
+def make_filter(filters):
+    """
+    Build a pyarrow dataset filter expression from a {column: value or list of values} dict. None if empty.
+    """
+    import pyarrow.dataset as ds
+    expression = None
+    for column, value in filters.items():
+        if isinstance(value, (list, tuple, set)):
+            condition = ds.field(column).isin(list(value))
+        else:
+            condition = ds.field(column) == value
+        expression = condition if expression is None else expression & condition
+    return expression
@@ -1,43 +1,309 @@
-# Note this still isn't used in the main flow yet, just an option for the future.
+import os
 import sqlite3
+import threading
 from datetime import datetime, timezone
-from google.cloud import storage
 
 import pandas as pd
 
+from .sinks import ResultSink, ScaleResultIndex
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(db_path):
+    """
+    Get the SQLite connection of a database, opened once and shared by every call in the process.
+    The database uses write-ahead logging, so readers do not block the writer and several processes
+    can write to the same file. Use the lock of the connection (see get_connection_lock) around each transaction.
+
+    Args:
+        db_path (str): The path to the SQLite database file.
+
+    Returns:
+        sqlite3.Connection
+
+    """
+    path = os.path.abspath(db_path)
+    with _connections_lock:
+        if path not in _connections:
+            conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            _connections[path] = (conn, threading.RLock())
+        return _connections[path][0]
+
+
+def get_connection_lock(db_path):
+    """
+    Get the lock serializing the use of the shared connection of a database across threads.
+    """
+    get_connection(db_path)
+    return _connections[os.path.abspath(db_path)][1]
+
+
+def close_connection(db_path):
+    """
+    Close the shared connection of a database, if open.
+    """
+    with _connections_lock:
+        conn, _ = _connections.pop(os.path.abspath(db_path), (None, None))
+    if conn is not None:
+        conn.close()
+
+
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def sqlite_type(dtype):
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    return "TEXT"
+
+
+def sqlite_value(value):
+    # Values sqlite3 cannot bind, e.g. timestamps or exceptions in error_message, are stored as str
+    if value is None or isinstance(value, (str, int, float, bytes)):
+        return None if isinstance(value, float) and value != value else value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        return sqlite_value(value.item())
+    return str(value)
+
+
+class SQLiteSink(ResultSink):
+
+    def __init__(self, db_path, table_name="results"):
+        """
+        Store results in a SQLite database. Can be passed to scale_file and scale_corpus as sink,
+        so several workers, in threads or processes, can write results and check for existing ones.
+        Scores are stored in table_name, indexed by (file, issue, scale_model, persona, encouragement).
+        The prompt and raw responses are stored in table_name + "_log", keyed by row_id.
+        Each write is a single transaction, and columns missing from the tables are added as they appear.
+
+        Args:
+            db_path (str): The path to the SQLite database file.
+            table_name (str): The name of the results table. Defaults to "results".
+        """
+        self.db_path = db_path
+        self.table_name = table_name
+        self.log_table_name = f"{table_name}_log"
+        self._columns = {}
+
+    @property
+    def connection(self):
+        return get_connection(self.db_path)
+
+    def table_columns(self, table_name, conn=None):
+        """
+        The columns of a table, or an empty list if it does not exist.
+        """
+        rows = (conn or self.connection).execute(f"PRAGMA table_info({quote_identifier(table_name)})").fetchall()
+        return [row[1] for row in rows]
+
+    def refresh(self):
+        with get_connection_lock(self.db_path):
+            self._columns = {t: self.table_columns(t) for t in (self.table_name, self.log_table_name)}
+
+    def _ensure_table(self, table_name, df, key_columns=(), primary_key=None):
+        columns = self._columns.get(table_name) or self.table_columns(table_name)
+        conn = self.connection
+        if len(columns) == 0:
+            definitions = []
+            for column in df.columns:
+                # Keys are compared as str, as in ScaleResultIndex
+                column_type = "TEXT" if column in key_columns else sqlite_type(df[column].dtype)
+                definition = f"{quote_identifier(column)} {column_type}"
+                if column == primary_key:
+                    definition += " PRIMARY KEY"
+                definitions.append(definition)
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {quote_identifier(table_name)} ({', '.join(definitions)})")
+            if all(c in df.columns for c in key_columns) and len(key_columns) > 0:
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {quote_identifier(f'idx_{table_name}_key')} "
+                    f"ON {quote_identifier(table_name)} ({', '.join(quote_identifier(c) for c in key_columns)})"
+                )
+            columns = self.table_columns(table_name)
+        if any(c not in columns for c in df.columns):
+            # Columns may have been added by another worker
+            columns = self.table_columns(table_name)
+        for column in df.columns:
+            if column not in columns:
+                conn.execute(
+                    f"ALTER TABLE {quote_identifier(table_name)} "
+                    f"ADD COLUMN {quote_identifier(column)} {sqlite_type(df[column].dtype)}"
+                )
+                columns.append(column)
+        self._columns[table_name] = columns
+
+    def _insert(self, table_name, df):
+        conn = self.connection
+        columns = ", ".join(quote_identifier(c) for c in df.columns)
+        placeholders = ", ".join("?" for _ in df.columns)
+        conn.executemany(
+            f"INSERT INTO {quote_identifier(table_name)} ({columns}) VALUES ({placeholders})",
+            ([sqlite_value(v) for v in row] for row in df.itertuples(index=False, name=None))
+        )
+
+    def write(self, scores_df, log_df=None):
+        scores_df = scores_df.copy()
+        scores_df["datetime_utc_added"] = datetime.now(timezone.utc)
+        with get_connection_lock(self.db_path):
+            conn = self.connection
+            with conn:
+                # Take the write lock at once, so concurrent writers wait on busy timeout instead of failing
+                conn.execute("BEGIN IMMEDIATE")
+                self._ensure_table(self.table_name, scores_df, key_columns=self.key_columns)
+                self._insert(self.table_name, scores_df)
+                if log_df is not None:
+                    log_df = log_df.copy()
+                    log_df["responses"] = [f"[{', '.join(r)}]" for r in log_df["responses"]]
+                    self._ensure_table(self.log_table_name, log_df, primary_key="row_id")
+                    self._insert(self.log_table_name, log_df)
+
+    def __contains__(self, key):
+        with get_connection_lock(self.db_path):
+            columns = self._columns.get(self.table_name)
+            if not columns or any(c not in columns for c in self.key_columns):
+                columns = self._columns[self.table_name] = self.table_columns(self.table_name)
+                if any(c not in columns for c in self.key_columns):
+                    return False
+            condition = " AND ".join(f"{quote_identifier(c)} = ?" for c in self.key_columns)
+            row = self.connection.execute(
+                f"SELECT 1 FROM {quote_identifier(self.table_name)} WHERE {condition} LIMIT 1",
+                ScaleResultIndex.make_key(key)
+            ).fetchone()
+        return row is not None
+
+    def _select(self, table_name, conn, columns=None, filters=None):
+        available = self.table_columns(table_name, conn)
+        columns = available if columns is None else list(columns)
+        filters = filters or {}
+        unknown = [c for c in [*columns, *filters] if c not in available]
+        if unknown:
+            raise ValueError(f"Unknown columns {unknown} in table {table_name}.")
+
+        conditions, params = [], []
+        for column, value in filters.items():
+            if isinstance(value, (list, tuple, set, pd.Series)):
+                value = [sqlite_value(v) for v in value]
+                conditions.append(f"{quote_identifier(column)} IN ({', '.join('?' for _ in value)})")
+                params.extend(value)
+            else:
+                conditions.append(f"{quote_identifier(column)} = ?")
+                params.append(sqlite_value(value))
+        query = f"SELECT {', '.join(quote_identifier(c) for c in columns)} FROM {quote_identifier(table_name)}"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return query, params, columns
+
+    def read(self, columns=None, **filters):
+        """
+        Read the scores back. Only the requested columns and matching rows are read,
+        using the index of the key columns when filtering on them.
+
+        Args:
+            columns (list[str]): The columns to read. If None, read all columns.
+            **filters: Keep the rows where a column is equal to a value, or in a list of values,
+                e.g. issue="taxation" or scale_model=["gpt-4o", "claude-3-5-sonnet-20241022"].
+
+        Returns:
+            DataFrame
+
+        """
+        return pd.concat(
+            list(self.iter_read(columns=columns, chunksize=None, **filters)), axis=0, ignore_index=True
+        )
+
+    def iter_read(self, columns=None, chunksize=10000, **filters):
+        """
+        Read the scores back in chunks, so large tables do not have to fit in memory.
+
+        Args:
+            columns (list[str]): The columns to read. If None, read all columns.
+            chunksize (int): The number of rows of each chunk. If None, read all rows in a single chunk.
+            **filters: See read.
+
+        Yields:
+            DataFrame
+
+        """
+        yield from self._iter_table(self.table_name, columns=columns, chunksize=chunksize, filters=filters)
+
+    def read_log(self, row_ids=None):
+        """
+        Read the prompts and raw responses of the results.
+
+        Args:
+            row_ids (list[str]): The row_id of the rows to read. If None, read all rows.
+
+        Returns:
+            DataFrame: The row_id, prompt, responses and shared_prompt columns. See ScalePrompt.loads to load prompts.
+
+        """
+        filters = {} if row_ids is None else {"row_id": list(row_ids)}
+        return pd.concat(
+            list(self._iter_table(self.log_table_name, chunksize=None, filters=filters)), axis=0, ignore_index=True
+        )
+
+    def _iter_table(self, table_name, columns=None, chunksize=10000, filters=None):
+        # Reads use their own connection: with write-ahead logging they see a snapshot of the database
+        # and do not block writers, even while a chunked read is not consumed.
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            if len(self.table_columns(table_name, conn)) == 0:
+                yield pd.DataFrame(columns=columns)
+                return
+            query, params, columns = self._select(table_name, conn, columns=columns, filters=filters)
+            cursor = conn.execute(query, params)
+            while True:
+                rows = cursor.fetchall() if chunksize is None else cursor.fetchmany(chunksize)
+                if len(rows) == 0 and chunksize is not None:
+                    break
+                yield pd.DataFrame.from_records(rows, columns=columns)
+                if chunksize is None:
+                    break
+        finally:
+            conn.close()
+
 
 def store_results(results_df, db_path='../data/results/manifesto_analysis_results.db', table_name='results'):
     """
-    Stores the results of the analysis in a SQLite database.
+    Stores the results of the analysis in a SQLite database. See SQLiteSink.
 
     Args:
         results_df (pd.DataFrame): The DataFrame containing the results of the analysis.
         db_path (str): The path to the SQLite database file. 
+        table_name (str): The name of the results table.
 
     Returns:
         None
 
     """
-    conn = sqlite3.connect(db_path)
-    results_df['datetime_utc_added'] = datetime.now(timezone.utc)
-    results_df.to_sql(table_name, conn, if_exists='append', index=False, method='multi')
+    SQLiteSink(db_path, table_name=table_name).write(results_df)
     print(f'{len(results_df)} results stored successfully in the database.')
 
 
-def get_results(db_path='../data/results/manifesto_analysis_results.db', table_name='results'):
+def get_results(db_path='../data/results/manifesto_analysis_results.db', table_name='results', columns=None, **filters):
     """
-    Retrieves the results of the analysis from a SQLite database.
+    Retrieves the results of the analysis from a SQLite database. See SQLiteSink.read.
 
     Args:
         db_path (str): The path to the SQLite database file. 
+        table_name (str): The name of the results table.
+        columns (list[str]): The columns to read. If None, read all columns.
+        **filters: Keep the rows where a column is equal to a value, or in a list of values.
 
     Returns:
         pd.DataFrame: The DataFrame containing the results of the analysis.
 
     """
-    conn = sqlite3.connect(db_path)
-    results_df = pd.read_sql(f'SELECT * FROM {table_name}', conn)
-    return results_df
+    return SQLiteSink(db_path, table_name=table_name).read(columns=columns, **filters)
 
 
 def read_gcs_file(
@@ -56,6 +322,8 @@ def read_gcs_file(
         encoding (str): File encoding.
 
     """
+    from google.cloud import storage
+
     storage_client = storage.Client(project=project)
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(blob_name)
@@ -69,6 +337,8 @@ def list_gcs_folder(
         project="llms-as-experts",
         delimiter=None
 ):
+    from google.cloud import storage
+
     storage_client = storage.Client(project=project)
     return [
         str(blob.name)
@@ -82,6 +352,8 @@ def download_gcs_file(
         bucket_name="llms-as-experts",
         project="llms-as-experts",
 ):
+    from google.cloud import storage
+
     storage_client = storage.Client(project=project)
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(blob_name)
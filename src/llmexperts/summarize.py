@@ -1,14 +1,15 @@
 import json
+import math
 import os
 # import re
 # from os import PathLike
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_core.load import dumpd
 
+from . import context_window
 from .model import LLMClient
 from .prompts import SummarizePromptTemplate
-from .utils import escape_model_name
+from .utils import escape_model_name, estimate_tokens, get_token_counter, token_counter_margin
 
 
 class Summary:
@@ -30,7 +31,8 @@ class Summary:
 def summarize_text(
         text, prompt_template: SummarizePromptTemplate | os.PathLike, model, issues_to_summarize,
         chunk_size=100000, overlap=2500, max_tokens_factor=1.0,
-        min_size=500, max_size=1000, debug=False, dry_run=False
+        min_size=500, max_size=1000, debug=False, dry_run=False, cache=None, journal=None, concurrency=3,
+        reduce="concat", reduce_token_budget=20000, chunk_unit="chars"
 ) -> Summary:
     """
     Summarizes the given text based on the specified issue areas using a language model.
@@ -48,6 +50,18 @@ def summarize_text(
         max_tokens_factor (float, optional): The max_tokens of LLM will be set to summary_size[1]*max_tokens_factor
         debug (bool, optional): Should debug information be printed. Defaults to False.
         dry_run (bool, optional): Don't invoke the LLM api call. Return a mock response for debug and testing. Defaults to False.
+        cache (ResponseCache|str, optional): A response cache, or the path to its SQLite database file.
+            Cached responses are reused instead of invoking the model again.
+        journal (Journal|str, optional): A journal, or the path to its JSONL file. Each response is appended
+            as soon as it is received, and an interrupted run resumed with the same journal replays them.
+        concurrency (int|str, optional): The number of chunks summarized concurrently. Defaults to 3.
+            "auto": as many as the adaptive limit of the provider allows, see ratelimit.ConcurrencyController.
+            The controller then also retries rate limits instead of the SDK, see LLMClient's adaptive_concurrency.
+        reduce (str, optional): How chunk summaries are combined. "concat": all summaries in a single final prompt.
+            "tree": merge summaries in groups of at most reduce_token_budget tokens, level by level, until one is left.
+        reduce_token_budget (int, optional): The maximum number of tokens of summaries merged in one prompt in "tree" mode.
+        chunk_unit (str, optional): The unit of chunk_size and overlap. "chars" (default) or "tokens" of the model.
+            With "tokens", chunk_size=None plans the fewest chunks fitting the context window of the model.
 
     Returns:
         Summary: The final summary of the text.
@@ -59,24 +73,21 @@ def summarize_text(
 
     # system_kwargs = {"max_size": max_size, "min_size": min_size}
 
-    if chunk_size > 0:
-        if chunk_size < 1:
-            chunk_size = int(len(text)*chunk_size)
-        # Split the text into manageable chunks
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=overlap)
-        chunks = text_splitter.split_text(text)
-    else:
-        chunks = [text]
-
     # Setup the LLM
     max_tokens = max_size * max_tokens_factor
-    llm = LLMClient(model, max_tokens, temperature=0)
+    llm = LLMClient(
+        model, max_tokens, temperature=0, cache=cache, journal=journal, adaptive_concurrency=concurrency == "auto"
+    )
 
-    # Summarize each chunk
-    responses = []
+    chunks = split_text(
+        text, prompt_template, model, issues_to_summarize, chunk_size=chunk_size, overlap=overlap,
+        chunk_unit=chunk_unit, max_tokens=max_tokens, min_size=min_size, max_size=max_size
+    )
 
+    # Summarize the chunks concurrently, responses are kept in the order of the chunks
     print(f"Using {model} for summarization.")
 
+    summarize_prompts = []
     for chunk in chunks:
         summarize_prompt = prompt_template.build_prompt(
             chunk, issues_to_summarize, min_size=min_size, max_size=max_size
@@ -84,18 +95,23 @@ def summarize_text(
 
         if debug:
             print('Prompt:', summarize_prompt)
+        summarize_prompts.append(summarize_prompt)
 
-        if dry_run:
-            dry_run = f"[MOCK SUMMARIZE][{' '.join(issues_to_summarize)}][{model}]"
+    if dry_run:
+        dry_run = f"[MOCK SUMMARIZE][{' '.join(issues_to_summarize)}][{model}]"
 
-        summary_response = llm.invoke(summarize_prompt, dry_run=dry_run)
-        responses.append(summary_response)
+    responses = llm.batch(summarize_prompts, concurrency=concurrency, dry_run=dry_run)
 
-        print(f'Summarized so far: {len(responses)} out of {len(chunks)} chunks', end='\r')
-    print('\n', end='\r')
+    print(f'Summarized {len(responses)} out of {len(chunks)} chunks')
 
     # Combine all summaries into one final summary
-    if len(responses) > 1:
+    if len(responses) > 1 and reduce == "tree":
+        print('Merging summaries level by level into one final summary')
+        responses += tree_reduce_summaries(
+            llm, prompt_template, responses, issues_to_summarize, token_budget=reduce_token_budget,
+            min_size=min_size, max_size=max_size, concurrency=concurrency, dry_run=dry_run
+        )
+    elif len(responses) > 1:
         print('Combining summaries into one final summary')
         final_summaries = " ".join([s.content for s in responses])
         final_summarize_prompt = prompt_template.build_prompt(
@@ -104,11 +120,166 @@ def summarize_text(
         final_summary_response = llm.invoke(final_summarize_prompt, dry_run=dry_run)
         responses.append(final_summary_response)
 
+    if llm.journal is not None:
+        llm.journal.sync()
+
     final_summary = responses[-1].content
     print(f'Final summary length: {len(final_summary)} characters \n')
     return Summary(final_summary, responses)
 
 
+def split_text(
+        text, prompt_template: SummarizePromptTemplate, model, issues_to_summarize,
+        chunk_size=100000, overlap=2500, chunk_unit="chars", max_tokens=1000, min_size=500, max_size=1000
+):
+    """
+    Split a text in the chunks summarized by summarize_text, see summarize_text for the arguments.
+
+    Returns:
+        list[str]: The chunks.
+
+    """
+    if chunk_unit == "tokens":
+        # Size the chunks in tokens of the model, leaving room for the instructions and the summary
+        count_tokens = get_token_counter(model)
+        prompt_tokens = sum(
+            count_tokens(m.content) for m in
+            prompt_template.build_prompt("", issues_to_summarize, min_size=min_size, max_size=max_size)
+        )
+        return split_text_by_tokens(
+            text, model, chunk_size=chunk_size, overlap=overlap, reserved_tokens=prompt_tokens + int(max_tokens)
+        )
+    elif chunk_size > 0:
+        if chunk_size < 1:
+            chunk_size = int(len(text)*chunk_size)
+        # Split the text into manageable chunks
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=overlap)
+        return text_splitter.split_text(text)
+    return [text]
+
+
+def split_text_by_tokens(text, model, chunk_size=None, overlap=0, reserved_tokens=0, safety_margin=None):
+    """
+    Split a text in chunks sized in tokens of the model.
+    Plans the fewest chunks of at most chunk_size tokens and sizes them evenly, instead of a last small chunk.
+
+    Args:
+        text (str): The text to split.
+        model (str): The name of the model, used to count tokens.
+        chunk_size (int, optional): The maximum number of tokens of a chunk.
+            Chunks never exceed the context window of the model minus reserved_tokens and a safety margin,
+            which is also the size used if None.
+        overlap (int, optional): The overlap between consecutive chunks in tokens. Defaults to 0.
+        reserved_tokens (int, optional): Tokens of the context window used by the instructions and the response.
+        safety_margin (float, optional): The fraction of the context window kept free, as the token count can be
+            an approximation. If None, scaled to the error of the counter of the model, see utils.token_counter_margin.
+
+    Returns:
+        list[str]: The chunks.
+
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    count_tokens = get_token_counter(model)
+    if safety_margin is None:
+        safety_margin = token_counter_margin(count_tokens)
+    max_chunk_size = int(context_window.get(model, 8192) * (1 - safety_margin)) - reserved_tokens
+    chunk_size = max_chunk_size if chunk_size is None else min(chunk_size, max_chunk_size)
+    if chunk_size <= overlap:
+        raise ValueError(f"The chunk size ({chunk_size} tokens) must be larger than the overlap ({overlap} tokens).")
+
+    total_tokens = count_tokens(text)
+    if total_tokens <= chunk_size:
+        return [text]
+
+    n_chunks = math.ceil((total_tokens - overlap) / (chunk_size - overlap))
+    even_size = min(chunk_size, math.ceil((total_tokens - overlap) / n_chunks) + overlap)
+    # The splitter sums the lengths of the pieces it merges, which the estimation would round up piece by piece
+    length_function = (lambda t: len(t) / 4) if count_tokens is estimate_tokens else count_tokens
+    chunks = RecursiveCharacterTextSplitter(
+        chunk_size=even_size, chunk_overlap=overlap, length_function=length_function
+    ).split_text(text)
+    if len(chunks) > n_chunks and even_size < chunk_size:
+        # Separators did not line up with the even size, fall back to the fullest chunks
+        chunks = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=overlap, length_function=length_function
+        ).split_text(text)
+    return chunks
+
+
+def group_summaries(token_counts, token_budget):
+    """
+    Group consecutive summaries so that the tokens of each group fit in the budget.
+    A summary larger than the budget is put in a group of its own, but if every summary is,
+    they are grouped in pairs so that each level of the reduce makes progress.
+
+    Args:
+        token_counts (list[int]): The number of tokens of each summary.
+        token_budget (int): The maximum number of tokens of a group.
+
+    Returns:
+        list[list[int]]: The indices of the summaries in each group.
+
+    """
+    groups = []
+    group_tokens = 0
+    for i, tokens in enumerate(token_counts):
+        if len(groups) == 0 or group_tokens + tokens > token_budget:
+            groups.append([i])
+            group_tokens = tokens
+        else:
+            groups[-1].append(i)
+            group_tokens += tokens
+    if len(groups) == len(token_counts) > 1:
+        groups = [list(range(i, min(i + 2, len(token_counts)))) for i in range(0, len(token_counts), 2)]
+    return groups
+
+
+def tree_reduce_summaries(
+        llm: LLMClient, prompt_template: SummarizePromptTemplate, responses, issues_to_summarize, token_budget=20000,
+        min_size=500, max_size=1000, concurrency=3, dry_run=False
+):
+    """
+    Merge summaries level by level until a single summary is left.
+    At each level, consecutive summaries are merged in groups sized to the token budget, and the merges run concurrently.
+
+    Args:
+        llm (LLMClient): The client used for summarization.
+        prompt_template (SummarizePromptTemplate): The prompt template.
+        responses (list): LangChain's Responses of the summaries to merge.
+        issues_to_summarize (list): The issues to be summarized.
+        token_budget (int): The maximum number of tokens of summaries merged in one prompt, counted in tokens of the
+            model less the margin of its counter, see utils.token_counter_margin.
+        min_size (int): The minimum size of the summaries.
+        max_size (int): The maximum size of the summaries.
+        concurrency (int): The number of merges run concurrently.
+        dry_run (bool|str): Don't invoke the LLM api call. Return a mock response for debug and testing.
+
+    Returns:
+        list: The responses of every merge, level by level. The last one is the final summary.
+
+    """
+    merge_responses = []
+    level = list(responses)
+    count_tokens = get_token_counter(llm.model)
+    # Counted in tokens of the model, with the same margin as the chunks for approximate counters
+    token_budget = int(token_budget * (1 - token_counter_margin(count_tokens)))
+    while len(level) > 1:
+        groups = group_summaries([count_tokens(r.content) for r in level], token_budget)
+        merge_groups = [g for g in groups if len(g) > 1]
+        merged = llm.batch([
+            prompt_template.build_prompt(
+                " ".join(level[i].content for i in g), issues_to_summarize, min_size=min_size, max_size=max_size
+            ) for g in merge_groups
+        ], concurrency=concurrency, dry_run=dry_run)
+        merge_responses += merged
+        merged = iter(merged)
+        level = [next(merged) if len(g) > 1 else level[g[0]] for g in groups]
+        print(f'Merged into {len(level)} summaries')
+    return merge_responses
+
+
 def make_summary_name(max_size, model_name, issue_areas, file_path):
 
     input_filename, _ = os.path.splitext(os.path.basename(file_path))
@@ -133,7 +304,8 @@ def summarize_file(
         issues_to_summarize, output_dir, model, try_no_chunk=False,
         chunk_size=100000, overlap=2500, min_size=500, max_size=1000, max_tokens_factor=1.0,
         if_exists='reuse', save_summary=True,  save_log=False, log_dir=None,
-        debug=False, dry_run=False
+        debug=False, dry_run=False, cache=None, journal=None, concurrency=3,
+        reduce="concat", reduce_token_budget=20000, chunk_unit="chars"
 ) -> str:
     """
     Summarizes the text in the given file based on the specified issue area using a language model.
@@ -156,6 +328,18 @@ def summarize_file(
         log_dir (str, optional): The path to the directory where the summary logs will be stored. If None and save_summary is True, save logs to the summary output dir.
         debug (bool, optional): Should debug information be printed. Defaults to False.
         dry_run (bool, optional): Don't invoke the LLM api call. Return a mock response for debug and testing. Defaults to False.
+        cache (ResponseCache|str, optional): A response cache, or the path to its SQLite database file.
+            Cached responses are reused instead of invoking the model again.
+        journal (Journal|str, optional): A journal, or the path to its JSONL file. Each response is appended
+            as soon as it is received, and an interrupted run resumed with the same journal replays them.
+        concurrency (int|str, optional): The number of chunks summarized concurrently. Defaults to 3.
+            "auto": as many as the adaptive limit of the provider allows, see ratelimit.ConcurrencyController.
+            The controller then also retries rate limits instead of the SDK, see LLMClient's adaptive_concurrency.
+        reduce (str, optional): How chunk summaries are combined. "concat": all summaries in a single final prompt.
+            "tree": merge summaries in groups of at most reduce_token_budget tokens, level by level, until one is left.
+        reduce_token_budget (int, optional): The maximum number of tokens of summaries merged in one prompt in "tree" mode.
+        chunk_unit (str, optional): The unit of chunk_size and overlap. "chars" (default) or "tokens" of the model.
+            With "tokens", the whole text is sent without chunks when it fits, so try_no_chunk is not needed.
 
     Returns:
         str: The final summary of the text.
@@ -190,13 +374,15 @@ def summarize_file(
     with open(file_path, "r", encoding="utf-8") as file:
         text = file.read()
 
-    if try_no_chunk:
+    if try_no_chunk and chunk_unit != "tokens":
         try:
             print("Trying summarize without chunk ...")
             summary = summarize_text(
                 text, prompt_template, model, issues_to_summarize,
                 chunk_size=0, overlap=0, max_tokens_factor=max_tokens_factor,
-                min_size=min_size, max_size=max_size, debug=debug, dry_run=dry_run
+                min_size=min_size, max_size=max_size, debug=debug, dry_run=dry_run, cache=cache, journal=journal,
+                concurrency=concurrency, reduce=reduce, reduce_token_budget=reduce_token_budget,
+                chunk_unit=chunk_unit
             )
         except Exception as e:
             if chunk_size > 0:
@@ -204,7 +390,9 @@ def summarize_file(
                 summary = summarize_text(
                     text, prompt_template, model, issues_to_summarize,
                     chunk_size=chunk_size, overlap=overlap, max_tokens_factor=max_tokens_factor,
-                    min_size=min_size, max_size=max_size, debug=debug, dry_run=dry_run
+                    min_size=min_size, max_size=max_size, debug=debug, dry_run=dry_run, cache=cache, journal=journal,
+                    concurrency=concurrency, reduce=reduce, reduce_token_budget=reduce_token_budget,
+                    chunk_unit=chunk_unit
                 )
             else:
                 raise e
@@ -212,7 +400,9 @@ def summarize_file(
         summary = summarize_text(
             text, prompt_template, model, issues_to_summarize,
             chunk_size=chunk_size, overlap=overlap, max_tokens_factor=max_tokens_factor,
-            min_size=min_size, max_size=max_size, debug=debug, dry_run=dry_run
+            min_size=min_size, max_size=max_size, debug=debug, dry_run=dry_run, cache=cache, journal=journal,
+            concurrency=concurrency, reduce=reduce, reduce_token_budget=reduce_token_budget,
+            chunk_unit=chunk_unit
         )
 
     if save_log:
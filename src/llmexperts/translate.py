@@ -1,10 +1,13 @@
 import os
 from math import floor
 from sys import getsizeof
+from typing import TYPE_CHECKING
 
-from google.cloud import translate
 from langchain_core.documents import Document
-from langchain_google_community import GoogleTranslateTransformer
+
+if TYPE_CHECKING:
+    # Google Cloud clients are imported on first use
+    from google.cloud import translate
 
 
 def truncate_text(text, limit=100000):
@@ -33,6 +36,8 @@ def detect_language(
         location (str): Translation service location. Default to "global".
     """
 
+    from google.cloud import translate
+
     client = translate.TranslationServiceClient()
     parent = f"projects/{project_id}/locations/{location}"
     content = truncate_text(text)
@@ -56,7 +61,7 @@ def batch_translate_text(
         location: str = "global",
         timeout: int = 300,
         target_language_code: str = "en",
-) -> translate.TranslateTextResponse:
+) -> "translate.TranslateTextResponse":
     """
     Translates a file on GCS and stores the result in a GCS location.
     This uses Google cloud translation's batch_translate_text API, which allow long text translation.
@@ -87,6 +92,8 @@ def batch_translate_text(
     gcs_destination = {"output_uri_prefix": output_uri}
     output_config = {"gcs_destination": gcs_destination}
 
+    from google.cloud import translate
+
     client = translate.TranslationServiceClient()
     parent = f"projects/{project_id}/locations/{location}"
 
@@ -126,6 +133,8 @@ def translate_text(
         model_id (str): The model to use. One of [general/nmt, general/translation-llm].
         location (str): The location of model.
     """
+    from langchain_google_community import GoogleTranslateTransformer
+
     translator = GoogleTranslateTransformer(project_id=project_id, model_id=model_id, location=location)
     documents = [Document(page_content=text)]
     translated_documents = translator.transform_documents(
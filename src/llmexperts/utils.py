@@ -1,24 +1,172 @@
+import asyncio
+import functools
 import json
-import tiktoken
-import anthropic
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import yaml
 
-from vertexai.preview import tokenization
+from . import openai_model_list, claude_model_list, gemini_model_list
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model):
+    """
+    Get the tokenizer of a model family, loaded once and cached for the whole process.
+    The tokenizer packages are only imported on first use.
+
+    Args:
+        model (str): "gpt", "claude" or "gemini".
 
+    Returns:
+        A tiktoken Encoding for "gpt", an Anthropic client for "claude" (counted by the API),
+        a Vertex AI tokenizer for "gemini".
 
-def count_tokens(text, model):
+    """
     if model == "gpt":
-        encoding = tiktoken.encoding_for_model('gpt-4')
-        enc = encoding.encode(text)
-        return len(enc)
+        import tiktoken
+        return tiktoken.encoding_for_model('gpt-4')
     elif model == "claude":
-        ac = anthropic.Client()
-        return ac.count_tokens(text)
+        import anthropic
+        return anthropic.Client()
     elif model == "gemini":
-        model_name = "gemini-1.5-pro-001"
-        tokenizer = tokenization.get_tokenizer_for_model(model_name)
-        result = tokenizer.count_tokens(text)
-        return result.total_tokens
+        from vertexai.preview import tokenization
+        return tokenization.get_tokenizer_for_model("gemini-1.5-pro-001")
+    raise ValueError(f"No tokenizer for model {model}. Use 'gpt', 'claude' or 'gemini'.")
+
+
+def count_tokens(text, model, approximate=False):
+    """
+    Count the tokens of a text.
+    For "claude", the text is counted by the API as a user message to claude-3-5-sonnet-20241022: the count includes
+    the few tokens wrapping the message, so it is slightly more than the tokens of the text itself.
+
+    Args:
+        text (str): The text.
+        model (str): "gpt", "claude" or "gemini".
+        approximate (bool): For "claude", use approximate_claude_tokens instead of a round trip to the API.
+
+    Returns:
+        int
+
+    """
+    if model == "claude" and approximate:
+        return approximate_claude_tokens(text)
+    tokenizer = get_tokenizer(model)
+    if model == "gpt":
+        return len(tokenizer.encode(text, disallowed_special=()))
+    elif model == "claude":
+        return tokenizer.messages.count_tokens(
+            model="claude-3-5-sonnet-20241022", messages=[{"role": "user", "content": text}]
+        ).input_tokens
+    elif model == "gemini":
+        return tokenizer.count_tokens(text).total_tokens
+
+
+def count_tokens_many(texts, model, approximate=False):
+    """
+    Count the tokens of many texts. Uses tiktoken's batch encoding for "gpt".
+
+    Args:
+        texts (list[str]): The texts.
+        model (str): "gpt", "claude" or "gemini".
+        approximate (bool): For "claude", use approximate_claude_tokens instead of a round trip to the API per text.
+
+    Returns:
+        list[int]
+
+    """
+    if model == "gpt":
+        return [len(tokens) for tokens in get_tokenizer(model).encode_batch(list(texts), disallowed_special=())]
+    return [count_tokens(text, model, approximate=approximate) for text in texts]
+
+
+_claude_token_pattern = re.compile(r"[A-Za-z]+|[0-9]{1,3}|\s+|[^\sA-Za-z0-9]")
+
+
+def approximate_claude_tokens(text):
+    """
+    An offline approximation of the number of tokens of a text for Claude models, whose tokenizer is not public.
+    Latin words count one token per 6 letters started, numbers one token per 3 digits,
+    and every other non-space character one token. Whitespace is merged with the next word.
+
+    Meant for planning, not billing: its error against the API count has not been measured.
+    Code, symbols and non-Latin scripts are counted one token per character, so they are over-counted
+    rather than under-counted. Use count_tokens(text, "claude") where exact numbers matter.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int
+
+    """
+    tokens = 0
+    for piece in _claude_token_pattern.findall(text):
+        if piece[0].isalpha():
+            tokens += (len(piece) + 5) // 6
+        elif not piece[0].isspace():
+            tokens += 1
+    return tokens
+
+
+def estimate_tokens(text):
+    """
+    A fast estimation of the number of tokens of a text, at roughly 4 characters per token.
+    """
+    return len(text) // 4 + 1
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_counter(model):
+    """
+    Get a function counting the tokens of a text for a model, cached per model.
+    OpenAI models use the cached tiktoken encoding of their family, Claude models approximate_claude_tokens
+    and Gemini models the local Vertex AI tokenizer. Other models, or models whose tokenizer cannot be loaded
+    (e.g. offline), fall back to estimate_tokens.
+
+    Args:
+        model (str): The name of the model.
+
+    Returns:
+        A function taking a str and returning its number of tokens.
+
+    """
+    if model in openai_model_list:
+        family = "gpt"
+    elif model in claude_model_list:
+        # Counting with the API would be a round trip per text
+        return approximate_claude_tokens
+    elif model in gemini_model_list:
+        family = "gemini"
+    else:
+        return estimate_tokens
+    try:
+        get_tokenizer(family)
+    except Exception:
+        return estimate_tokens
+    return functools.partial(count_tokens, model=family)
+
+
+def token_counter_margin(count_tokens):
+    """
+    The fraction of a token budget to keep free when sizing text with a counter of get_token_counter,
+    as the approximate counters can under-count: 0.02 for the tokenizers of the model,
+    0.25 for approximate_claude_tokens and 0.5 for estimate_tokens, which under-counts code and non-Latin scripts.
+
+    Args:
+        count_tokens: A function returned by get_token_counter.
+
+    Returns:
+        float
+
+    """
+    if count_tokens is estimate_tokens:
+        return 0.5
+    elif count_tokens is approximate_claude_tokens:
+        return 0.25
+    return 0.02
 
 
 def yml_to_dict(filepath):
@@ -58,3 +206,53 @@ def escape_model_name(name):
 
 def unescape_model_name(name):
     return name.replace("+", "/")
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_background_loop():
+    """
+    Get the event loop run_sync runs coroutines on. It is started once, in a daemon thread, and kept for the whole
+    process, so the chat models pooled per event loop (see providers.get_chat_model) and their HTTP connections are
+    reused by every synchronous call.
+
+    Returns: The event loop.
+
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llmexperts-loop", daemon=True).start()
+        return _loop
+
+
+def run_sync(coro):
+    """
+    Run a coroutine to completion from synchronous code, on a background event loop shared by every call.
+    Works both in plain scripts and inside a running event loop (e.g. Jupyter).
+
+    Args:
+        coro: The coroutine to run.
+
+    Returns: The result of the coroutine.
+
+    """
+    loop = get_background_loop()
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is loop:
+        # Called from a coroutine of the background loop itself, which cannot wait for its own loop
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, coro).result()
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result()
+    except BaseException:
+        # e.g. KeyboardInterrupt: stop the coroutine instead of leaving it running in the background
+        future.cancel()
+        raise
@@ -0,0 +1,271 @@
+import json
+import os
+import threading
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from langchain.schema import HumanMessage, SystemMessage
+
+from src.llmexperts.batch import OpenAIBatchBackend, AnthropicBatchBackend
+from src.llmexperts.prompts import ScalePromptTemplate
+from src.llmexperts.scale import scale_text_with_batch, scale_file
+
+
+class BatchAPIHandler(BaseHTTPRequestHandler):
+    """
+    A local stand-in of OpenAI's and Anthropic's batch APIs.
+    Every request is answered with the score "4", except prompts containing "FAIL" which return an error.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_text(self, text):
+        data = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/binary")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers["Content-Length"]))
+
+    def do_POST(self):
+        state = self.server.state
+        if self.path == "/v1/files":
+            message = BytesParser().parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + self.read_body()
+            )
+            content = [part for part in message.get_payload() if part.get_param("name", header="content-disposition") == "file"][0]
+            file_id = f"file-{len(state['files'])}"
+            state["files"][file_id] = content.get_payload(decode=True).decode("utf-8")
+            self.send_json({
+                "id": file_id, "object": "file", "bytes": 0, "created_at": 0,
+                "filename": "batch.jsonl", "purpose": "batch", "status": "processed"
+            })
+        elif self.path == "/v1/batches":
+            body = json.loads(self.read_body())
+            batch_id = f"batch-{len(state['batches'])}"
+            state["batches"][batch_id] = {"input_file_id": body["input_file_id"], "polls": 0}
+            self.send_json(self.openai_batch(batch_id))
+        elif self.path == "/v1/messages/batches":
+            body = json.loads(self.read_body())
+            batch_id = f"msgbatch-{len(state['batches'])}"
+            state["batches"][batch_id] = {"requests": body["requests"], "polls": 0}
+            self.send_json(self.anthropic_batch(batch_id))
+        else:
+            self.send_json({"error": "not found"}, status=404)
+
+    def do_GET(self):
+        state = self.server.state
+        path = self.path.split("?")[0]
+        if path.startswith("/v1/batches/"):
+            batch_id = path.split("/")[-1]
+            state["batches"][batch_id]["polls"] += 1
+            self.send_json(self.openai_batch(batch_id))
+        elif path.startswith("/v1/files/") and path.endswith("/content"):
+            self.send_text(state["files"][path.split("/")[-2]])
+        elif path.startswith("/v1/messages/batches/") and path.endswith("/results"):
+            batch_id = path.split("/")[-2]
+            lines = []
+            for request in state["batches"][batch_id]["requests"]:
+                if "FAIL" in json.dumps(request):
+                    result = {"type": "errored", "error": {"type": "error", "error": {"type": "api_error", "message": "failed"}}}
+                else:
+                    result = {"type": "succeeded", "message": {
+                        "id": "msg", "type": "message", "role": "assistant", "model": request["params"]["model"],
+                        "content": [{"type": "text", "text": "4"}], "stop_reason": "end_turn", "stop_sequence": None,
+                        "usage": {"input_tokens": 10, "output_tokens": 1}
+                    }}
+                lines.append(json.dumps({"custom_id": request["custom_id"], "result": result}))
+            self.send_text("\n".join(lines))
+        elif path.startswith("/v1/messages/batches/"):
+            batch_id = path.split("/")[-1]
+            state["batches"][batch_id]["polls"] += 1
+            self.send_json(self.anthropic_batch(batch_id))
+        else:
+            self.send_json({"error": "not found"}, status=404)
+
+    def openai_batch(self, batch_id):
+        state = self.server.state
+        batch = state["batches"][batch_id]
+        completed = batch["polls"] > 1
+        output_file_id = None
+        if completed and "output_file_id" not in batch:
+            lines = []
+            for line in state["files"][batch["input_file_id"]].splitlines():
+                request = json.loads(line)
+                if "FAIL" in line:
+                    response = {"status_code": 400, "body": {"error": {"message": "failed"}}}
+                else:
+                    response = {"status_code": 200, "body": {
+                        "id": "chatcmpl", "object": "chat.completion", "model": request["body"]["model"],
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": "4"}, "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11}
+                    }}
+                lines.append(json.dumps({"id": "req", "custom_id": request["custom_id"], "response": response, "error": None}))
+            batch["output_file_id"] = f"file-{len(state['files'])}"
+            state["files"][batch["output_file_id"]] = "\n".join(lines)
+        if completed:
+            output_file_id = batch["output_file_id"]
+        return {
+            "id": batch_id, "object": "batch", "endpoint": "/v1/chat/completions",
+            "input_file_id": batch["input_file_id"], "completion_window": "24h",
+            "status": "completed" if completed else "in_progress", "created_at": 0,
+            "output_file_id": output_file_id, "error_file_id": None,
+        }
+
+    def anthropic_batch(self, batch_id):
+        batch = self.server.state["batches"][batch_id]
+        ended = batch["polls"] > 1
+        return {
+            "id": batch_id, "type": "message_batch", "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": "2024-01-01T00:00:00Z", "expires_at": "2024-01-02T00:00:00Z",
+            "ended_at": "2024-01-01T01:00:00Z" if ended else None, "archived_at": None, "cancel_initiated_at": None,
+            "results_url": f"http://{self.headers['Host']}/v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+
+@pytest.fixture(scope='function')
+def batch_api_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BatchAPIHandler)
+    server.state = {"files": {}, "batches": {}}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture(scope='function')
+def batch_api_url(batch_api_server):
+    return f"http://127.0.0.1:{batch_api_server.server_address[1]}"
+
+
+def test_openai_batch_backend(batch_api_url):
+    backend = OpenAIBatchBackend(base_url=f"{batch_api_url}/v1", api_key="test", poll_interval=0.01)
+    prompts = [
+        [SystemMessage(content="System"), HumanMessage(content="Scale this.")],
+        [SystemMessage(content="System"), HumanMessage(content="FAIL")],
+    ]
+    responses = backend.run(prompts, "gpt-4o-2024-11-20", max_tokens=10)
+    assert len(responses) == 2
+    assert responses[0].content == "4"
+    assert responses[0].usage_metadata["total_tokens"] == 11
+    assert responses[1].content == ""
+    assert "batch_error" in responses[1].response_metadata
+
+
+def test_anthropic_batch_backend(batch_api_url):
+    backend = AnthropicBatchBackend(base_url=batch_api_url, api_key="test", poll_interval=0.01)
+    prompts = [
+        [SystemMessage(content="System"), HumanMessage(content="Scale this.")],
+        [SystemMessage(content="System"), HumanMessage(content="FAIL")],
+    ]
+    request = backend.build_request("request-0", prompts[0], "claude-3-5-sonnet-20241022", 10, 0)
+    assert request["params"]["system"] == "System"
+    assert request["params"]["messages"] == [{"role": "user", "content": "Scale this."}]
+
+    responses = backend.run(prompts, "claude-3-5-sonnet-20241022", max_tokens=10)
+    assert len(responses) == 2
+    assert responses[0].content == "4"
+    assert responses[0].usage_metadata["input_tokens"] == 10
+    assert responses[1].content == ""
+    assert "batch_error" in responses[1].response_metadata
+
+
+def test_scale_text_with_batch_backend(batch_api_url, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    prompt_template = ScalePromptTemplate.from_file(os.path.join(os.path.dirname(__file__), "prompts-scale.yaml"))
+    prompts = prompt_template.build_prompt("TEST TEXT", "issue_1")
+    backend = OpenAIBatchBackend(base_url=f"{batch_api_url}/v1", api_key="test", poll_interval=0.01)
+    results = scale_text_with_batch(prompts, "gpt-4o-2024-11-20", batch_backend=backend)
+    assert len(results) == len(prompts)
+    for r, p in zip(results, prompts):
+        assert r["score"] == "4"
+        assert r["persona"] == p.persona_idx
+        assert r["encouragement"] == p.encouragement_idx
+
+
+def test_scale_file_batch_backend(batch_api_server, batch_api_url, output_folder, summary_file_folder, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    backend = OpenAIBatchBackend(base_url=f"{batch_api_url}/v1", api_key="test", poll_interval=0.01)
+    filename = os.listdir(summary_file_folder)[0]
+    df = scale_file(
+        os.path.join(summary_file_folder, filename), ["gpt-4o-2024-11-20"], ["issue_1", "issue_2"],
+        os.path.join(os.path.dirname(__file__), "prompts-scale.yaml"), output_dir=output_folder,
+        batch_backend=backend
+    )
+    assert df.shape[0] == 2 * 9
+    assert (df["score"] == "4").all()
+    assert (df[df["issue"] == "issue_2"]["persona"].tolist() == df[df["issue"] == "issue_1"]["persona"].tolist())
+    # All prompts of the model are sent as a single batch job
+    assert len(batch_api_server.state["batches"]) == 1
+
+
+def test_batch_backend_bound_kwargs(batch_api_server, batch_api_url, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    prompt_template = ScalePromptTemplate.from_file(os.path.join(os.path.dirname(__file__), "prompts-scale.yaml"))
+    prompts = prompt_template.build_prompt("TEST TEXT", "issue_1")
+    backend = OpenAIBatchBackend(base_url=f"{batch_api_url}/v1", api_key="test", poll_interval=0.01)
+    scale_text_with_batch(prompts, "gpt-4o-2024-11-20", batch_backend=backend, top_logprobs=5)
+    input_file = next(iter(batch_api_server.state["files"].values()))
+    body = json.loads(input_file.splitlines()[0])["body"]
+    assert body["logprobs"] is True
+    assert body["top_logprobs"] == 5
+
+    backend = AnthropicBatchBackend(base_url=batch_api_url, api_key="test", poll_interval=0.01)
+    request = backend.build_request("request-0", prompts[0].prompt, "claude-3-5-sonnet-20241022", 5, 0, {"stop": ["\n"]})
+    assert request["params"]["stop_sequences"] == ["\n"]
+    with pytest.raises(ValueError):
+        backend.build_request("request-0", prompts[0].prompt, "claude-3-5-sonnet-20241022", 5, 0, {"logprobs": True})
+
+
+def test_offline_batch_journal(batch_api_url, output_folder, monkeypatch):
+    from src.llmexperts.journal import Journal
+    from src.llmexperts.model import LLMClient
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    prompts = [[HumanMessage(content="Scale this.")], [HumanMessage(content="FAIL")]]
+    backend = OpenAIBatchBackend(base_url=f"{batch_api_url}/v1", api_key="test", poll_interval=0.01)
+    journal_path = os.path.join(output_folder, "journal.jsonl")
+    with Journal(journal_path) as journal:
+        LLMClient("gpt-4o-2024-11-20", max_tokens=10, journal=journal).offline_batch(prompts, backend=backend)
+
+    class RecordingBackend:
+        def __init__(self):
+            self.prompts = []
+
+        def run(self, prompt_batch, model, max_tokens, temperature=0, bound_kwargs=None):
+            self.prompts.extend(prompt_batch)
+            return backend.run(prompt_batch, model, max_tokens, temperature=temperature, bound_kwargs=bound_kwargs)
+
+    # Only the failed request is sent again when resuming
+    recording = RecordingBackend()
+    with Journal(journal_path) as journal:
+        responses = LLMClient("gpt-4o-2024-11-20", max_tokens=10, journal=journal).offline_batch(prompts, backend=recording)
+    assert responses[0].content == "4"
+    assert recording.prompts == [prompts[1]]
+
+
+def test_get_batch_backend_unsupported():
+    from src.llmexperts.batch import BatchBackend, get_batch_backend
+    from src.llmexperts.providers import Provider
+
+    with pytest.raises(ValueError):
+        get_batch_backend("gemini-1.5-pro-002")
+    # The abstract methods are enforced
+    with pytest.raises(TypeError):
+        BatchBackend()
+    with pytest.raises(TypeError):
+        Provider("test", [])
@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded on first use only, see LLMClient, get_tokenizer, store and translate
+LAZY_MODULES = [
+    "anthropic", "openai", "tiktoken", "vertexai", "langchain_openai", "langchain_anthropic",
+    "langchain_google_genai", "langchain_google_community", "google.cloud.storage", "google.cloud.translate",
+]
+PACKAGE_MODULES = ["scale", "summarize", "plan", "store", "translate", "sinks", "journal", "utils"]
+
+
+def run_python(code):
+    # A fresh interpreter, so nothing is already imported
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return result.stdout.strip().splitlines()[-1]
+
+
+def test_lazy_imports():
+    loaded = run_python(
+        "import sys\n"
+        + "".join(f"import src.llmexperts.{m}\n" for m in PACKAGE_MODULES)
+        + f"print([m for m in {LAZY_MODULES!r} if m in sys.modules])"
+    )
+    assert loaded == "[]"
+
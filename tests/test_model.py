@@ -95,3 +95,370 @@ def test_llm_client_invoke():
             usage_metadata = res.usage_metadata
             assert usage_metadata["input_tokens"] > 0
             assert usage_metadata["output_tokens"] > 0
+
+
+def test_llm_client_abatch_order_and_concurrency():
+    import asyncio
+    import random
+    from langchain.schema import AIMessage
+
+    class SlowChatModel:
+        def __init__(self):
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+        async def ainvoke(self, prompt):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(random.random() / 100)
+            self.in_flight -= 1
+            return AIMessage(content=prompt[-1].content)
+
+    llm = LLMClient("claude-3-5-sonnet-20241022", max_tokens=10)
+    llm.llm = SlowChatModel()
+    batch_prompt = [[HumanMessage(content=str(i))] for i in range(20)]
+    responses = asyncio.run(llm.abatch(batch_prompt, concurrency=3))
+    assert [r.content for r in responses] == [str(i) for i in range(20)]
+    assert llm.llm.max_in_flight == 3
+
+    responses = asyncio.run(llm.abatch(batch_prompt, concurrency=3, dry_run=True, dry_run_res="test"))
+    assert len(responses) == 20
+    for r in responses:
+        assert r.content == "test"
+
+
+def test_response_cache(output_folder):
+    import os
+    import time
+    from langchain.schema import AIMessage
+    from src.llmexperts.model import ResponseCache
+
+    class CountingChatModel:
+        def __init__(self):
+            self.calls = 0
+
+        def invoke(self, prompt):
+            self.calls += 1
+            return AIMessage(
+                content=f"response {self.calls}",
+                usage_metadata={'input_tokens': 1, 'output_tokens': 1, 'total_tokens': 2}
+            )
+
+    cache_path = os.path.join(output_folder, "cache.db")
+    prompt = [SystemMessage(content="System"), HumanMessage(content="Tell me a story.")]
+
+    llm = LLMClient("claude-3-5-sonnet-20241022", max_tokens=10, cache=cache_path)
+    llm.llm = CountingChatModel()
+    first = llm.invoke(prompt)
+    second = llm.invoke(prompt)
+    assert llm.llm.calls == 1
+    assert second.content == first.content
+    assert second.usage_metadata == first.usage_metadata
+    assert (llm.cache.hits, llm.cache.misses) == (1, 1)
+
+    # Persisted across clients, keyed by the model settings
+    llm = LLMClient("claude-3-5-sonnet-20241022", max_tokens=10, cache=ResponseCache(cache_path))
+    llm.llm = CountingChatModel()
+    assert llm.invoke(prompt).content == first.content
+    assert llm.llm.calls == 0
+    llm = LLMClient("claude-3-5-sonnet-20241022", max_tokens=20, cache=cache_path)
+    llm.llm = CountingChatModel()
+    llm.invoke(prompt)
+    assert llm.llm.calls == 1
+    assert llm.invoke(prompt, refresh_cache=True).content == "response 2"
+    assert llm.invoke(prompt).content == "response 2"
+
+    # Eviction
+    cache = ResponseCache(os.path.join(output_folder, "cache_evict.db"), max_entries=2)
+    for i in range(3):
+        cache.set(str(i), AIMessage(content=str(i)))
+        time.sleep(0.01)
+    assert len(cache) == 2
+    assert cache.get("0") is None
+    assert cache.get("2").content == "2"
+
+    cache = ResponseCache(os.path.join(output_folder, "cache_ttl.db"), ttl=0.01)
+    cache.set("0", AIMessage(content="0"))
+    time.sleep(0.02)
+    assert cache.get("0") is None
+
+
+def test_llm_client_prompt_cache():
+    import asyncio
+    from langchain.schema import AIMessage, SystemMessage
+
+    class RecordingChatModel:
+        def __init__(self):
+            self.prompts = []
+
+        async def ainvoke(self, prompt):
+            self.prompts.append(prompt)
+            return AIMessage(
+                content="4",
+                usage_metadata={
+                    "input_tokens": 100, "output_tokens": 1, "total_tokens": 101,
+                    "input_token_details": {"cache_read": 90}
+                }
+            )
+
+    from src.llmexperts.model import response_cache_read_tokens
+    prompt = [SystemMessage(content="System"), HumanMessage(content="Text"), HumanMessage(content="Persona")]
+
+    llm = LLMClient("claude-3-5-sonnet-20241022", max_tokens=10, prompt_cache=True)
+    llm.llm = RecordingChatModel()
+    response = asyncio.run(llm.ainvoke(prompt))
+    sent = llm.llm.prompts[0]
+    assert sent[0] == prompt[0]
+    assert sent[1].content == [{"type": "text", "text": "Text", "cache_control": {"type": "ephemeral"}}]
+    assert sent[2] == prompt[2]
+    # The original prompt is not modified
+    assert prompt[1].content == "Text"
+    assert response_cache_read_tokens(response) == 90
+    assert response_cache_read_tokens(AIMessage(content="4")) == 0
+
+    # No markers for providers caching prefixes automatically
+    llm = LLMClient("gpt-4o-2024-11-20", max_tokens=10, prompt_cache=True)
+    assert llm.mark_prompt_cache(prompt) is prompt
+
+
+def test_journal_resume(output_folder):
+    import asyncio
+    import os
+    from langchain.schema import AIMessage
+    from src.llmexperts.journal import Journal
+
+    class CountingChatModel:
+        def __init__(self, fail_after=None):
+            self.calls = 0
+            self.fail_after = fail_after
+
+        async def ainvoke(self, prompt):
+            if self.fail_after is not None and self.calls >= self.fail_after:
+                raise RuntimeError("Interrupted")
+            self.calls += 1
+            return AIMessage(content=f"response {prompt[-1].content}")
+
+    journal_path = os.path.join(output_folder, "journal.jsonl")
+    batch_prompt = [[HumanMessage(content=str(i))] for i in range(10)]
+
+    # The run is interrupted after 6 responses
+    llm = LLMClient("claude-3-5-sonnet-20241022", max_tokens=10, journal=Journal(journal_path, fsync_every=4))
+    llm.llm = CountingChatModel(fail_after=6)
+    with pytest.raises(RuntimeError):
+        asyncio.run(llm.abatch(batch_prompt, concurrency=1))
+    llm.journal.close()
+    # A partially written line is dropped on resume
+    with open(journal_path, "a", encoding="utf-8") as f:
+        f.write('{"key": "torn", "resp')
+
+    journal = Journal(journal_path)
+    assert journal.replayed == 6
+    llm = LLMClient("claude-3-5-sonnet-20241022", max_tokens=10, journal=journal)
+    llm.llm = CountingChatModel()
+    responses = asyncio.run(llm.abatch(batch_prompt, concurrency=1))
+    assert [r.content for r in responses] == [f"response {i}" for i in range(10)]
+    assert llm.llm.calls == 4
+    # Responses appended in this run are read back from the file too
+    assert llm.journal_get(batch_prompt[9]).content == "response 9"
+    journal.close()
+
+    with open(journal_path, "r", encoding="utf-8") as f:
+        assert len(f.readlines()) == 10
+    assert len(Journal(journal_path, resume=False)) == 0
+
+
+def test_chat_model_pool(monkeypatch):
+    import asyncio
+    from src.llmexperts import open_model_list, per_minute_token_limit
+    from src.llmexperts.providers import get_model_provider, register_model
+
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    monkeypatch.setenv("NEBIUS_API_KEY", "test")
+    a = LLMClient("claude-3-5-sonnet-20241022", max_tokens=10)
+    b = LLMClient("claude-3-5-sonnet-20241022", max_tokens=10)
+    assert a.llm is b.llm
+    assert LLMClient("claude-3-5-sonnet-20241022", max_tokens=20).llm is not a.llm
+    # Per-call settings are bound, the pooled chat model is not changed
+    b.bind(stop=["\n"])
+    assert b.llm is not a.llm
+    assert LLMClient("claude-3-5-sonnet-20241022", max_tokens=10).llm is a.llm
+
+    async def make_clients():
+        return [LLMClient("claude-3-5-sonnet-20241022", max_tokens=10).llm for _ in range(2)]
+
+    # Async HTTP clients are bound to their event loop
+    in_loop = asyncio.run(make_clients())
+    assert in_loop[0] is in_loop[1]
+    assert in_loop[0] is not a.llm
+
+    register_model("test-model", "nebius", token_limit=1000)
+    try:
+        assert get_model_provider("test-model") == "nebius"
+        llm = LLMClient("test-model", max_tokens=10)
+        assert llm.token_limit == 1000
+        assert llm.llm.openai_api_base == "https://api.studio.nebius.com/v1/"
+    finally:
+        open_model_list.remove("test-model")
+        per_minute_token_limit.pop("test-model")
+    with pytest.raises(ValueError):
+        register_model("test-model", "unknown-provider")
+
+
+def test_chat_model_pool_sync_calls(monkeypatch):
+    import os
+    from src.llmexperts.prompts import ScalePromptTemplate
+    from src.llmexperts.providers import ClaudeProvider, clear_chat_models
+    from src.llmexperts.scale import scale_text_with_batch
+
+    from langchain_core.messages import AIMessage
+
+    made = []
+
+    class ChatModel:
+        async def ainvoke(self, prompt):
+            return AIMessage(content="3")
+
+    def counting_make_chat_model(self, *args):
+        made.append(args)
+        return ChatModel()
+
+    monkeypatch.setattr(ClaudeProvider, "make_chat_model", counting_make_chat_model)
+    clear_chat_models()
+    prompt_template = ScalePromptTemplate.from_file(os.path.join(os.path.dirname(__file__), "prompts-scale.yaml"))
+    prompts = prompt_template.build_prompt("TEST TEXT", "issue_1")
+    # Every synchronous call runs on the same event loop, so its chat model and connections are reused
+    for _ in range(2):
+        results = scale_text_with_batch(prompts, "claude-3-5-sonnet-20241022")
+        assert [r["score"] for r in results] == ["3"] * len(prompts)
+    assert len(made) == 1
+    clear_chat_models()
+
+
+def test_llm_client_overload_retry():
+    import asyncio
+    from langchain.schema import AIMessage
+    from src.llmexperts.ratelimit import ConcurrencyController
+
+    class Response:
+        headers = {"retry-after": "0.01"}
+
+    class Overloaded(Exception):
+        response = Response()
+
+    class FlakyChatModel:
+        def __init__(self):
+            self.calls = 0
+
+        async def ainvoke(self, prompt):
+            self.calls += 1
+            if self.calls <= 2:
+                raise Overloaded()
+            return AIMessage(content="ok")
+
+    llm = LLMClient("claude-3-5-sonnet-20241022", max_tokens=10, overload_retries=2)
+    llm.llm = FlakyChatModel()
+    llm.overload_errors = (Overloaded,)
+    llm.concurrency_controller = ConcurrencyController(initial=4)
+    assert asyncio.run(llm.ainvoke([HumanMessage(content="Hi")])).content == "ok"
+    assert llm.llm.calls == 3
+    assert llm.concurrency_controller.limit < 4
+    assert llm.concurrency_controller.in_flight == 0
+
+    llm.llm = FlakyChatModel()
+    llm.overload_retries = 1
+    with pytest.raises(Overloaded):
+        asyncio.run(llm.ainvoke([HumanMessage(content="Hi")]))
+    assert llm.concurrency_controller.in_flight == 0
+
+
+def test_llm_client_choices(monkeypatch):
+    import tiktoken
+    from src.llmexperts.model import LLMClient
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("NEBIUS_API_KEY", "test")
+    choices = ["NA", "1", "2"]
+    llm = LLMClient("claude-3-5-sonnet-20241022", max_tokens=150, choices=choices)
+    assert llm.max_tokens == 5
+    assert llm.bound_kwargs == {}
+
+    llm = LLMClient("meta-llama/Llama-3.3-70B-Instruct", max_tokens=150, choices=choices)
+    assert llm.max_tokens == 5
+    assert llm.bound_kwargs == {"stop": ["\n"]}
+
+    class Encoding:
+        def encode(self, text):
+            return [ord(c) for c in text]
+
+    monkeypatch.setattr(tiktoken, "encoding_for_model", lambda model: Encoding())
+    llm = LLMClient("gpt-4o-2024-11-20", max_tokens=150, choices=choices)
+    assert llm.max_tokens == 2
+    assert llm.bound_kwargs["logit_bias"] == {ord("N"): 100, ord("A"): 100, ord("1"): 100, ord("2"): 100}
+    # The constrained client does not share cached responses with the unconstrained one
+    assert llm.cache_key("prompt") != LLMClient("gpt-4o-2024-11-20", max_tokens=150).cache_key("prompt")
+
+
+def test_llm_client_top_logprobs(monkeypatch):
+    from src.llmexperts.model import LLMClient
+
+    monkeypatch.setenv("NEBIUS_API_KEY", "test")
+    llm = LLMClient("meta-llama/Llama-3.3-70B-Instruct", max_tokens=150, top_logprobs=10)
+    assert llm.bound_kwargs == {"logprobs": True, "top_logprobs": 10}
+    llm = LLMClient("claude-3-5-sonnet-20241022", max_tokens=150, top_logprobs=10)
+    assert llm.bound_kwargs == {}
+
+
+def test_llm_client_adaptive_concurrency(monkeypatch):
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from src.llmexperts.providers import OpenAIProvider, providers, register_provider
+    from src.llmexperts.ratelimit import ConcurrencyController
+
+    class RateLimitedHandler(BaseHTTPRequestHandler):
+        """
+        Answers the first two chat completions with a 429, then with "ok".
+        """
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            self.server.requests += 1
+            if self.server.requests <= 2:
+                status, body = 429, {"error": {"message": "rate limited", "type": "rate_limit_error"}}
+            else:
+                status, body = 200, {
+                    "id": "chatcmpl", "object": "chat.completion", "created": 0, "model": "local-model",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+                }
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("retry-after-ms", "10")
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RateLimitedHandler)
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("LOCAL_API_KEY", "test")
+    register_provider(OpenAIProvider(
+        "local", ["local-model"], base_url=f"http://127.0.0.1:{server.server_address[1]}/v1", api_key_env="LOCAL_API_KEY"
+    ))
+    try:
+        llm = LLMClient("local-model", max_tokens=10, max_retries=7, adaptive_concurrency=True)
+        llm.concurrency_controller = ConcurrencyController(initial=4)
+        assert llm.llm.max_retries == 0
+        assert llm.overload_retries == 7
+        assert llm.invoke([HumanMessage(content="Hi")]).content == "ok"
+        # Every 429 reached the controller instead of being retried by the SDK
+        assert server.requests == 3
+        assert llm.concurrency_controller.limit < 4
+        assert llm.concurrency_controller.in_flight == 0
+    finally:
+        providers.pop("local")
+        server.shutdown()
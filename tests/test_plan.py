@@ -0,0 +1,46 @@
+import os
+
+from src.llmexperts.plan import plan_scale, plan_summarize
+from src.llmexperts.prompts import ScalePromptTemplate
+
+
+def test_plan_scale(summary_file_folder):
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-scale.yaml")
+    models = ["gpt-4o-2024-11-20", "claude-3-5-sonnet-20241022"]
+    plan = plan_scale(os.path.join(summary_file_folder, "*.txt"), models, ["issue_1", "issue_2"], prompt_template)
+
+    n_prompts = len(ScalePromptTemplate.from_file(prompt_template).build_prompt("TEXT", "issue_1"))
+    n_files = len(os.listdir(summary_file_folder))
+    assert plan["model"].tolist() == models
+    assert (plan["requests"] == n_files * 2 * n_prompts).all()
+    assert (plan["output_tokens"] == plan["requests"] * 150).all()
+    assert (plan["input_tokens"] > 0).all()
+    assert (plan["projected_minutes"] > 0).all()
+
+    latency_bound = plan_scale(
+        os.path.join(summary_file_folder, "*.txt"), models, ["issue_1", "issue_2"], prompt_template,
+        concurrency=2, seconds_per_request=60
+    )
+    assert (latency_bound["projected_minutes"] == latency_bound["requests"] / 2).all()
+
+
+def test_plan_summarize():
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-summarize.yaml")
+    path = os.path.join(os.path.dirname(__file__), "texts", "long", "UK - UK 2019 SNP Scotland.txt")
+    with open(path, "r", encoding="utf-8") as f:
+        n_chars = len(f.read())
+
+    plan = plan_summarize(path, prompt_template, ["issue_1"], ["claude-3-5-sonnet-20241022"], chunk_size=n_chars // 4)
+    n_chunks = plan["requests"][0] - 1
+    assert n_chunks >= 4
+    assert plan["output_tokens"][0] == (n_chunks + 1) * 1000
+
+    tree = plan_summarize(
+        path, prompt_template, ["issue_1"], ["claude-3-5-sonnet-20241022"], chunk_size=n_chars // 4,
+        reduce="tree", reduce_token_budget=2000
+    )
+    # Summaries are merged in pairs: n_chunks - 1 merges
+    assert tree["requests"][0] == n_chunks + n_chunks - 1
+
+    whole = plan_summarize(path, prompt_template, ["issue_1"], ["claude-3-5-sonnet-20241022"], chunk_unit="tokens")
+    assert whole["requests"][0] == 1
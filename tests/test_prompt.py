@@ -3,7 +3,7 @@ import os
 
 import pytest
 
-from src.llmexperts.prompts import ScalePromptTemplate, SummarizePromptTemplate
+from src.llmexperts.prompts import ScalePrompt, ScalePromptTemplate, SummarizePromptTemplate
 
 
 def test_summarize_prompt():
@@ -75,3 +75,55 @@ def test_scale_prompt_with_examples():
     assert len(prompts) == 9
     for p in prompts:
         assert len(p.prompt) == 2
+
+def test_scale_prompt_prefix_layout():
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-scale__examples.yaml")
+    scale_prompt_template = ScalePromptTemplate.from_file(prompt_template)
+    prompts = scale_prompt_template.build_prompt("TEST TEXT", "issue_1", use_examples=True, layout="prefix")
+    assert len(prompts) == 9
+    for p in prompts:
+        assert len(p.prompt) == 2*2+3
+        # Every message but the last is shared by all prompts
+        assert p.prompt[:-1] == prompts[0].prompt[:-1]
+        assert p.prompt[0].content == "ISSUE_1 DEFINITION"
+        assert p.prompt[-2].content == "Scale the following political text:\n\nTEST TEXT\n"
+        assert p.prompt[-1].content == f"{p.persona} {p.encouragement}"
+
+    with pytest.raises(ValueError):
+        scale_prompt_template.build_prompt("TEST TEXT", "issue_1", layout="unknown")
+
+def test_scale_prompt_shares_text():
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-scale__examples.yaml")
+    scale_prompt_template = ScalePromptTemplate.from_file(prompt_template)
+    prompts = scale_prompt_template.build_prompt("TEST TEXT", "issue_1", use_examples=True)
+    for p in prompts:
+        assert p.shared is prompts[0].shared
+        assert p.prompt[-1] is prompts[0].prompt[-1]
+
+    p = prompts[4]
+    loaded = ScalePrompt.loads(p.dumps(), p.shared.dumps())
+    assert loaded == p
+    assert loaded.prompt == p.prompt
+    assert "TEST TEXT" not in p.dumps()
+
+def test_scale_prompt_template_is_compiled():
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-scale__examples.yaml")
+    scale_prompt_template = ScalePromptTemplate.from_file(prompt_template)
+    first = scale_prompt_template.build_prompt("TEXT 1", "issue_1", use_examples=True)
+    second = scale_prompt_template.build_prompt("TEXT 2", "issue_1", use_examples=True)
+    for p1, p2 in zip(first, second):
+        # System and example messages are rendered once and reused
+        assert all(m1 is m2 for m1, m2 in zip(p1.prompt[:-1], p2.prompt[:-1]))
+        assert p1.prompt[0].content == scale_prompt_template.system_template.format(
+            persona=p1.persona, encouragement=p1.encouragement,
+            policy_scale=scale_prompt_template.policy_scales["issue_1"]
+        )
+        assert p1.prompt[1].content == scale_prompt_template.human_template.format(text="ISSUE 1 EXAMPLE 1")
+        assert p2.prompt[-1].content == scale_prompt_template.human_template.format(text="TEXT 2")
+
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-summarize.yaml")
+    summarize_prompt_template = SummarizePromptTemplate.from_file(prompt_template)
+    first = summarize_prompt_template.build_prompt("CHUNK 1", ["issue_1", "issue_2"])
+    second = summarize_prompt_template.build_prompt("CHUNK 2", ["issue_1", "issue_2"])
+    assert first[0] is second[0]
+    assert second[1].content == summarize_prompt_template.human_template.format(text="CHUNK 2")
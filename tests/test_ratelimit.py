@@ -0,0 +1,245 @@
+import asyncio
+import math
+import threading
+
+import pytest
+
+from src.llmexperts.ratelimit import RateLimiter, get_rate_limiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limiter_tokens():
+    clock = FakeClock()
+    limiter = RateLimiter(token_limit=100, window=60, clock=clock)
+    first, wait = limiter.try_reserve(60)
+    assert first is not None and wait == 0
+    clock.now = 10
+    second, wait = limiter.try_reserve(30)
+    assert second is not None
+    assert limiter.tokens_used == 90
+
+    # Does not fit until the first reservation leaves the window
+    reservation, wait = limiter.try_reserve(50)
+    assert reservation is None
+    assert wait == 50
+
+    # Settling against the real usage frees budget straight away
+    limiter.settle(first, 10)
+    assert limiter.tokens_used == 40
+    reservation, wait = limiter.try_reserve(50)
+    assert reservation is not None
+
+    clock.now = 61
+    assert limiter.tokens_used == 80
+    # Settling a reservation that already left the window does not change the usage
+    limiter.settle(first, 1000)
+    assert limiter.tokens_used == 80
+
+
+def test_rate_limiter_requests():
+    clock = FakeClock()
+    limiter = RateLimiter(request_limit=2, window=60, clock=clock)
+    assert limiter.try_reserve(1)[0] is not None
+    clock.now = 5
+    assert limiter.try_reserve(1)[0] is not None
+    reservation, wait = limiter.try_reserve(1)
+    assert reservation is None
+    assert wait == 55
+    clock.now = 60
+    assert limiter.try_reserve(1)[0] is not None
+
+
+def test_rate_limiter_oversized_request():
+    clock = FakeClock()
+    limiter = RateLimiter(token_limit=100, window=60, clock=clock)
+    assert limiter.try_reserve(500)[0] is not None
+    reservation, wait = limiter.try_reserve(500)
+    assert reservation is None
+    assert wait == 60
+
+
+def test_rate_limiter_concurrent():
+    limiter = RateLimiter(token_limit=1000, window=0.2)
+
+    def worker():
+        for _ in range(10):
+            limiter.acquire(50)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert limiter.tokens_used <= 1000
+
+    async def main():
+        await asyncio.gather(*[limiter.aacquire(100) for _ in range(20)])
+        return limiter.tokens_used
+
+    assert asyncio.run(main()) <= 1000
+
+
+def test_get_rate_limiter_is_shared():
+    assert get_rate_limiter("claude-3-haiku-20240307") is get_rate_limiter("claude-3-haiku-20240307")
+    assert get_rate_limiter("claude-3-haiku-20240307").token_limit == 200000
+    assert get_rate_limiter("claude-3-haiku-20240307") is not get_rate_limiter("claude-3-opus-20240229")
+
+
+def test_concurrency_controller_aimd():
+    from src.llmexperts.ratelimit import ConcurrencyController
+
+    clock = FakeClock()
+    controller = ConcurrencyController(initial=2, max_limit=4, target_latency=10, clock=clock)
+    assert controller.try_acquire() == 0
+    assert controller.try_acquire() == 0
+    # The limit is reached
+    assert controller.try_acquire() > 0
+
+    # Grows by about one for every `limit` successes
+    controller.release(latency=1)
+    controller.release(latency=1)
+    assert 2.5 < controller.limit < 3
+    for _ in range(20):
+        controller.try_acquire()
+        controller.release(latency=1)
+    assert controller.limit == 4
+
+    # Cut by half on overload, at most once per second
+    controller.try_acquire()
+    controller.try_acquire()
+    controller.release_overloaded()
+    controller.release_overloaded()
+    assert controller.limit == 2
+    clock.now += 2
+    controller.try_acquire()
+    controller.release(latency=20)
+    assert controller.limit == 1
+    assert controller.in_flight == 0
+
+
+def test_concurrency_controller_pause():
+    from src.llmexperts.ratelimit import ConcurrencyController
+
+    clock = FakeClock()
+    controller = ConcurrencyController(initial=4, failure_threshold=3, cooldown=60, clock=clock)
+    controller.try_acquire()
+    controller.release_overloaded(retry_after=5)
+    assert controller.is_open
+    assert controller.try_acquire() == 5
+    clock.now = 5
+    assert controller.try_acquire() == 0
+    controller.release_error()
+
+    # The circuit opens after consecutive overload errors
+    for _ in range(3):
+        controller.try_acquire()
+        controller.release_overloaded()
+    assert controller.try_acquire() == 60
+    assert controller.limit == controller.min_limit
+    clock.now = 66
+    assert controller.try_acquire() == 0
+    controller.release()
+    assert controller.consecutive_failures == 0
+
+
+def test_concurrency_controller_wakes_waiters():
+    from src.llmexperts.ratelimit import ConcurrencyController
+
+    controller = ConcurrencyController(initial=1, max_limit=1)
+    assert controller.try_acquire() == 0
+    assert controller.try_acquire() == math.inf
+    # A fixed concurrency is not capped by the adaptive limit
+    assert controller.try_acquire(adaptive=False) == 0
+    controller.release_error()
+
+    async def wait_for_slot():
+        waiter = asyncio.create_task(controller.aacquire())
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        # The waiter is woken by the release, from another thread
+        threading.Thread(target=controller.release).start()
+        await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(wait_for_slot())
+    assert controller.in_flight == 1
+
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (controller.acquire(), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.05)
+    controller.release()
+    assert acquired.wait(1)
+    thread.join()
+    assert controller.in_flight == 1
+
+def test_retry_after_seconds():
+    from src.llmexperts.ratelimit import retry_after_seconds
+
+    class Response:
+        def __init__(self, headers):
+            self.headers = headers
+
+    class Error(Exception):
+        def __init__(self, headers):
+            self.response = Response(headers)
+
+    assert retry_after_seconds(Error({"retry-after": "7"})) == 7
+    assert retry_after_seconds(Error({"retry-after-ms": "1500", "retry-after": "7"})) == 1.5
+    assert retry_after_seconds(Error({})) is None
+    assert retry_after_seconds(Error({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0
+    assert retry_after_seconds(ValueError()) is None
+
+
+def test_default_request_limits():
+    from src.llmexperts import per_minute_token_limit, per_minute_request_limit
+    from src.llmexperts.ratelimit import get_rate_limiter
+
+    assert set(per_minute_request_limit) == set(per_minute_token_limit)
+    assert get_rate_limiter("claude-3-haiku-20240307").request_limit == per_minute_request_limit["claude-3-haiku-20240307"]
+    # Dated models get the limits of their family
+    assert get_rate_limiter("gpt-4o-2024-11-20").request_limit == per_minute_request_limit["gpt-4o"]
+    assert get_rate_limiter("gpt-4o-2024-11-20").token_limit == per_minute_token_limit["gpt-4o"]
+    assert get_rate_limiter("claude-3-5-sonnet-20241022").request_limit is not None
+
+
+def test_model_limit():
+    from src.llmexperts.ratelimit import model_limit
+
+    limits = {"gpt-4o": 10, "gpt-4o-mini": 20, "gpt-4o-2024-11-20": 30}
+    assert model_limit(limits, "gpt-4o-2024-11-20") == 30
+    assert model_limit(limits, "gpt-4o-2024-08-06") == 10
+    assert model_limit(limits, "gpt-4o-mini-2024-07-18") == 20
+    assert model_limit(limits, "gpt-4", 5) == 5
+    assert model_limit(limits, "gpt-4") is None
+
+
+def test_failed_request_releases_tokens(monkeypatch):
+    from langchain_core.messages import HumanMessage
+    from src.llmexperts.model import LLMClient
+
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    llm = LLMClient("claude-3-haiku-20240307", max_tokens=100)
+    llm.rate_limiter = RateLimiter(token_limit=1000, request_limit=10)
+
+    def fail(prompt):
+        raise ValueError("bad request")
+
+    async def afail(prompt):
+        fail(prompt)
+
+    monkeypatch.setattr(llm, "_invoke_llm", fail)
+    monkeypatch.setattr(llm, "_ainvoke_llm", afail)
+    with pytest.raises(ValueError):
+        llm.invoke([HumanMessage(content="Hi")])
+    with pytest.raises(ValueError):
+        asyncio.run(llm.ainvoke([HumanMessage(content="Hi")]))
+    # The failed requests count against the request limit, but their estimated tokens are released
+    assert llm.rate_limiter.tokens_used == 0
+    assert llm.rate_limiter.requests_used == 2
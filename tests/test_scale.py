@@ -98,3 +98,465 @@ def test_scale_file_use_examples(output_folder, summary_file_folder):
 
     df = pd.read_csv(os.path.join(output_folder, "scale_results.csv"))
     assert df.shape[0] == len(filenames)*len(model_list)*len(issue_list)
+
+
+def test_ascale_text_with_batch_order():
+    import asyncio
+    from src.llmexperts.scale import ascale_text_with_batch, scale_text_with_batch
+    from src.llmexperts.prompts import ScalePromptTemplate
+
+    prompt_template = ScalePromptTemplate.from_file(os.path.join(os.path.dirname(__file__), "prompts-scale.yaml"))
+    prompts = prompt_template.build_prompt("TEST TEXT", "issue_1")
+    results = asyncio.run(ascale_text_with_batch(prompts, "claude-3-5-sonnet-20241022", concurrency=2, dry_run=True))
+    assert len(results) == len(prompts)
+    for r, p in zip(results, prompts):
+        assert r["score"] == "NA"
+        assert r["persona"] == p.persona_idx
+        assert r["encouragement"] == p.encouragement_idx
+
+    sync_results = scale_text_with_batch(prompts, "claude-3-5-sonnet-20241022", concurrency=2, dry_run=True)
+    assert [r["persona"] for r in sync_results] == [r["persona"] for r in results]
+
+
+def test_scale_file_log_format(output_folder, summary_file_folder):
+    import ast
+    import json
+    from src.llmexperts.prompts import ScalePrompt
+    from src.llmexperts.scale import make_log_filepath
+
+    model_list = ["claude-3-5-sonnet-20241022"]
+    issue_list = ["issue_1", "issue_2"]
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-scale.yaml")
+    file_path = os.path.join(summary_file_folder, os.listdir(summary_file_folder)[0])
+
+    scale_file(file_path, model_list, issue_list, prompt_template, output_dir=output_folder,
+               results_filename="inline.csv", dry_run=True)
+    df = pd.read_csv(os.path.join(output_folder, "inline.csv"))
+    # Each row only logs its own responses
+    for responses in df["responses"]:
+        assert len(ast.literal_eval(responses)) == 1
+    # The shared text is only written in the first row of each issue
+    assert df["shared_prompt"].notna().sum() == len(issue_list)
+    first_rows = df[df["shared_prompt"].notna()]
+    prompt = ScalePrompt.loads(first_rows["prompt"].iloc[0], first_rows["shared_prompt"].iloc[0])
+    assert prompt.prompt[-1].content.startswith("Scale the following political text:")
+
+    results_filepath = os.path.join(output_folder, "scale_results.csv")
+    scale_file(file_path, model_list, issue_list, prompt_template, output_dir=output_folder,
+               dry_run=True, log_format="jsonl")
+    df = pd.read_csv(results_filepath)
+    assert "prompt" not in df.columns
+    assert "responses" not in df.columns
+    with open(make_log_filepath(results_filepath), "r", encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    logs = [line for line in lines if "row_id" in line]
+    shared = {line["shared_id"]: line["messages"] for line in lines if "shared_id" in line}
+    assert len(logs) == df.shape[0] == len(issue_list) * 9
+    # The text is written once per issue, and referenced by each prompt.
+    # The shared messages are the same for both issues, as the issue is in the system message.
+    assert sum("shared_id" in line for line in lines) == len(issue_list)
+    assert len(shared) == 1
+    for log in logs:
+        assert log["prompt"]["shared_id"] in shared
+    assert [log["row_id"] for log in logs] == df["row_id"].tolist()
+    for log in logs:
+        assert len(log["responses"]) == 1
+        assert log["responses"][0]["kwargs"]["content"] == "NA"
+
+
+def test_scale_result_index(output_folder):
+    from src.llmexperts.scale import ScaleResultIndex
+
+    results_filepath = os.path.join(output_folder, "scale_results.csv")
+    index = ScaleResultIndex(results_filepath)
+    index.refresh()
+    assert len(index) == 0
+
+    df = pd.DataFrame({
+        "file": ["a.txt", "a.txt"], "issue": ["issue_1", "issue_1"], "scale_model": ["m", "m"],
+        "score": ["1", "2"], "persona": [0, 1], "encouragement": [0, 0], "prompt": ["multi\nline", "x"]
+    })
+    df.to_csv(results_filepath, index=False)
+    index.refresh()
+    assert len(index) == 2
+    assert ("a.txt", "issue_1", "m", 0, 0) in index
+    assert ("a.txt", "issue_1", "m", 2, 0) not in index
+
+    # Rows appended by other writers are picked up incrementally
+    df.assign(persona=[2, 3]).to_csv(results_filepath, mode="a", header=False, index=False)
+    index.refresh()
+    assert len(index) == 4
+    assert ("a.txt", "issue_1", "m", 3, 0) in index
+
+    size_before = os.path.getsize(results_filepath)
+    appended = df.assign(persona=[4, 5])
+    appended.to_csv(results_filepath, mode="a", header=False, index=False)
+    index.add_appended(
+        appended[list(ScaleResultIndex.key_columns)].itertuples(index=False, name=None),
+        size_before, os.path.getsize(results_filepath)
+    )
+    assert len(index) == 6
+    index.refresh()
+    assert len(index) == 6
+
+    # Rebuilt when the file is replaced
+    df.to_csv(results_filepath, index=False)
+    index.refresh()
+    assert len(index) == 2
+
+    # A torn last row is dropped before appending, so rows never merge with it
+    from src.llmexperts.sinks import CSVSink
+    with open(results_filepath, "a", encoding="utf-8") as f:
+        f.write("a.txt,issue_1,m,3,")
+    CSVSink(results_filepath, result_index=index).write(df.assign(persona=[6, 7]))
+    saved = pd.read_csv(results_filepath)
+    assert saved["persona"].tolist() == [0, 1, 6, 7]
+    assert len(index) == 4
+    index.refresh()
+    assert len(index) == 4
+
+    # Rebuilt when the file was replaced by a larger one, whose rows do not end at the stored offset
+    offset = os.path.getsize(results_filepath)
+    df.assign(persona=[8, 9], prompt=["y" * 100, "x"]).to_csv(results_filepath, index=False)
+    with open(results_filepath, "rb") as f:
+        f.seek(offset - 1)
+        assert f.read(1) != b"\n"
+    index.refresh()
+    assert ("a.txt", "issue_1", "m", 8, 0) in index
+    assert ("a.txt", "issue_1", "m", 6, 0) not in index
+
+
+def test_csv_sink_existing_columns(output_folder, summary_file_folder, monkeypatch):
+    from src.llmexperts.sinks import CSVSink, get_result_index
+
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    model = "claude-3-5-sonnet-20241022"
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-scale.yaml")
+    filenames = sorted(os.listdir(summary_file_folder))
+    results_filepath = os.path.join(output_folder, "scale_results.csv")
+    # A results file written before the shared_prompt column existed
+    old_columns = [
+        "file", "issue", "scale_model", "score", "created_at", "persona", "encouragement",
+        "error_message", "prompt", "responses"
+    ]
+    old_df = pd.DataFrame([[filenames[0], "issue_1", model, "4", "2024-01-01", 0, 0, "", "[]", "[]"]], columns=old_columns)
+    old_df.to_csv(results_filepath, index=False)
+
+    df = scale_file(
+        os.path.join(summary_file_folder, filenames[1]), [model], ["issue_1"], prompt_template,
+        output_dir=output_folder, dry_run=True
+    )
+    saved = pd.read_csv(results_filepath, dtype=str, keep_default_na=False)
+    assert list(saved.columns[:len(old_columns)]) == old_columns
+    assert "shared_prompt" in saved.columns
+    assert saved.shape[0] == df.shape[0] + 1
+    assert saved["score"].tolist() == ["4"] + ["NA"] * df.shape[0]
+    # The index of existing results is rebuilt after the rewrite
+    assert (filenames[0], "issue_1", model, 0, 0) in get_result_index(results_filepath)
+    assert (filenames[1], "issue_1", model, 0, 0) in get_result_index(results_filepath)
+
+    # Rows missing some columns of the file are aligned with its header
+    sink = CSVSink(results_filepath)
+    sink.write(pd.DataFrame({"score": ["5"], "file": ["b.txt"]}))
+    saved = pd.read_csv(results_filepath, dtype=str, keep_default_na=False)
+    assert saved.shape[0] == df.shape[0] + 2
+    assert saved.iloc[-1]["file"] == "b.txt"
+    assert saved.iloc[-1]["score"] == "5"
+
+
+def test_scale_corpus(output_folder, summary_file_folder, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    import asyncio
+    from langchain.schema import AIMessage
+    from src.llmexperts.model import LLMClient
+    from src.llmexperts.scale import scale_corpus
+
+    model_list = ["gpt-4o-2024-11-20", "claude-3-5-sonnet-20241022"]
+    issue_list = ["issue_1", "issue_2"]
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-scale.yaml")
+    filenames = os.listdir(summary_file_folder)
+
+    in_flight = {model: 0 for model in model_list}
+    max_in_flight = {model: 0 for model in model_list}
+
+    async def ainvoke(self, prompt, dry_run=False, dry_run_res=None, refresh_cache=False):
+        in_flight[self.model] += 1
+        max_in_flight[self.model] = max(max_in_flight[self.model], in_flight[self.model])
+        # The OpenAI lane is slow, which must not hold back the Claude lane
+        await asyncio.sleep(0.02 if self.model.startswith("gpt") else 0.001)
+        in_flight[self.model] -= 1
+        return AIMessage(content="3")
+
+    monkeypatch.setattr(LLMClient, "ainvoke", ainvoke)
+    df = scale_corpus(
+        os.path.join(summary_file_folder, "*.txt"), model_list, issue_list, prompt_template,
+        output_dir=output_folder, concurrency=2, provider_concurrency={"openai": 4}
+    )
+    n_rows = len(filenames) * len(model_list) * len(issue_list) * 9
+    assert df.shape[0] == n_rows
+    assert (df["score"] == "3").all()
+    assert max_in_flight == {"gpt-4o-2024-11-20": 4, "claude-3-5-sonnet-20241022": 2}
+    # The fast lane is not held back by the slow one
+    first_half = df["scale_model"].iloc[:df.shape[0] // 2]
+    assert (first_half == "claude-3-5-sonnet-20241022").sum() > (first_half == "gpt-4o-2024-11-20").sum()
+
+    df = pd.read_csv(os.path.join(output_folder, "scale_results.csv"))
+    assert df.shape[0] == n_rows
+    assert df.groupby(["file", "issue", "scale_model"]).size().eq(9).all()
+
+    # Everything exists already
+    assert scale_corpus(
+        [os.path.join(summary_file_folder, f) for f in filenames], model_list, issue_list, prompt_template,
+        output_dir=output_folder
+    ) is None
+    assert pd.read_csv(os.path.join(output_folder, "scale_results.csv")).shape[0] == n_rows
+
+
+def test_scale_corpus_parse_retry_releases_lane(output_folder, summary_file_folder, monkeypatch):
+    import asyncio
+    from langchain_core.messages import AIMessage
+    from src.llmexperts.model import LLMClient
+    from src.llmexperts.scale import scale_corpus
+
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-scale.yaml")
+    file_path = os.path.join(summary_file_folder, os.listdir(summary_file_folder)[0])
+    calls = []
+
+    async def ainvoke(self, prompt, dry_run=False, dry_run_res=None, refresh_cache=False):
+        calls.append(refresh_cache)
+        await asyncio.sleep(0.001)
+        # Only the first response cannot be parsed
+        return AIMessage(content="I cannot answer" if len(calls) == 1 else "3")
+
+    monkeypatch.setattr(LLMClient, "ainvoke", ainvoke)
+    df = scale_corpus(
+        [file_path], ["claude-3-5-sonnet-20241022"], ["issue_1"], prompt_template,
+        output_dir=output_folder, concurrency=1
+    )
+    assert (df["score"] == "3").all()
+    # The other prompts are invoked on the single lane during the backoff of the retry
+    assert calls == [False] * 9 + [True]
+
+
+def test_scale_corpus_reads_files_lazily(output_folder, summary_file_folder, monkeypatch):
+    from langchain_core.messages import AIMessage
+    from src.llmexperts.model import LLMClient
+    from src.llmexperts.prompts import ScalePromptTemplate
+    from src.llmexperts.scale import scale_corpus
+
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-scale.yaml")
+    issue_list = ["issue_1", "issue_2"]
+    n_files = len(os.listdir(summary_file_folder))
+    built = []
+    built_at_first_call = []
+    build_prompt = ScalePromptTemplate.build_prompt
+
+    def counting_build_prompt(self, text, issue, **kwargs):
+        built.append(issue)
+        return build_prompt(self, text, issue, **kwargs)
+
+    async def ainvoke(self, prompt, dry_run=False, dry_run_res=None, refresh_cache=False):
+        if not built_at_first_call:
+            built_at_first_call.append(len(built))
+        return AIMessage(content="3")
+
+    monkeypatch.setattr(ScalePromptTemplate, "build_prompt", counting_build_prompt)
+    monkeypatch.setattr(LLMClient, "ainvoke", ainvoke)
+    df = scale_corpus(
+        os.path.join(summary_file_folder, "*.txt"), ["claude-3-5-sonnet-20241022"], issue_list, prompt_template,
+        output_dir=output_folder, concurrency=1
+    )
+    assert df.shape[0] == n_files * len(issue_list) * 9
+    assert len(built) == n_files * len(issue_list)
+    # Scaling starts before the prompts of the whole corpus are built
+    assert built_at_first_call[0] < len(built)
+
+
+def test_scale_file_prompt_cache(output_folder, summary_file_folder):
+    from src.llmexperts.scale import scale_file
+
+    filename = os.listdir(summary_file_folder)[0]
+    df = scale_file(
+        os.path.join(summary_file_folder, filename), ["claude-3-5-sonnet-20241022"], ["issue_1"],
+        os.path.join(os.path.dirname(__file__), "prompts-scale.yaml"), output_dir=output_folder,
+        dry_run=True, prompt_cache=True
+    )
+    assert df.shape[0] == 9
+    assert (df["cache_read_tokens"] == 0).all()
+    results = pd.read_csv(os.path.join(output_folder, "scale_results.csv"))
+    assert "cache_read_tokens" in results.columns
+
+
+def test_scale_file_parquet_sink(output_folder, summary_file_folder, monkeypatch):
+    pytest.importorskip("pyarrow")
+    from src.llmexperts.prompts import ScalePrompt
+    from src.llmexperts.sinks import ParquetSink
+
+    monkeypatch.setenv("NEBIUS_API_KEY", "test")
+    # A model name with a "/" checks the partition paths are escaped
+    model_list = ["claude-3-5-sonnet-20241022", "meta-llama/Llama-3.3-70B-Instruct"]
+    issue_list = ["issue_1", "issue_2"]
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-scale.yaml")
+    file_path = os.path.join(summary_file_folder, os.listdir(summary_file_folder)[0])
+
+    sink = ParquetSink(os.path.join(output_folder, "results"), buffer_rows=20)
+    scale_file(file_path, model_list, issue_list, prompt_template, output_dir=output_folder,
+               dry_run=True, sink=sink)
+    scores = sink.read(columns=["issue", "scale_model", "persona", "encouragement", "row_id"])
+    assert scores.shape[0] == len(model_list) * len(issue_list) * 9
+    assert set(scores["scale_model"]) == set(model_list)
+    assert sink.read(columns=["row_id"], issue="issue_1").shape[0] == len(model_list) * 9
+    assert sink.read(columns=["row_id"], scale_model=["meta-llama/Llama-3.3-70B-Instruct"]).shape[0] == \
+        len(issue_list) * 9
+
+    logs = sink.read_log(row_ids=scores["row_id"].iloc[:3])
+    assert logs.shape[0] == 3
+    shared = sink.read_log()["shared_prompt"].dropna()
+    prompt = ScalePrompt.loads(logs["prompt"].iloc[0], shared.iloc[0])
+    assert prompt.prompt[-1].content.startswith("Scale the following political text:")
+
+    # A new sink on the same directory only reads the key columns to skip existing results
+    sink = ParquetSink(os.path.join(output_folder, "results"))
+    scale_file(file_path, model_list, issue_list, prompt_template, output_dir=output_folder,
+               dry_run=True, sink=sink, skip_existing_scale_results=True)
+    assert sink.read(columns=["row_id"]).shape[0] == len(model_list) * len(issue_list) * 9
+
+
+def test_ascale_text_with_batch_parse_retries(monkeypatch):
+    import asyncio
+    from langchain_core.messages import AIMessage
+    from src.llmexperts.model import LLMClient
+    from src.llmexperts.prompts import ScalePromptTemplate
+    from src.llmexperts.scale import ascale_text_with_batch
+
+    prompt_template = ScalePromptTemplate.from_file(os.path.join(os.path.dirname(__file__), "prompts-scale.yaml"))
+    prompts = prompt_template.build_prompt("TEST TEXT", "issue_1")
+    calls = {}
+    in_flight = [0]
+    max_in_flight = [0]
+
+    async def ainvoke(self, prompt, dry_run=False, dry_run_res=None, refresh_cache=False):
+        key = tuple(m.content for m in prompt)
+        calls[key] = calls.get(key, 0) + 1
+        in_flight[0] += 1
+        max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        # The first prompt never gives a score, every other one gives a score on its second attempt
+        if key == tuple(m.content for m in prompts[0].prompt) or calls[key] == 1:
+            return AIMessage(content="I cannot answer")
+        return AIMessage(content="4")
+
+    monkeypatch.setattr(LLMClient, "ainvoke", ainvoke)
+    results = asyncio.run(ascale_text_with_batch(
+        prompts, "claude-3-5-sonnet-20241022", parse_retries=2, concurrency=4, parse_retry_backoff=0,
+        res_persona="text", res_encouragement="text"
+    ))
+    assert [r["score"] for r in results] == ["ERR"] + ["4"] * (len(prompts) - 1)
+    assert isinstance(results[0]["error_message"], ValueError)
+    for r, p in zip(results, prompts):
+        assert r["persona"] == p.persona
+        assert r["encouragement"] == p.encouragement
+    assert len(results[0]["responses"]) == 3
+    assert all(len(r["responses"]) == 2 for r in results[1:])
+    # The failed prompts are retried together, not one at a time
+    assert max_in_flight[0] == 4
+
+
+def test_extract_score():
+    from src.llmexperts.scale import extract_score
+
+    assert extract_score("5") == "5"
+    assert extract_score(" NA\n") == "NA"
+    assert extract_score("**6**") == "6"
+    assert extract_score("Score: 2.") == "2"
+    assert extract_score("n/a") == "NA"
+    assert extract_score("8") is None
+    assert extract_score("3 or 4") is None
+    assert extract_score("I would rate this text a 4 because") is None
+
+
+
+def test_parse_scale_response_strict():
+    from langchain_core.messages import AIMessage
+    from src.llmexperts.prompts import ScalePromptTemplate
+    from src.llmexperts.scale import parse_scale_response
+
+    prompt_template = ScalePromptTemplate.from_file(os.path.join(os.path.dirname(__file__), "prompts-scale.yaml"))
+    prompt = prompt_template.build_prompt("TEST TEXT", "issue_1")[0]
+    model = "claude-3-5-sonnet-20241022"
+    assert parse_scale_response(AIMessage(content=" 5\n"), prompt, model)["score"] == "5"
+    # Decorated scores are only accepted in the score-only mode
+    with pytest.raises(ValueError):
+        parse_scale_response(AIMessage(content="**5**"), prompt, model)
+    assert parse_scale_response(AIMessage(content="**5**"), prompt, model, tolerant=True)["score"] == "5"
+
+def test_score_distribution():
+    import math
+    from langchain_core.messages import AIMessage
+    from src.llmexperts.prompts import ScalePromptTemplate
+    from src.llmexperts.scale import parse_scale_response, score_distribution
+
+    prompt_template = ScalePromptTemplate.from_file(os.path.join(os.path.dirname(__file__), "prompts-scale.yaml"))
+    prompt = prompt_template.build_prompt("TEST TEXT", "issue_1")[0]
+    top_logprobs = [
+        {"token": "4", "logprob": math.log(0.6)}, {"token": "5", "logprob": math.log(0.2)},
+        {"token": "NA", "logprob": math.log(0.1)}, {"token": "Four", "logprob": math.log(0.1)},
+    ]
+    response = AIMessage(content="4", response_metadata={"logprobs": {"content": [
+        {"token": "4", "logprob": math.log(0.6), "top_logprobs": top_logprobs}
+    ]}})
+    result = parse_scale_response(
+        response, prompt, "meta-llama/Llama-3.3-70B-Instruct", probabilities=True, top_logprobs=4
+    )
+    assert result["score"] == "4"
+    assert math.isclose(result["prob"], 0.6)
+    # Renormalized over the scores, "Four" is not a score
+    assert math.isclose(result["prob_4"], 2 / 3)
+    assert math.isclose(result["prob_NA"], 1 / 9)
+    assert result["prob_7"] == 0
+    assert math.isclose(result["expected_score"], 4.25)
+    probs = [2 / 3, 2 / 9, 1 / 9]
+    assert math.isclose(result["entropy"], -sum(p * math.log2(p) for p in probs))
+
+    assert score_distribution(None)["expected_score"] is None
+    result = parse_scale_response(AIMessage(content="NA"), prompt, "claude-3-5-sonnet-20241022", top_logprobs=4)
+    assert result["prob_NA"] is None
+
+
+def test_scale_file_cascade(output_folder, summary_file_folder, monkeypatch):
+    from langchain_core.messages import AIMessage
+    from src.llmexperts.model import LLMClient
+
+    model_list = ["claude-3-haiku-20240307", "claude-3-5-sonnet-20241022"]
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-scale.yaml")
+    filepath = os.path.join(summary_file_folder, sorted(os.listdir(summary_file_folder))[0])
+    calls = {model: 0 for model in model_list}
+
+    async def ainvoke(self, prompt, dry_run=False, dry_run_res=None, refresh_cache=False):
+        calls[self.model] += 1
+        # The cheap model disagrees with itself on the first persona only
+        if self.model == model_list[0] and "PERSONA_1" in prompt[0].content:
+            return AIMessage(content="6")
+        return AIMessage(content="3")
+
+    monkeypatch.setattr(LLMClient, "ainvoke", ainvoke)
+    df = scale_file(
+        filepath, model_list, ["issue_1"], prompt_template, output_dir=output_folder, cascade=True
+    )
+    n_prompts = df.shape[0]
+    n_escalated = calls[model_list[1]]
+    assert calls[model_list[0]] == n_prompts
+    assert n_escalated == n_prompts // 3
+    assert (df["score"] == "3").all()
+    assert (df.loc[df["tier"] == 1, "scale_model"] == model_list[1]).sum() == n_escalated
+    assert (df.loc[df["tier"] == 0, "confidence"] >= 0.6).all()
+
+    saved = pd.read_csv(os.path.join(output_folder, "scale_results.csv"))
+    assert saved.shape[0] == n_prompts
+    assert sorted(saved["tier"].unique()) == [0, 1]
+
+    # Every prompt has been answered by a tier of the cascade
+    assert scale_file(
+        filepath, model_list, ["issue_1"], prompt_template, output_dir=output_folder, cascade=True
+    ) is None
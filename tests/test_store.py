@@ -0,0 +1,62 @@
+import os
+import threading
+
+import pandas as pd
+
+from src.llmexperts.store import SQLiteSink, close_connection, get_results, store_results
+
+
+def make_scores(issue, n, model="gpt-4o"):
+    return pd.DataFrame({
+        "file": ["text_1.txt"] * n,
+        "issue": [issue] * n,
+        "scale_model": [model] * n,
+        "score": list(range(n)),
+        "persona": list(range(n)),
+        "encouragement": [0] * n,
+        "row_id": [f"{issue}-{model}-{i}" for i in range(n)],
+    })
+
+
+def test_sqlite_sink(output_folder):
+    db_path = os.path.join(output_folder, "results.db")
+    sink = SQLiteSink(db_path)
+    assert ("text_1.txt", "issue_1", "gpt-4o", 0, 0) not in sink
+
+    scores = make_scores("issue_1", 5)
+    log = pd.DataFrame({
+        "row_id": scores["row_id"], "prompt": ['{"message": []}'] * 5, "responses": [['{"content": "1"}']] * 5
+    })
+    sink.write(scores, log)
+    # A column missing from the table is added
+    sink.write(make_scores("issue_2", 3).assign(cache_read_tokens=10))
+
+    assert ("text_1.txt", "issue_1", "gpt-4o", 0, 0) in sink
+    assert ("text_1.txt", "issue_1", "gpt-4o", "4", "0") in sink
+    assert ("text_1.txt", "issue_1", "gpt-4o", 5, 0) not in sink
+
+    df = sink.read(columns=["issue", "score"], issue="issue_1")
+    assert df.columns.tolist() == ["issue", "score"]
+    assert df["score"].tolist() == list(range(5))
+    assert sink.read(columns=["row_id"], issue=["issue_1", "issue_2"]).shape[0] == 8
+    assert sink.read()["cache_read_tokens"].notna().sum() == 3
+    assert [c.shape[0] for c in sink.iter_read(columns=["row_id"], chunksize=3)] == [3, 3, 2]
+    assert sink.read_log(row_ids=scores["row_id"][:2]).shape[0] == 2
+    assert get_results(db_path, columns=["row_id"], issue="issue_2").shape[0] == 3
+    close_connection(db_path)
+
+
+def test_sqlite_sink_concurrent_writes(output_folder):
+    db_path = os.path.join(output_folder, "results.db")
+    sinks = [SQLiteSink(db_path) for _ in range(4)]
+    threads = [
+        threading.Thread(target=lambda s=s, i=i: [s.write(make_scores(f"issue_{i}_{j}", 10)) for j in range(5)])
+        for i, s in enumerate(sinks)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    store_results(make_scores("issue_x", 2), db_path=db_path)
+    assert sinks[0].read(columns=["row_id"]).shape[0] == 4 * 5 * 10 + 2
+    close_connection(db_path)
@@ -9,7 +9,8 @@ from src.llmexperts.summarize import summarize_file
 
 load_dotenv()
 
-def test_summarize_file_output(text_file_folder, capfd):
+def test_summarize_file_output(text_file_folder, capfd, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
 
     prompt_template = os.path.join(os.path.dirname(__file__), "prompts-summarize.yaml")
     input_filenames = os.listdir(text_file_folder)
@@ -89,7 +90,8 @@ def test_summarize_file_output(text_file_folder, capfd):
     shutil.rmtree(output_folder)
     shutil.rmtree(log_dir)
 
-def test_summarize_file_single_issue_dry_run(output_folder, text_file_folder):
+def test_summarize_file_single_issue_dry_run(output_folder, text_file_folder, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
     prompt_template = os.path.join(os.path.dirname(__file__), "prompts-summarize.yaml")
     input_filenames = os.listdir(text_file_folder)
     common_args = dict(
@@ -125,7 +127,8 @@ def test_summarize_file_single_issue_dry_run(output_folder, text_file_folder):
                 assert os.path.isfile(os.path.join(output_folder, f"summary_standard__{model}__{iss}__{filename}")) == True
                 assert os.path.isfile(os.path.join(output_folder, f"log_summary_standard__{model}__{iss}__{os.path.splitext(filename)[0]}.json")) == True
 
-def test_summarize_file_multi_issue_dry_run(output_folder, text_file_folder):
+def test_summarize_file_multi_issue_dry_run(output_folder, text_file_folder, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
     prompt_template = os.path.join(os.path.dirname(__file__), "prompts-summarize.yaml")
     input_filenames = os.listdir(text_file_folder)
     common_args = dict(
@@ -159,7 +162,8 @@ def test_summarize_file_multi_issue_dry_run(output_folder, text_file_folder):
             assert os.path.isfile(os.path.join(output_folder, f"summary_standard__{model}__multi__{filename}")) == True
             assert os.path.isfile(os.path.join(output_folder, f"log_summary_standard__{model}__multi__{os.path.splitext(filename)[0]}.json")) == True
 
-def test_summarize_file_multi_issue_dry_run_log_folder(output_folder, text_file_folder):
+def test_summarize_file_multi_issue_dry_run_log_folder(output_folder, text_file_folder, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
     prompt_template = os.path.join(os.path.dirname(__file__), "prompts-summarize.yaml")
     input_filenames = os.listdir(text_file_folder)
     common_args = dict(
@@ -361,3 +365,97 @@ def test_summarize_file_very_long(output_folder, capfd):
                     assert len(content["responses"]) == 1
                 assert content["responses"][0]["kwargs"]["usage_metadata"]["input_tokens"] > 0
                 assert content["responses"][0]["kwargs"]["usage_metadata"]["output_tokens"] > 0
+
+
+def test_summarize_text_concurrent_chunks(monkeypatch):
+    import random
+    import threading
+    import time
+    from langchain.schema import AIMessage
+    from src.llmexperts.model import LLMClient
+    from src.llmexperts.summarize import summarize_text
+
+    lock = threading.Lock()
+    state = {"in_flight": 0, "max_in_flight": 0}
+
+    def invoke(self, prompt, dry_run=False, dry_run_res=None, refresh_cache=False):
+        with lock:
+            state["in_flight"] += 1
+            state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        time.sleep(random.random() / 50)
+        with lock:
+            state["in_flight"] -= 1
+        return AIMessage(content=prompt[-1].content.split()[1])
+
+    monkeypatch.setattr(LLMClient, "invoke", invoke)
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-summarize.yaml")
+    text = " ".join(f"chunk{i:02d}" for i in range(12))
+    summary = summarize_text(
+        text, prompt_template, "claude-3-5-sonnet-20241022", ["issue_1"],
+        chunk_size=8, overlap=0, concurrency=4
+    )
+    assert state["max_in_flight"] == 4
+    assert len(summary.responses) == 13
+    assert [r.content for r in summary.responses[:12]] == [f"chunk{i:02d}" for i in range(12)]
+    # The final prompt combines the chunk summaries in order
+    assert summary.final_summary == "chunk00"
+
+
+def test_summarize_text_tree_reduce(monkeypatch):
+    from langchain.schema import AIMessage
+    from src.llmexperts.model import LLMClient
+    from src.llmexperts.summarize import summarize_text, group_summaries
+
+    assert group_summaries([11, 11, 11, 51], token_budget=25) == [[0, 1], [2], [3]]
+    assert group_summaries([30, 30, 30], token_budget=25) == [[0, 1], [2]]
+
+    prompts = []
+
+    def invoke(self, prompt, dry_run=False, dry_run_res=None, refresh_cache=False):
+        prompts.append(prompt[-1].content)
+        # A summary of 14 tokens for the Claude approximation, so that only two summaries fit in the budget
+        # once the margin of the approximation is taken off
+        return AIMessage(content="s" * 80)
+
+    monkeypatch.setattr(LLMClient, "invoke", invoke)
+    prompt_template = os.path.join(os.path.dirname(__file__), "prompts-summarize.yaml")
+    text = " ".join(f"chunk{i:02d}" for i in range(5))
+    summary = summarize_text(
+        text, prompt_template, "claude-3-5-sonnet-20241022", ["issue_1"],
+        chunk_size=8, overlap=0, reduce="tree", reduce_token_budget=50
+    )
+    # 5 chunk summaries -> 3 -> 2 -> 1, with at most two summaries in each merge
+    assert len(summary.responses) == 5 + 2 + 1 + 1
+    assert all(p.count("s" * 80) <= 2 for p in prompts[5:])
+    assert summary.final_summary == summary.responses[-1].content
+
+
+def test_split_text_by_tokens(monkeypatch):
+    from src.llmexperts import summarize
+    from src.llmexperts.summarize import split_text_by_tokens
+    from src.llmexperts.utils import estimate_tokens
+
+    # Count with the estimate whatever tokenizers are available
+    monkeypatch.setattr(summarize, "get_token_counter", lambda model: estimate_tokens)
+
+    text = " ".join(f"word{i:04d}" for i in range(1000))
+    # The whole text fits in the context window of the model
+    assert split_text_by_tokens(text, "claude-3-5-sonnet-20241022") == [text]
+
+    chunks = split_text_by_tokens(text, "claude-3-5-sonnet-20241022", chunk_size=1000, overlap=50)
+    # 2500 tokens in chunks of at most 1000 tokens with 50 tokens overlap: 3 even chunks
+    assert len(chunks) == 3
+    assert all(estimate_tokens(c) <= 1000 for c in chunks)
+    assert max(estimate_tokens(c) for c in chunks) - min(estimate_tokens(c) for c in chunks) < 50
+
+    # The chunks never exceed the context window of the model,
+    # with half of it kept free as the estimate can under-count
+    chunks = split_text_by_tokens(text * 10, "gpt-4", chunk_size=100000, reserved_tokens=1000)
+    assert all(estimate_tokens(c) <= 8192 // 2 - 1000 for c in chunks)
+    assert len(chunks) == 8
+    chunks = split_text_by_tokens(text * 10, "gpt-4", chunk_size=100000, reserved_tokens=1000, safety_margin=0.05)
+    assert all(estimate_tokens(c) <= 8192 - 1000 for c in chunks)
+    assert len(chunks) == 4
+
+    with pytest.raises(ValueError):
+        split_text_by_tokens(text, "gpt-4", chunk_size=100, overlap=100)
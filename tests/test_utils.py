@@ -0,0 +1,49 @@
+import pytest
+
+from src.llmexperts.utils import (
+    approximate_claude_tokens, count_tokens, count_tokens_many, estimate_tokens, get_token_counter, get_tokenizer,
+    token_counter_margin
+)
+
+
+def test_tokenizer_is_loaded_once(monkeypatch):
+    import tiktoken
+
+    loads = []
+
+    class Encoding:
+        def encode(self, text, disallowed_special=()):
+            return text.split()
+
+        def encode_batch(self, texts, disallowed_special=()):
+            return [self.encode(t) for t in texts]
+
+    def encoding_for_model(model):
+        loads.append(model)
+        return Encoding()
+
+    monkeypatch.setattr(tiktoken, "encoding_for_model", encoding_for_model)
+    get_tokenizer.cache_clear()
+    get_token_counter.cache_clear()
+    try:
+        assert count_tokens("one two three", "gpt") == 3
+        assert count_tokens("one two", "gpt") == 2
+        assert count_tokens_many(["one", "one two", ""], "gpt") == [1, 2, 0]
+        assert get_token_counter("gpt-4")("one two") == 2
+        assert token_counter_margin(get_token_counter("gpt-4")) < token_counter_margin(approximate_claude_tokens) \
+            < token_counter_margin(estimate_tokens)
+        assert len(loads) == 1
+    finally:
+        get_tokenizer.cache_clear()
+        get_token_counter.cache_clear()
+
+
+def test_approximate_claude_tokens():
+    assert approximate_claude_tokens("") == 0
+    assert approximate_claude_tokens("Hello, world!") == 4
+    assert approximate_claude_tokens("1234567") == 3
+    assert count_tokens("Hello, world!", "claude", approximate=True) == 4
+    assert count_tokens_many(["Hello", "a b"], "claude", approximate=True) == [1, 2]
+    assert get_token_counter("claude-3-5-sonnet-20241022") is approximate_claude_tokens
+    with pytest.raises(ValueError):
+        get_tokenizer("llama")